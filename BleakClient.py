@@ -1,42 +1,117 @@
 
+"""
+Qt-free client of a Polar device, depending only on asyncio, bleak and NumPy.
+
+The decoded data is delivered through Signal objects with the same
+connect() / emit() interface as the Qt signals, qt_client.QBleakClient
+re-emits them as pyqtSignals for the GUI.
+"""
 import asyncio
+import logging
 import struct
 
 import numpy as np
 import time
-import math
 from dataclasses import dataclass
 from functools import cached_property
-from PyQt5.QtCore import QObject, pyqtSignal
-from bleak import BleakClient
-from bleak.backends.device import BLEDevice
-from bleak import BleakScanner
-import qasync
+
+import decoders
+import pmd
+from dispatcher import PMDDispatcher
+from capture import CaptureWriter
+from clock_sync import ClockSync
+from continuity import ContinuityChecker
+from subscription import Subscription, DROP_OLDEST
+import device_cache
+from metrics import REGISTRY
+import transport
+
+log = logging.getLogger(__name__)
+
+
+PMD_CONTROL = "FB005C81-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of stream settings ##
+PMD_DATA = "FB005C82-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of start stream ##
+HEART_RATE_MEASUREMENT_UUID = "00002a37-0000-1000-8000-00805f9b34fb"
+
+## UUID for battery level ##
+BATTERY_LEVEL_UUID = "00002a19-0000-1000-8000-00805f9b34fb"
+
+## DEVICE INFORMATION SERVICE
+MANUFACTURER_NAME_UUID = "00002a29-0000-1000-8000-00805f9b34fb"
+MODEL_NBR_UUID = "00002a24-0000-1000-8000-00805f9b34fb"
+SERIAL_NUMBER_UUID = "00002a25-0000-1000-8000-00805f9b34fb"
+HARDWARE_REVISION_UUID = "00002a27-0000-1000-8000-00805f9b34fb"
+FIRMWARE_REVISION_UUID = "00002a26-0000-1000-8000-00805f9b34fb"
+SOFTWARE_REVISION_UUID = "00002a28-0000-1000-8000-00805f9b34fb"
+
+# Sample rates (Hz) assumed for the streams until a start command sets them
+DEFAULT_SAMPLE_RATE = {decoders.ECG: 130, decoders.PPG: 130, decoders.ACC: 200}
+
+# Settings of the start commands by model when the device does not answer or rejects GET_MEASUREMENT_SETTINGS
+DEFAULT_SETTINGS = {
+    "H10": {
+        decoders.ECG: {pmd.SettingType.SAMPLE_RATE: 130, pmd.SettingType.RESOLUTION: 14},
+        decoders.ACC: {pmd.SettingType.SAMPLE_RATE: 200, pmd.SettingType.RESOLUTION: 16, pmd.SettingType.RANGE: 8},
+    },
+    "OH1": {
+        decoders.PPG: {pmd.SettingType.SAMPLE_RATE: 130, pmd.SettingType.RESOLUTION: 22},
+        decoders.ACC: {pmd.SettingType.SAMPLE_RATE: 50, pmd.SettingType.RESOLUTION: 16, pmd.SettingType.RANGE: 8},
+    },
+}
+
+# Smallest accelerometer range (G) to negotiate, enough for the movements of the body
+ACC_RANGE = 8
+
+# Seconds to wait for the response to a PMD control point command
+PMD_RESPONSE_TIMEOUT = 5.0
+
+
+# Signals of the client:
+# ecg_updated, ppg_updated, acc_updated = decoders.Batch of every packet
+# HR_updated = [hr, RR intervals], PPI_updated = [HRs, PPIs, error estimates, times]
+# Battery_level_read = battery level (%)
+# disconnected = emitted when the connection ends, True when it was closed with stop()
+# data_gap = (start_ns, end_ns, measurement type, missing samples) of samples lost from a stream, epoch times
+SIGNALS = ("ecg_updated", "ppg_updated", "acc_updated", "HR_updated", "PPI_updated",
+           "Battery_level_read", "disconnected", "data_gap")
+
+# Stream names of the PMD measurement types, used as the stream label of the metrics
+STREAM_NAMES = {decoders.ECG: "ecg", decoders.PPG: "ppg", decoders.ACC: "acc", decoders.PPI: "ppi"}
+
+# Stream names of stream() and their signals
+STREAM_SIGNALS = {"ecg": "ecg_updated", "ppg": "ppg_updated", "acc": "acc_updated",
+                  "hr": "HR_updated", "ppi": "PPI_updated"}
+
+
+class Signal:
+    """
+    Minimal synchronous signal: emit() calls every connected callback in order.
+    """
+    __slots__ = ("_callbacks",)
+
+    def __init__(self):
+        self._callbacks = []
+
+    def connect(self, callback):
+        self._callbacks.append(callback)
+
+    def disconnect(self, callback):
+        self._callbacks.remove(callback)
+
+    def emit(self, *args):
+        for callback in self._callbacks:
+            callback(*args)
 
 
 @dataclass
-class QBleakClient(QObject):
-    device: BLEDevice
-    ecg_updated = pyqtSignal(int)
-    ppg_updated = pyqtSignal(list)
-    acc_updated = pyqtSignal(list)
-    HR_updated = pyqtSignal(list)
-    PPI_updated = pyqtSignal(list)
-    Battery_level_read = pyqtSignal(int)
-    first_acc_record = True
+class PolarClient:
+    device: "bleak.backends.device.BLEDevice"
 
     def ecg_data_conv(self, sender, data):
-        if data[0] == 0x00:
-            #timestamp = self.convert_to_unsigned_long(data, 1, 8)
-            step = 3
-            samples = data[10:]
-            offset = 0
-            ecg_package = []
-            while offset < len(samples):
-                ecg = self.convert_array_to_signed_int(samples, offset, step)
-                offset += step
-                ecg_package.append(ecg)
-                self.ecg_updated.emit(ecg)
+        # The whole packet is decoded at once and emitted as a single (timestamp, samples) batch
+        if data[0] == decoders.ECG:
+            self.emit_batch(decoders.ECG, decoders.decode_ecg(data, self.pmd_resolution[decoders.ECG]), self.ecg_updated)
+
     def ppg_data_conv(self, sender, data):
         # type1 (8)
         # timestamp (64)
@@ -46,28 +121,9 @@ class QBleakClient(QObject):
         #   ppg2 (24)
         #   ppg3 (24)
         #   amb (24)
-        if data[0] == 0x01:
-
-            def get_ppg_value(subdata):
-
-                # A bit of magic happening here with the padding.
-                # Since the value comes as a 24 bit signed int, it's padded to allow the use
-                # of struct.unpack("<i") since that takes a 32 bit signed integer.
-                # The padding is then either 0xFF or 0x00 depending of if the most significant
-                # bit of the most significant byte of the 24 bit value was set. Since this
-                # determine if the value was positive of negative.
-                return struct.unpack("<i", subdata + (b'\0' if subdata[2] < 128 else b'\xff'))[0]
-
-
-            numSamples = math.floor((len(data) - 10) / 12)
-            for x in range(numSamples):
-                channel_samples = []
-                for y in range(4):
-                    channel_samples.append(get_ppg_value(data[10 + x * 12 + y * 3:(10 + x * 12 + y * 3) + 3]))
-
-
-                self.ppg_updated.emit(channel_samples)
-
+        # The (n_samples, 4) block is read straight from the notification buffer and emitted once per packet
+        if data[0] == decoders.PPG:
+            self.emit_batch(decoders.PPG, decoders.decode_ppg(data, self.pmd_resolution[decoders.PPG]), self.ppg_updated)
 
     def hr_data_conv(self, sender, data):
         """
@@ -118,6 +174,7 @@ class QBleakClient(QObject):
             #self.ibi_queue_values.enqueue(np.array([ibi]))
             #self.ibi_queue_times.enqueue(np.array([time.time_ns() / 1.0e9]))
 
+        self.count_decoded("hr", len(values))
         self.HR_updated.emit([hr, values])
 
     def acc_data_conv(self, sender, data):
@@ -129,48 +186,19 @@ class QBleakClient(QObject):
         # sample1, sample2,
 
 
-        if data[0] == 0x02:
-            time_step = 0.005  # 200 Hz sample rate (ECG)
-            timestamp = self.convert_to_unsigned_long(data, 1,
-                                                          8) / 1.0e9  # timestamp of the last sample in the record
-
-            frame_type = data[9]
-            resolution = (frame_type + 1) * 8  # 16 bit
-            step = math.ceil(resolution / 8.0)
-            samples = data[10:]
-            n_samples = math.floor(len(samples) / (step * 3))
-            record_duration = (n_samples - 1) * time_step  # duration of the current record received in seconds
-
-            if self.first_acc_record:  # First record at the start of the stream
-                stream_start_t_epoch_s = time.time_ns() / 1.0e9 - record_duration
-                stream_start_t_polar_s = timestamp - record_duration
-                self.polar_to_epoch_s = stream_start_t_epoch_s - stream_start_t_polar_s
-                self.first_acc_record = False
-
-            sample_timestamp = timestamp - record_duration + self.polar_to_epoch_s  # timestamp of the first sample in the record in epoch seconds
-            offset = 0
-            Acc_list = []
-            while offset < len(samples):
-                x = self.convert_array_to_signed_int(samples, offset, step) / 100.0
-                offset += step
-                y = self.convert_array_to_signed_int(samples, offset, step) / 100.0
-                offset += step
-                z = self.convert_array_to_signed_int(samples, offset, step) / 100.0
-                offset += step
-
-                #self.acc_queue_times.enqueue(np.array([sample_timestamp]))
-                #self.acc_queue_values.enqueue(np.array([x, y, z]))
-                Acc_list.append([x, y, z])
-
-                sample_timestamp += time_step
-            self.acc_updated.emit(Acc_list)
+        # Raw frames (frame type 0, 1, 2) and delta-compressed frames (frame type bit 0x80)
+        # are both decoded into a single (n_samples, 3) batch per packet.
+        if data[0] == decoders.ACC:
+            batch = decoders.decode_acc(data, self.pmd_resolution[decoders.ACC])
+            self.emit_batch(decoders.ACC, batch._replace(samples=batch.samples / 100.0), self.acc_updated)
 
     def PPI_data_conv(self, sender, data):
         if data[0] == 0x03:
 
             type1, _, type2 = struct.unpack("<BqB", data[0:10])
             if type1 == 3:
-                numSamples = math.floor((len(data) - 8) / 6)
+                # 6 byte records after the 10 byte PMD header, a trailing partial record is ignored
+                numSamples = (len(data) - 10) // 6
 
 
                 HRs = []
@@ -185,7 +213,69 @@ class QBleakClient(QObject):
                     PPIs.append(ppi)
                     err_ests.append(errEst)
 
-                self.PPI_updated.emit([HRs, PPIs, err_ests])
+                # Epoch time (ns) at the end of every interval, the last one ends at the packet timestamp
+                ppi_ns = np.array(PPIs, dtype=np.int64) * 1000000
+                ends = np.cumsum(ppi_ns[::-1])[::-1] - ppi_ns
+                timestamp = decoders.read_timestamp(data)
+                if timestamp:
+                    self.clock.observe(timestamp, self.received_ns)
+                    times = self.clock.to_epoch(timestamp - ends)
+                else:
+                    # Sensors without a PPI timestamp, use the receive time
+                    times = self.received_ns - ends
+                self.count_decoded("ppi", numSamples)
+                self.PPI_updated.emit([HRs, PPIs, err_ests, times])
+
+    def emit_batch(self, measurement_type, batch, signal):
+        """
+        Check the continuity of the packet, set the epoch time of every sample and emit the batch.
+
+        Duplicated packets are dropped and lost samples are emitted with data_gap.
+        """
+        rate = self.pmd_sample_rate.get(measurement_type) or DEFAULT_SAMPLE_RATE[measurement_type]
+        checker = self.continuity.get(measurement_type)
+        if checker is None:
+            checker = self.continuity[measurement_type] = ContinuityChecker()
+        gap = checker.check(batch.timestamp, len(batch.samples), rate)
+        if checker.duplicate:
+            return
+        metrics = self.count_decoded(STREAM_NAMES[measurement_type], len(batch.samples))
+        self.clock.observe(batch.timestamp, self.received_ns)
+        if gap is not None:
+            metrics[3].inc(gap.missing)
+            start_ns, end_ns = self.clock.to_epoch([gap.start_ns, gap.end_ns])
+            self.data_gap.emit(int(start_ns), int(end_ns), measurement_type, gap.missing)
+        signal.emit(batch._replace(times=self.clock.sample_times(measurement_type, batch.timestamp, len(batch.samples), rate)))
+
+    def stream_metrics(self, stream):
+        """
+        (notifications, samples, decode seconds, lost samples) metrics of a stream, see metrics.py.
+
+        The notifications and samples per second of the last 10 s are published as rate gauges.
+        """
+        metrics = self._stream_metrics.get(stream)
+        if metrics is None:
+            labels = {"stream": stream}
+            # Decoding also runs without a device (replaying a capture, benchmarks), without a device label
+            if self.device is not None:
+                labels["device"] = self.device.name
+            metrics = self._stream_metrics[stream] = (
+                REGISTRY.counter("polopy_notifications_total", "Notifications decoded", **labels),
+                REGISTRY.counter("polopy_samples_total", "Samples decoded", **labels),
+                REGISTRY.histogram("polopy_decode_seconds", "Time from receiving a notification to emitting its data", **labels),
+                REGISTRY.counter("polopy_lost_samples_total", "Samples lost in transmission", **labels),
+            )
+            REGISTRY.rate("polopy_notifications_per_second", "Notifications decoded per second", metrics[0], **labels)
+            REGISTRY.rate("polopy_samples_per_second", "Samples decoded per second", metrics[1], **labels)
+        return metrics
+
+    def count_decoded(self, stream, n_samples):
+        # Called by the decoders just before emitting, so the time excludes the connected callbacks
+        metrics = self.stream_metrics(stream)
+        metrics[0].inc()
+        metrics[1].inc(n_samples)
+        metrics[2].observe(time.perf_counter() - self._received_at)
+        return metrics
 
     def convert_array_to_signed_int(self, data, offset, length):
         return int.from_bytes(
@@ -198,73 +288,158 @@ class QBleakClient(QObject):
         )
 
     def __post_init__(self):
-        super().__init__()
+        for name in SIGNALS:
+            setattr(self, name, Signal())
+        # Resolution (bits) requested for each PMD stream, needed for decoding delta-compressed frames
+        self.pmd_resolution = {decoders.ECG: 14, decoders.PPG: 22, decoders.ACC: 16}
+        # Sample rate (Hz) requested for each started PMD stream
+        self.pmd_sample_rate = {}
+        self.device_info = {}
+        # All PMD streams share one subscription to PMD_DATA, routed by the measurement type byte
+        self.pmd_dispatcher = PMDDispatcher()
+        self.pmd_subscribed = False
+        self.pmd_decoders = {decoders.ECG: self.ecg_data_conv, decoders.PPG: self.ppg_data_conv,
+                             decoders.ACC: self.acc_data_conv, decoders.PPI: self.PPI_data_conv}
+        # Every notification goes through handle_notification, which looks up the handler of its characteristic
+        self.notification_handlers = {HEART_RATE_MEASUREMENT_UUID: self.hr_data_conv,
+                                      PMD_DATA.lower(): self.pmd_dispatcher,
+                                      PMD_CONTROL.lower(): self.handle_control_response}
+        # Control point: pending responses by (op code, measurement type) and the settings offered by the device
+        self.pmd_control_subscribed = False
+        self._pmd_responses = {}
+        self.available_settings = {}
+        self.mtu = None
+        # Optional capture.CaptureWriter logging the raw traffic
+        self.capture = None
+        # Sensor to host time mapping shared by all streams of the device
+        self.clock = ClockSync()
+        # continuity.ContinuityChecker of every stream, counting lost and duplicated packets
+        self.continuity = {}
+        # Host epoch time (ns) at which the notification being handled was received
+        self.received_ns = 0
+        self._received_at = 0.0
+        # Metrics of every stream by stream name, see stream_metrics()
+        self._stream_metrics = {}
+        self.connected = False
+        self.closing = False
+        # Static device information by address, one cache and file shared by all clients
+        self.device_cache = device_cache.shared()
+        self.connect_timings = {}
+        self.battery_level = None
+        self.battery_task = None
+        # Start commands of the running PMD streams and whether HR notifications are on, re-issued by resume()
+        self.active_commands = {}
+        self.hr_active = False
+        # Open subscriptions of stream(), ended by stop()
+        self.subscriptions = []
         self.ECG_data = []
 
     @cached_property
-    def client(self) -> BleakClient:
-        return BleakClient(self.device, disconnected_callback=self._handle_disconnect)
+    def client(self):
+        # bleak.BleakClient for real devices, simulator.SimulatedClient for simulated ones
+        return transport.create_client(self.device, disconnected_callback=self._handle_disconnect)
     async def scan(self):
-        devices = await BleakScanner.discover()
-        print(devices)
+        devices = await transport.discover()
+        log.info("Found %s", devices)
 
     async def start(self):
-        await self.client.connect()
-
-
-        ## UUID for battery level ##
-        BATTERY_LEVEL_UUID = "00002a19-0000-1000-8000-00805f9b34fb"
-
-        ## DEVICE INFORMATION SERVICE
-        DEVICE_INFORMATION_SERVICE = "0000180a-0000-1000-8000-00805f9b34fb"
-        MANUFACTURER_NAME_UUID = "00002a29-0000-1000-8000-00805f9b34fb"
-        MODEL_NBR_UUID = "00002a24-0000-1000-8000-00805f9b34fb"
-        SERIAL_NUMBER_UUID = "00002a25-0000-1000-8000-00805f9b34fb"
-        HARDWARE_REVISION_UUID = "00002a27-0000-1000-8000-00805f9b34fb"
-        FIRMWARE_REVISION_UUID = "00002a26-0000-1000-8000-00805f9b34fb"
-        SOFTWARE_REVISION_UUID = "00002a28-0000-1000-8000-00805f9b34fb"
-        SYSTEM_ID_UUID = "00002a23-0000-1000-8000-00805f9b34fb"
-
-        self.model_number = await self.client.read_gatt_char(MODEL_NBR_UUID)
-        self.manufacturer_name = await self.client.read_gatt_char(MANUFACTURER_NAME_UUID)
-        self.serial_number = await self.client.read_gatt_char(SERIAL_NUMBER_UUID)
-        self.battery_level = await self.client.read_gatt_char(BATTERY_LEVEL_UUID)
-        self.firmware_revision = await self.client.read_gatt_char(FIRMWARE_REVISION_UUID)
-        self.hardware_revision = await self.client.read_gatt_char(HARDWARE_REVISION_UUID)
-        self.software_revision = await self.client.read_gatt_char(SOFTWARE_REVISION_UUID)
-
-
-        if "OH1" in ''.join(map(chr, self.model_number)):
-            print("Optical sensor info")
-            print("----------------------")
-        elif "H10" in ''.join(map(chr, self.model_number)):
-            print("ECG strap sensor info")
-            print("----------------------")
-
-
-
-        Battery_level = int(self.battery_level[0])
-        BLUE = "\033[94m"
-        RESET = "\033[0m"
-        print(f"Model Number: {BLUE}{''.join(map(chr, self.model_number))}{RESET}\n"
-              f"Bluetooth address: {BLUE}{self.device.address}{RESET}\n"
-              f"Manufacturer Name: {BLUE}{''.join(map(chr, self.manufacturer_name))}{RESET}\n"
-              f"Serial Number: {BLUE}{''.join(map(chr, self.serial_number))}{RESET}\n"
-              f"Battery Level: {BLUE}{int(self.battery_level[0])}%{RESET}\n"
-              f"Firmware Revision: {BLUE}{''.join(map(chr, self.firmware_revision))}{RESET}\n"
-              f"Hardware Revision: {BLUE}{''.join(map(chr, self.hardware_revision))}{RESET}\n"
-              f"Software Revision: {BLUE}{''.join(map(chr, self.software_revision))}{RESET}")
+        """
+        Connect and read the device information.
 
+        The static device information comes from the device info cache when the
+        address is known and the device still has the cached firmware revision,
+        otherwise it is read with concurrent GATT reads and cached. The battery level is read in the background (battery_task) and
+        emitted with Battery_level_read. The duration of every phase (s) is in connect_timings.
         """
-        Measurement type:
-        
+        self.closing = False
+        self.connect_timings = {}
+        started = time.perf_counter()
+        await self.client.connect()
+        self.connected = True
+        self.connect_timings["connect"] = time.perf_counter() - started
+        self.available_settings = {}
+
+        phase = time.perf_counter()
+        await self.request_mtu()
+        self.connect_timings["mtu"] = time.perf_counter() - phase
+
+        # The battery level changes between connections, it is always read
+        self.battery_task = asyncio.ensure_future(self.read_battery_level())
+
+        phase = time.perf_counter()
+        info = self.device_cache.get(self.device.address)
+        if info is not None:
+            # A firmware update changes the revisions, the cached information is only used with the same firmware
+            firmware = ''.join(map(chr, await self.client.read_gatt_char(FIRMWARE_REVISION_UUID)))
+            if firmware != info.get("firmware_revision"):
+                info = None
+        self.connect_timings["device_info_cached"] = info is not None
+        if info is None:
+            uuids = [MODEL_NBR_UUID, MANUFACTURER_NAME_UUID, SERIAL_NUMBER_UUID,
+                     FIRMWARE_REVISION_UUID, HARDWARE_REVISION_UUID, SOFTWARE_REVISION_UUID]
+            values = await asyncio.gather(*(self.client.read_gatt_char(uuid) for uuid in uuids))
+            model, manufacturer, serial, firmware, hardware, software = (''.join(map(chr, value)) for value in values)
+            # Static device information, stored e.g. in the header of the recordings
+            info = {
+                "address": self.device.address,
+                "model": model,
+                "manufacturer": manufacturer,
+                "serial_number": serial,
+                "firmware_revision": firmware,
+                "hardware_revision": hardware,
+                "software_revision": software,
+            }
+            self.device_cache.put(self.device.address, info)
+        self.device_info = info
+        self.connect_timings["device_info"] = time.perf_counter() - phase
+        self.connect_timings["total"] = time.perf_counter() - started
+
+        for phase, seconds in self.connect_timings.items():
+            if phase != "device_info_cached":
+                REGISTRY.gauge("polopy_connect_seconds", "Duration of the connect phases",
+                               device=self.device.name, phase=phase).set(seconds)
+
+        if "OH1" in info["model"]:
+            kind = "Optical sensor info"
+        elif "H10" in info["model"]:
+            kind = "ECG strap sensor info"
+        else:
+            kind = "Sensor info"
+        log.info("%s\n----------------------\n"
+                 "Model Number: %s\n"
+                 "Bluetooth address: %s\n"
+                 "Manufacturer Name: %s\n"
+                 "Serial Number: %s\n"
+                 "Firmware Revision: %s\n"
+                 "Hardware Revision: %s\n"
+                 "Software Revision: %s\n"
+                 "Connected in %.0f ms (device info %s)",
+                 kind, info['model'], self.device.address, info['manufacturer'], info['serial_number'],
+                 info['firmware_revision'], info['hardware_revision'], info['software_revision'],
+                 self.connect_timings['total'] * 1000,
+                 'cached' if self.connect_timings['device_info_cached'] else 'read')
+
+    async def read_battery_level(self):
         """
-
-        # Read the battery level and emit it to the GUI for displaying
-        self.Battery_level_read.emit(Battery_level)
+        Read the battery level and emit it with Battery_level_read. Returns the level (%).
+        """
+        phase = time.perf_counter()
+        try:
+            value = await self.client.read_gatt_char(BATTERY_LEVEL_UUID)
+        except Exception as error:
+            # The device may disconnect before the background read finishes
+            log.warning("%s: battery level read failed: %r", self.device.name, error)
+            return None
+        self.battery_level = int(value[0])
+        self.connect_timings["battery"] = time.perf_counter() - phase
+        REGISTRY.gauge("polopy_battery_percent", "Battery level", device=self.device.name).set(self.battery_level)
+        log.info("%s: battery level %d%%", self.device.name, self.battery_level)
+        # Emit the battery level to the GUI for displaying
+        self.Battery_level_read.emit(self.battery_level)
+        return self.battery_level
 
     """
-    Command structure:
+    Command structure (built with pmd.start_command / pmd.stop_command, see pmd.py):
     
     START_MEASUREMENT = 2
     STOP_MEASUREMENT = 3
@@ -281,7 +456,7 @@ class QBleakClient(QObject):
     
     Sample Rate:
     50 Hz = 0x0032
-    135 Hz = 0x0082
+    130 Hz = 0x0082
     200 Hz = 0x00c8
     SampleRateUnknown = -1
     
@@ -293,7 +468,7 @@ class QBleakClient(QObject):
     8 = 0,
     16 = 1,
     24 = 2,
-    Delta = 128
+    Delta = 128 (bit 0x80 of the frame type, decoded by decoders.decode_delta_frame)
     
     Range:
     8G = 0x0008,
@@ -302,78 +477,299 @@ class QBleakClient(QObject):
     
     For example for the ECG measurement:
     [0x02, 0x00, 0x00, 0x01, 0x82, 0x00, 0x01, 0x01, 0x0E, 0x00]
-    [start measurement, ECG, 0x00, 0x01, 135, 0x00, 0x01, 0x01, 0x0E, 0x00]
+    [start measurement, ECG, 0x00, 0x01, 130, 0x00, 0x01, 0x01, 0x0E, 0x00]
     """
 
 
+    def handle_notification(self, uuid, sender, data, received_ns=None):
+        """
+        Decode a notification of the characteristic uuid.
+
+        received_ns = epoch time (ns) the notification was received, the time of the call when not given
+        (a replayed capture passes the recorded one)
+        """
+        self._received_at = time.perf_counter()
+        self.received_ns = time.time_ns() if received_ns is None else received_ns
+        if self.capture is not None:
+            self.capture.notification(uuid, data, self.received_ns / 1e9)
+        self.notification_handlers[uuid.lower()](sender, data)
+
+    def handle_write(self, uuid, data):
+        """
+        Apply a command written to the device to the decoding state.
+
+        START_MEASUREMENT commands to PMD_CONTROL register the decoder of the stream
+        and carry the sample rate and resolution needed to decode its frames, and
+        STOP_MEASUREMENT removes the decoder. Called for every write to the device
+        and when a capture is replayed.
+        """
+        if uuid.lower() != PMD_CONTROL.lower() or len(data) < 2:
+            return
+        op_code, measurement_type = data[0], data[1]
+        if op_code == pmd.OpCode.START_MEASUREMENT:
+            settings = pmd.parse_settings(data, 2)
+            if pmd.SettingType.SAMPLE_RATE in settings:
+                self.pmd_sample_rate[measurement_type] = settings[pmd.SettingType.SAMPLE_RATE][0]
+            if pmd.SettingType.RESOLUTION in settings:
+                self.pmd_resolution[measurement_type] = settings[pmd.SettingType.RESOLUTION][0]
+            if measurement_type in self.pmd_decoders:
+                self.pmd_dispatcher.add_stream(measurement_type, self.pmd_decoders[measurement_type])
+            if self.active_commands.get(measurement_type) != bytes(data) and measurement_type in self.continuity:
+                # New settings start a new sequence, re-sending the same command (resume) does not
+                self.continuity[measurement_type].reset()
+            self.active_commands[measurement_type] = bytes(data)
+        elif op_code == pmd.OpCode.STOP_MEASUREMENT:
+            self.pmd_dispatcher.remove_stream(measurement_type)
+            self.active_commands.pop(measurement_type, None)
+
+    async def _start_notify(self, uuid):
+        await self.client.start_notify(uuid, lambda sender, data: self.handle_notification(uuid, sender, data))
+
+    async def _write_pmd_control(self, command):
+        if self.capture is not None:
+            self.capture.write(PMD_CONTROL, command)
+        self.handle_write(PMD_CONTROL, command)
+        await self.client.write_gatt_char(PMD_CONTROL, command)
+
+    def start_capture(self, path):
+        """
+        Log every notification and PMD control write of the device to a capture file (see capture.py).
+
+        The start commands of the streams already running are written first, so a
+        capture started in the middle of a session has the settings to decode them.
+        """
+        self.capture = CaptureWriter(path)
+        for command in self.active_commands.values():
+            self.capture.write(PMD_CONTROL, command)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
     async def start_HR(self):
-        print("starting HR...")
-        HEART_RATE_MEASUREMENT_UUID = "00002a37-0000-1000-8000-00805f9b34fb"
-        await self.client.start_notify(HEART_RATE_MEASUREMENT_UUID, self.hr_data_conv)
-    async def start_PPI(self):
-        print("starting PPI...")
-        PMD_CONTROL = "FB005C81-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of stream settings ##
-        PMD_DATA = "FB005C82-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of start stream ##
-        PPI_WRITE = bytearray([0x02, 0x03])
-        await self.client.write_gatt_char(PMD_CONTROL, PPI_WRITE)
-        await self.client.start_notify(PMD_DATA, self.PPI_data_conv)
+        log.info("%s: starting HR", self.device.name)
+        await self._start_notify(HEART_RATE_MEASUREMENT_UUID)
+        self.hr_active = True
 
+    async def resume(self):
+        """
+        Reconnect after a lost connection and restart the streams that were running.
 
+        The device information, decoders, clock mapping, capture and subscriptions are kept.
+        """
+        self.closing = False
+        await self.client.connect()
+        self.connected = True
+        # The MTU is exchanged again on every connection
+        await self.request_mtu()
+        # Notifications do not survive a disconnection
+        self.pmd_subscribed = False
+        self.pmd_control_subscribed = False
+        try:
+            if self.hr_active:
+                await self._start_notify(HEART_RATE_MEASUREMENT_UUID)
+            for command in list(self.active_commands.values()):
+                await self.start_pmd_stream(bytearray(command))
+        except Exception:
+            # Leave the device disconnected, so the next attempt starts from scratch
+            await self.client.disconnect()
+            raise
+    async def _subscribe_control(self):
+        # The control point responses arrive as indications on PMD_CONTROL
+        if not self.pmd_control_subscribed:
+            await self._start_notify(PMD_CONTROL)
+            self.pmd_control_subscribed = True
+
+    def handle_control_response(self, sender, data):
+        """
+        Complete the pending pmd_request() of a control point response.
 
-    async def start_ECG(self):
-        PMD_CONTROL = "FB005C81-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of stream settings ##
-        PMD_DATA = "FB005C82-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of start stream ##
-        ECG_WRITE = bytearray([0x02, 0x00, 0x00, 0x01, 0x82, 0x00, 0x01, 0x01, 0x0E, 0x00])
-        await self.client.write_gatt_char(PMD_CONTROL, ECG_WRITE)
-        await self.client.start_notify(PMD_DATA, self.ecg_data_conv)
+        Responses split over several indications (more frames flag) are joined first.
+        """
+        response = pmd.parse_response(data)
+        if response is None:
+            return
+        pending = self._pmd_responses.get((response.op_code, response.measurement_type))
+        if pending is None or pending[0].done():
+            return
+        pending[1] += response.parameters
+        if not response.more:
+            pending[0].set_result(response._replace(parameters=bytes(pending[1])))
 
-    async def start_ACC_H10(self):
-        print("starting ACC...")
-        ACC_WRITE = bytearray([0x02, 0x02, 0x00, 0x01, 0xC8, 0x00, 0x01, 0x01, 0x10, 0x00, 0x02, 0x01, 0x08, 0x00])
-        PMD_CONTROL = "FB005C81-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of stream settings ##
-        PMD_DATA = "FB005C82-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of start stream ##
-        await self.client.write_gatt_char(PMD_CONTROL, ACC_WRITE)
-        await self.client.start_notify(PMD_DATA, self.acc_data_conv)
+    async def pmd_request(self, command, timeout=PMD_RESPONSE_TIMEOUT):
+        """
+        Write a control point command and wait for the response of the device.
 
-    async def start_ACC_OH1(self):
-        print("starting ACC...")
-        ACC_WRITE = bytearray([0x02, 0x02, 0x00, 0x01, 0x0032, 0x00, 0x01, 0x01, 0x10, 0x00, 0x02, 0x01, 0x08, 0x00])
-        PMD_CONTROL = "FB005C81-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of stream settings ##
-        PMD_DATA = "FB005C82-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of start stream ##
-        await self.client.write_gatt_char(PMD_CONTROL, ACC_WRITE)
-        await self.client.start_notify(PMD_DATA, self.acc_data_conv)
+        Returns the pmd.ControlPointResponse, or None when no response arrived
+        within `timeout` seconds. Raises pmd.PMDError when the device rejects the command.
+        """
+        await self._subscribe_control()
+        key = (command[0], command[1])
+        future = asyncio.get_running_loop().create_future()
+        self._pmd_responses[key] = [future, bytearray()]
+        try:
+            await self._write_pmd_control(command)
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            log.warning("%s: no response to PMD command %s", self.device.name, bytes(command).hex())
+            return None
+        finally:
+            self._pmd_responses.pop(key, None)
+        if not response.ok and response.status != pmd.Status.ALREADY_IN_STATE:
+            raise pmd.PMDError(response)
+        return response
+
+    async def get_measurement_settings(self, measurement_type):
+        """
+        Settings the device supports for a stream, {pmd.SettingType: [values]}. Cached per connection.
 
-    async def start_PPG(self):
+        Empty when the device does not answer or rejects the query.
+        """
+        if measurement_type not in self.available_settings:
+            try:
+                response = await self.pmd_request(pmd.settings_command(measurement_type))
+            except pmd.PMDError as error:
+                log.warning("%s: %s", self.device.name, error)
+                response = None
+            self.available_settings[measurement_type] = response.settings() if response else {}
+        return self.available_settings[measurement_type]
+
+    async def start_pmd_stream(self, command):
         """
+        Send the start command of a PMD stream, which also registers its decoder.
 
-        Tell the OH-1 that it should start to stream PPG values
+        PMD_DATA is subscribed only once, when the first stream is started.
+        Later streams are just added to the dispatcher.
+        """
+        if not self.pmd_subscribed:
+            await self._start_notify(PMD_DATA)
+            self.pmd_subscribed = True
+        previous = self.active_commands.get(command[1])
+        try:
+            return await self.pmd_request(command)
+        except pmd.PMDError:
+            # The device keeps its previous state, restore the decoding state of the stream
+            self.handle_write(PMD_CONTROL, previous or pmd.stop_command(command[1]))
+            raise
+
+    async def stop_pmd_stream(self, measurement_type):
+        # STOP_MEASUREMENT for the given type, the subscription to PMD_DATA is kept for the other streams
+        await self.pmd_request(pmd.stop_command(measurement_type))
+
+    def default_settings(self, measurement_type):
+        """
+        Fallback settings of a stream for the model of the device (DEFAULT_SETTINGS),
+        those of the first model with the stream when the model is unknown.
+        """
+        model = self.device_info.get("model") or getattr(self.device, "name", None) or ""
+        for name, settings in sorted(DEFAULT_SETTINGS.items(), key=lambda item: item[0] not in model):
+            if measurement_type in settings:
+                return dict(settings[measurement_type])
+        return {}
+
+    async def start_measurement(self, measurement_type, **settings):
+        """
+        Start a PMD stream. Returns the settings used, {pmd.SettingType: value}.
+
+        settings = sample_rate, resolution, range, channels; the ones not given (or None)
+        are negotiated with pmd.choose_settings() from the settings the device reports with
+        GET_MEASUREMENT_SETTINGS: the highest sample rate and resolution, the smallest range
+        covering ACC_RANGE. The default_settings() of the model are used when the device
+        does not answer or rejects the query. PPI has no settings, its start command is
+        sent without a query.
+        """
+        if measurement_type == pmd.MeasurementType.PPI:
+            await self.start_pmd_stream(pmd.start_command(measurement_type))
+            return {}
+        chosen = pmd.choose_settings(await self.get_measurement_settings(measurement_type), ACC_RANGE)
+        if not chosen:
+            chosen = self.default_settings(measurement_type)
+        for name, value in settings.items():
+            if value is not None:
+                chosen[pmd.SettingType[name.upper()]] = value
+        await self.start_pmd_stream(pmd.start_command(measurement_type, chosen))
+        return chosen
+
+    async def start_PPI(self):
+        log.info("%s: starting PPI", self.device.name)
+        # PPI has no settings, the command is just [START_MEASUREMENT, PPI]
+        await self.start_measurement(pmd.MeasurementType.PPI)
+
+    async def start_ECG(self, sample_rate=None, resolution=None):
+        await self.start_measurement(pmd.MeasurementType.ECG, sample_rate=sample_rate, resolution=resolution)
+
+    async def start_ACC(self, sample_rate=None, resolution=None, acc_range=None):
+        log.info("%s: starting ACC", self.device.name)
+        await self.start_measurement(pmd.MeasurementType.ACC, sample_rate=sample_rate, resolution=resolution, range=acc_range)
 
-        cmd = []
-        cmd.append(PolarDevice.CPOpCode.START_MEASUREMENT.value)
-        cmd.append(PolarDevice.MeasurementType.PPG.value)
-        cmd.append(0x00)  # Sample rate Setting
-        cmd.append(0x01)  # array count (?)
-        cmd.append(0x82)  # 16 bit value: 130 Hz
-        cmd.append(0x00)  # see above
-        cmd.append(0x01)  # Resolution Setting
-        cmd.append(0x01)  # array count
-        cmd.append(0x16)  # 16 bit value: 22 bit
-        cmd.append(0x00)  # see above
+    async def start_ACC_H10(self, sample_rate=None, resolution=None, acc_range=None):
+        await self.start_ACC(sample_rate, resolution, acc_range)
+
+    async def start_ACC_OH1(self, sample_rate=None, resolution=None, acc_range=None):
+        await self.start_ACC(sample_rate, resolution, acc_range)
+
+    async def start_PPG(self, sample_rate=None, resolution=None):
+        """
+        Tell the OH-1 that it should start to stream PPG values, by default at the
+        highest sample rate and resolution it supports (130 Hz, 22 bit).
+        """
+        await self.start_measurement(pmd.MeasurementType.PPG, sample_rate=sample_rate, resolution=resolution)
+
+    async def request_mtu(self):
         """
+        Read the MTU of the connection into self.mtu. Returns the MTU in use.
 
+        The MTU is exchanged by the OS Bluetooth stack when connecting, bleak can not
+        ask for a larger one. On BlueZ bleak only learns the negotiated MTU by acquiring
+        it explicitly (_acquire_mtu), the other backends report it directly.
+        """
+        acquire = getattr(getattr(self.client, "_backend", None), "_acquire_mtu", None)
+        if acquire is not None:
+            try:
+                await acquire()
+            except Exception as error:
+                log.warning("%s: reading the MTU failed: %r", self.device.name, error)
+        self.mtu = getattr(self.client, "mtu_size", None)
+        return self.mtu
+
+    @property
+    def stream_sample_rates(self):
+        # Nominal sample rates of the started streams by stream name, as used by the recorder
+        names = {decoders.ECG: "ECG", decoders.PPG: "PPG", decoders.ACC: "ACC"}
+        return {names[t]: rate for t, rate in self.pmd_sample_rate.items() if t in names}
+
+    def stream(self, name, maxsize=256, policy=DROP_OLDEST):
+        """
+        Subscribe to a stream: "ecg", "ppg", "acc", "hr" or "ppi".
 
-        PPG_WRITE = bytearray([0x02, 0x01, 0x00, 0x01, 0x82, 0x00, 0x01, 0x01, 0x16, 0x00])
-        PMD_CONTROL = "FB005C81-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of stream settings ##
-        PMD_DATA = "FB005C82-02E7-F387-1CAD-8ACD2D8DF0C8"  ## UUID for Request of start stream ##
-        await self.client.write_gatt_char(PMD_CONTROL, PPG_WRITE)
-        await self.client.start_notify(PMD_DATA, self.ppg_data_conv)
+        Returns a subscription.Subscription with its own queue of `maxsize` values
+        and the policy used when the queue is full, DROP_OLDEST or DROP_NEWEST (the
+        notifications can not wait, so BLOCK raises ValueError), to be consumed with
 
+            async for batch in client.stream("ecg"):
+        """
+        subscription = Subscription(getattr(self, STREAM_SIGNALS[name.lower()]), maxsize, policy)
+        self.subscriptions = [s for s in self.subscriptions if not s.closed]
+        self.subscriptions.append(subscription)
+        return subscription
 
     async def stop(self):
+        self.closing = True
+        for subscription in self.subscriptions:
+            subscription.close()
         await self.client.disconnect()
+        self.stop_capture()
 
-    def _handle_disconnect(self, true):
-        print("Device was disconnected, goodbye.")
-        # cancelling all tasks effectively ends the program
-        for task in asyncio.all_tasks():
-            task.cancel()
\ No newline at end of file
+    def _handle_disconnect(self, client):
+        # Only this device is affected, the other clients and tasks of the event loop keep running
+        if not self.connected:
+            return
+        self.connected = False
+        self.pmd_subscribed = False
+        self.pmd_control_subscribed = False
+        if self.closing:
+            log.info("%s was disconnected", self.device.name)
+        else:
+            log.warning("%s was disconnected", self.device.name)
+        self.disconnected.emit(self.closing)
@@ -1,12 +1,15 @@
 import asyncio
+import datetime
+import logging
+import os
 from functools import cached_property
+from pathlib import Path
 import sys
 import pyqtgraph as pg
 import numpy as np
 from PyQt5 import QtGui
 from PyQt5.QtCore import QTimer
 from PyQt5.QtGui import QPixmap
-from scipy.fft import fft
 from collections import deque
 
 from PyQt5.QtWidgets import (
@@ -21,35 +24,37 @@ from PyQt5.QtWidgets import (
 )
 
 
-import BleakClient
+from qt_client import QBleakClient
+from ring_buffer import RingBuffer
+from render_scheduler import RenderScheduler
+from filters import FilterBank
+from respiration import RespirationEstimator
+from hrv import HRVEngine
+from recorder import Recorder
+from qrs import QRSDetector
+from reconnect import ReconnectSupervisor
+from metrics import REGISTRY
 import qasync
-from bleak import BleakScanner
-from bleak.backends.device import BLEDevice
-import pandas as pd
-import datetime
-import scipy
-
-from pathlib import Path
+import transport
 
+log = logging.getLogger(__name__)
 
 UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_RX_CHAR_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
 
 UART_SAFE_SIZE = 20
+# Icons, next to this file in a checkout, under <prefix>/share/polopy when installed with pip
+IMAGE_DIRECTORY = next((directory for directory in (Path(__file__).parent / "Images",
+                                                    Path(sys.prefix) / "share" / "polopy" / "Images")
+                        if directory.is_dir()), Path("Images"))
+# Directory for raw BLE captures, capturing is enabled by setting the environment variable
+CAPTURE_DIRECTORY = os.environ.get("POLOPY_CAPTURE")
+# Runtime metrics (see metrics.py) are written to POLOPY_METRICS_FILE and served on localhost:POLOPY_METRICS_PORT when set
+METRICS_FILE = os.environ.get("POLOPY_METRICS_FILE")
+METRICS_PORT = os.environ.get("POLOPY_METRICS_PORT")
 Battery_level = 100
-
-class liveFilter():
-    def __init__(self, odred, window, fs, bandtype, filtertype):
-        #initialize filter coefficients
-        self.b, self.a = scipy.signal.iirfilter(odred, Wn=window, fs=fs, btype=bandtype, ftype=filtertype)
-        self.z = np.zeros(self.b.size-1)
-    def process(self, data):
-        y, self.z = scipy.signal.lfilter(self.b, self.a, [data], zi=self.z)
-        return y[0]
-
-
-
+PLOT_FPS = 30  # maximum redraw rate of the live plots
 
 class MainWindow(QMainWindow):
     """
@@ -59,42 +64,39 @@ class MainWindow(QMainWindow):
         self.streaming = False
         self.device_connected = False
         self.recording = False
-        self.ECG_data = []
-        self.PPG_data1 = []
-        self.PPG_data2 = []
-        self.PPG_data3 = []
-        self.PPG_data1_filtered = []
-        self.PPG_data2_filtered = []
-        self.PPG_data3_filtered = []
-        self.PPG_ambient = []
-        self.PPG_data_save = []
+        # Live signal windows for plotting and analysis
+        self.ECG_data = RingBuffer(1200)
+        # R-peaks of the raw ECG, the detector is built at the negotiated ECG sample rate on the first packet
+        self.qrs = None
+        self.PPG_data = RingBuffer(1200, channels=3)
         self.HR_data = []
-        self.IBI_data = []
-        self.ECG_data_save = []
+        # RMSSD, SDNN, pNN50 and mean HR of the last 5 minutes of inter-beat intervals
+        self.hrv = HRVEngine(window_s=300)
+        # Streams the recorded data of every stream to disk from a writer thread
+        self.recorder = Recorder(label="gui")
         self.respiratory_rate = []
-        self.acc_x = []
-        self.acc_y = []
-        self.acc_z = []
-        self.ACC_calc = np.array(0)
+        self.acc_data = RingBuffer(4200, channels=3)
+        # Built at the negotiated accelerometer sample rate on its first packet
+        self.respiration = None
         self.battery_level = 100
         self.update_index = 0
         super().__init__()
         self.resize(800, 400)
-        self.pixmap_H10 = QPixmap('Images/H10_icon.png')
-        self.pixmap_OH1 = QPixmap('Images/OH1_icon.png')
-        self.pixmap_Rec = QPixmap('Images/Rec.png')
-        self.pixmap_battery = QPixmap('Images/battery_icon.png')
-        self.realtimeFilter1 = liveFilter(4, [0.1,20], 135, "bandpass", "butter")
-        self.realtimeFilter2 = liveFilter(4, [0.1,20], 135, "bandpass", "butter")
-        self.realtimeFilter3 = liveFilter(4, [0.1,20], 135, "bandpass", "butter")
+        self.pixmap_H10 = QPixmap(str(IMAGE_DIRECTORY / 'H10_icon.png'))
+        self.pixmap_OH1 = QPixmap(str(IMAGE_DIRECTORY / 'OH1_icon.png'))
+        self.pixmap_Rec = QPixmap(str(IMAGE_DIRECTORY / 'Rec.png'))
+        self.pixmap_battery = QPixmap(str(IMAGE_DIRECTORY / 'battery_icon.png'))
+        # One filter bank per stream, filtering every channel of a packet in a single call,
+        # built at the negotiated sample rate of the stream on its first packet
+        self.realtimeFilter_PPG = None
 
-        self.realtimeFilter_ECG = liveFilter(4, [0.1, 20], 130, "bandpass", "butter")
+        self.realtimeFilter_ECG = None
 
 
         self._client = None
 
         self.setWindowTitle("PoloPy")
-        self.setWindowIcon(QtGui.QIcon('Images/polopylogo.ico'))
+        self.setWindowIcon(QtGui.QIcon(str(IMAGE_DIRECTORY / 'polopylogo.ico')))
         scan_button = QPushButton("Scan Devices")
         scan_button.setFixedWidth(300)
         self.devices_combobox = QComboBox()
@@ -187,8 +189,15 @@ class MainWindow(QMainWindow):
         self.connect_button.clicked.connect(self.handle_connect)
         self.record_button.clicked.connect(self.Handle_recording)
 
+        # Data handlers only mark the plots dirty, the timer redraws them at most PLOT_FPS times per second
+        self.render_scheduler = RenderScheduler(PLOT_FPS)
+        self.render_scheduler.register("ECG", lambda: self.update_plot(self.ECG_data.view(0), type="ECG"))
+        self.render_scheduler.register("PPG", lambda: self.update_plot(
+            [self.PPG_data.view(0), self.PPG_data.view(1), self.PPG_data.view(2)], type="PPG"))
+
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.showTime)
+        self.timer.timeout.connect(self.render_scheduler.tick)
         self.timer.start(10)
         self.timer_count = 0
 
@@ -214,14 +223,27 @@ class MainWindow(QMainWindow):
             await self._client.stop()
         # Connect the updates on the bleak client with the GUI
         # These are the loops for processing the incoming data from the sensor for processing
-        self._client = BleakClient.QBleakClient(device)
+        self._client = QBleakClient(device)
+        self.qrs = None
+        self.realtimeFilter_ECG = None
+        self.realtimeFilter_PPG = None
+        self.respiration = None
+        if CAPTURE_DIRECTORY:
+            # Log all raw notifications of the session for replaying them later with capture.ReplaySource
+            name = device.name.replace(" ", "_") + "_" + datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S") + ".cap"
+            self._client.start_capture(Path(CAPTURE_DIRECTORY) / name)
         self._client.ecg_updated.connect(self.on_ecg_updated)
         self._client.ppg_updated.connect(self.on_ppg_updated)
         self._client.acc_updated.connect(self.on_acc_updated)
         self._client.HR_updated.connect(self.on_HR_updated)
-        self._client.PPI_updated.connect(self.on_HR_updated)
+        self._client.PPI_updated.connect(self.on_PPI_updated)
 
         self._client.Battery_level_read.connect(self.battery_level_updated)
+        self._client.disconnected.connect(self.on_disconnected)
+        self._client.data_gap.connect(self.on_data_gap)
+        self.supervisor = ReconnectSupervisor(self._client)
+        self.supervisor.gap.connect(self.on_gap)
+        self.supervisor.gave_up.connect(self.on_reconnect_failed)
 
         await self._client.start()
         if "H10" in device.name:
@@ -234,17 +256,41 @@ class MainWindow(QMainWindow):
             await self._client.start_ACC_OH1()
             await self._client.start_PPI()
 
+        # The battery level is read while the streams start, it is shown once the connection is set up
+        await self._client.battery_task
+
+    def on_disconnected(self, expected):
+        if not expected and self.device_connected:
+            # The supervisor reconnects and restarts the streams, the recording goes on
+            self.log_edit.appendPlainText("Connection to the device was lost, reconnecting...")
+
+    def on_gap(self, start_ns, end_ns):
+        self.log_edit.appendPlainText("Reconnected after {:.1f} s".format((end_ns - start_ns) / 1e9))
+        if self.recording == True:
+            self.record(self.recorder.gap, start_ns, end_ns)
+
+    def on_data_gap(self, start_ns, end_ns, measurement_type, missing_samples):
+        # Notifications were lost, e.g. because of radio interference or an overloaded host
+        names = {0: "ECG", 1: "PPG", 2: "ACC"}
+        self.log_edit.appendPlainText("{} samples of {} lost".format(missing_samples, names.get(measurement_type, measurement_type)))
+        if self.recording == True:
+            self.record(self.recorder.gap, start_ns, end_ns, measurement_type, missing_samples)
+
+    def on_reconnect_failed(self):
+        if self.device_connected:
+            # Save the recording and reset the UI as if Disconnect was pressed
+            self.handle_connect()
+            self.log_edit.appendPlainText("Could not reconnect to the device")
+
     @qasync.asyncSlot()
     async def handle_connect(self):
         if self.device_connected == False:
-            self.ECG_data_save = []
-            self.PPG_data_save = []
             self.log_edit.appendPlainText("Connecting...")
             device = self.devices_combobox.currentData()
 
 
 
-            if isinstance(device, BLEDevice):
+            if device is not None:
                 await self.build_client(device)
                 self.device_connected = True
                 self.connect_button.setText("Disconnect")
@@ -293,9 +339,6 @@ class MainWindow(QMainWindow):
             self.device_connected = False
             self.streaming = False
             self.filter_checkbox.setEnabled(False)
-            self.ECG_data_save = []
-
-            self.PPG_data_save = []
             self.Rec_icon.setVisible(False)
             self.record_button.setEnabled(False)
             self.recording = False
@@ -315,7 +358,7 @@ class MainWindow(QMainWindow):
 
         self.log_edit.appendPlainText("Scanning for Polar devices...")
         self.devices.clear()
-        devices = await BleakScanner.discover()
+        devices = await transport.discover()
         self.devices.extend(devices)
         self.devices_combobox.clear()
         Polar_amount = 0
@@ -337,8 +380,7 @@ class MainWindow(QMainWindow):
     def Handle_recording(self):
         if self.recording == False:
             self.recording = True
-            self.ECG_data_save = []
-            self.PPG_data_save = []
+            self.recorder.start(info=self._client.device_info, sample_rates=self._client.stream_sample_rates)
             self.record_button.setText("Stop Recording")
             self.Rec_icon.setVisible(True)
             self.timer_text.setVisible(True)
@@ -355,175 +397,168 @@ class MainWindow(QMainWindow):
             self.timer_count += 1
             self.timer_text.setText(str(self.timer_count//6000) +"." + str((self.timer_count%6000)/100))
     def Save_data(self):
-        # when recording is stopped, save ECG, PPG, ACC, HR and other measurements here
-        print("Saving data")
-
-        if len(self.PPG_data_save) != 0:
-            PPG_data_to_save = np.array(self.PPG_data_save)
-            df = pd.DataFrame(PPG_data_to_save)
-            now = datetime.datetime.now()
-            file = Path("measurements/PPG/" + now.strftime("%d-%m-%Y_%H-%M-%S") + "_PPG.csv")
-            self.log_edit.appendPlainText("Recording saved to file: measurements/PPG/" + now.strftime("%d-%m-%Y_%H-%M-%S") + "_PPG.csv" )
-            file.parent.mkdir(parents=True, exist_ok=True)
-            df.to_csv(file, header=["PPG_CH1", "PPG_CH2","PPG_CH3", "Ambient"], index=False)
-
-
-        if len(self.ECG_data_save) != 0:
-            ECG_data_to_save = np.array(self.ECG_data_save)
-            df = pd.DataFrame(ECG_data_to_save)
-            now = datetime.datetime.now()
-            file = Path("measurements/ECG/" + now.strftime("%d-%m-%Y_%H-%M-%S") + "_ECG.csv")
-            self.log_edit.appendPlainText("Recording saved to file: measurements/ECG/" + now.strftime("%d-%m-%Y_%H-%M-%S") + "_ECG.csv")
-            file.parent.mkdir(parents=True, exist_ok=True)
-            df.to_csv(file, header=["ECG"], index=False)
+        # The recorder has written the data while recording, stopping it only flushes the last chunks
+        log.info("Saving data")
+        try:
+            files = self.recorder.stop()
+        except Exception as error:
+            log.error("Recording failed: %r", error)
+            self.log_edit.appendPlainText("Recording failed: {!r}".format(error))
+            return
+        for file in files:
+            self.log_edit.appendPlainText("Recording saved to file: " + file.as_posix())
+
+    def record(self, write, *args):
+        # A failed recording (e.g. disk full) is stopped, instead of raising in every data handler
+        try:
+            write(*args)
+        except Exception:
+            if self.recording:
+                self.Handle_recording()
 
     def on_ecg_updated(self, output):
-        if len(self.ECG_data_save) == 0 and self.streaming == False and self.device_connected == True:
+        """
+        output.timestamp = sensor timestamp of the last sample in the packet (ns)
+        output.samples = ECG samples of the packet
+        output.times = epoch time of every sample (ns)
+        """
+        samples = output.samples
+        if self.streaming == False and self.device_connected == True:
             self.streaming = True
             self.log_edit.appendPlainText("Streaming")
             self.filter_checkbox.setEnabled(True)
             self.record_button.setEnabled(True)
         if self.recording == True:
-            self.ECG_data_save.append(output)
+            self.record(self.recorder.write, "ECG", samples, output.times[-1])
 
+        if self.realtimeFilter_ECG is None:
+            self.realtimeFilter_ECG = FilterBank(4, [0.1, 20], self._client.stream_sample_rates["ECG"], "bandpass", "butter")
         if self.filter_checkbox.isChecked():
-            self.ECG_data.append(self.realtimeFilter_ECG.process(output))
+            self.ECG_data.write(self.realtimeFilter_ECG.process(samples))
         else:
-            self.ECG_data.append(output)
+            self.ECG_data.write(samples)
 
-        if len(self.ECG_data) >= 1200:
-            self.ECG_data = self.ECG_data[-1200:]
         """
         Some real time actions on the ECG can be performed here
         """
-
-        self.update_plot(self.ECG_data, type="ECG")
+        # R-peak times (epoch ns) and beat-to-beat HR of the packet
+        if self.qrs is None:
+            self.qrs = QRSDetector(self._client.stream_sample_rates["ECG"])
+        beats = self.qrs.process(samples, output.times)
+        if len(beats.times):
+            log.debug("R-peaks: %s, HR: %s", beats.times, np.round(beats.hr, 1))
+            # HR and HRV from the R-peaks, timed more precisely than the RR intervals of the HR notifications
+            self.hrv.extend(beats.rr[~np.isnan(beats.rr)])
+            self.text_label_HR.setText("Heart rate: " + str(np.round(beats.hr[-1], 1)) + " BPM")
+            self.text_label_HRV.setText("RMSSD: " + str(np.round(self.hrv.rmssd, 1)) + " ms")
+
+        self.render_scheduler.mark_dirty("ECG")
     def on_ppg_updated(self, output):
         """
-        output[0] = PPG1
-        output[1] = PPG2
-        output[3] = PPG3
-        output[4] = Ambient
+        output.timestamp = sensor timestamp of the last sample in the packet (ns)
+        output.samples[:, 0] = PPG1
+        output.samples[:, 1] = PPG2
+        output.samples[:, 2] = PPG3
+        output.samples[:, 3] = Ambient
+        output.times = epoch time of every sample (ns)
         """
+        samples = output.samples
 
-        if len(self.PPG_data_save) == 0 and self.streaming == False and self.device_connected == True:
+        if self.streaming == False and self.device_connected == True:
             self.streaming = True
             self.log_edit.appendPlainText("Streaming")
             self.record_button.setEnabled(True)
             self.filter_checkbox.setEnabled(True)
 
         if self.recording == True:
-            self.PPG_data_save.append(output)
+            self.record(self.recorder.write, "PPG", samples, output.times[-1])
 
 
+        if self.realtimeFilter_PPG is None:
+            self.realtimeFilter_PPG = FilterBank(4, [0.1, 20], self._client.stream_sample_rates["PPG"], "bandpass", "butter",
+                                                 channels=3)
         if self.filter_checkbox.isChecked():
-            self.PPG_data1.append(self.realtimeFilter1.process(output[0]))
-            self.PPG_data2.append(self.realtimeFilter2.process(output[1]))
-            self.PPG_data3.append(self.realtimeFilter3.process(output[2]))
+            self.PPG_data.write(self.realtimeFilter_PPG.process(samples[:, :3]))
         else:
-            self.PPG_data1.append(output[0])
-            self.PPG_data2.append(output[1])
-            self.PPG_data3.append(output[2])
-
-        #self.PPG_data1_filtered.append(self.realtimeFilter1.process(output[0]))
-        #self.PPG_data2_filtered.append(self.realtimeFilter2.process(output[1]))
-        #self.PPG_data3_filtered.append(self.realtimeFilter3.process(output[2]))
-
-
+            self.PPG_data.write(samples[:, :3])
 
-        if len(self.PPG_data1) >= 1200:
-            self.PPG_data1 = self.PPG_data1[-1200:]
-            self.PPG_data2 = self.PPG_data2[-1200:]
-            self.PPG_data3 = self.PPG_data3[-1200:]
-            self.PPG_data1_filtered = self.PPG_data1_filtered[-1200:]
-            self.PPG_data2_filtered = self.PPG_data2_filtered[-1200:]
-            self.PPG_data3_filtered = self.PPG_data3_filtered[-1200:]
         """
         Some real time actions on the PPG can be performed here
         """
 
-        self.update_plot([self.PPG_data1, self.PPG_data2, self.PPG_data3], type="PPG")
+        self.render_scheduler.mark_dirty("PPG")
     def on_acc_updated(self, output):
-        # Accelerometer packet received
-        for reading in output:
-            self.acc_x.append(reading[0])
-            self.acc_y.append(reading[1])
-            self.acc_z.append(reading[2])
-
-            """
-            Some Real time actions on the ACC can be performed here (Like the breathing calculation below)
-            """
-        if len(self.acc_z) >= 4200:
-            self.acc_z = self.acc_z[-4200:]
-            self.ACC_calc = np.array(self.acc_z) - np.mean(self.acc_z)
-            padding = 15000
-            hamm1 = np.hamming(len(self.acc_z))
-            freq_axis = np.arange(0, 100, 100 / (padding / 2))
-            #freq_axis = np.arange(0, 100, 100 / 2200)
-            Frequencies = np.abs(fft(self.ACC_calc*hamm1, n = padding))
-            Frequencies = Frequencies[0:len(Frequencies) // 2]
-            Frequencies = Frequencies / np.max(Frequencies)
-            resp = freq_axis[np.argmax(Frequencies)] * 60
+        # Accelerometer packet received, output.samples is an (n_samples, 3) array of x, y and z
+        self.acc_data.write(output.samples)
+        if self.recording == True:
+            self.record(self.recorder.write, "ACC", output.samples, output.times[-1])
+
+        """
+        Some Real time actions on the ACC can be performed here (Like the breathing calculation below)
+        """
+        # The estimator decimates the z-axis and evaluates only the breathing band once every hop
+        if self.respiration is None:
+            self.respiration = RespirationEstimator(fs=self._client.stream_sample_rates["ACC"], window_s=21, hop_s=1)
+        resp = self.respiration.update(output.samples[:, 2])
+        if resp is not None:
             self.respiratory_rate.append(resp)
             self.text_label_resp.setText("Respiratory rate: " + str(np.round(resp, 1)) + " BPM")
-            print("Respiration:", resp,"|", np.argmax(Frequencies),"|", freq_axis[np.argmax(Frequencies)])
+            log.debug("Respiration: %s", resp)
 
 
     def on_HR_updated(self, output):
         # output[0] = Polar HR
         # output[1] = IBI list
 
+        log.debug("HR: %s", output[0])
+        if self.recording == True and len(output[1]) != 0:
+            self.record(self.recorder.write, "HR", np.column_stack([np.full(len(output[1]), output[0]), output[1]]))
+        if self.qrs is not None:
+            # The ECG is streaming, HR and HRV come from its R-peaks (on_ecg_updated)
+            return
+
         # Here the HR estimate from the device is displayed in the GUI
         self.text_label_HR.setText("Heart rate: " + str(np.average(output[0])) + " BPM")
-        print("HR:", output[0])
 
         # Alternatively the HR can be calculated from the IBI values
         """
-        self.IBI_data.append(output[0])
-        
-        if len(self.IBI_data)> 10:
-            HR = (1/(np.average(self.IBI_data[-9:])/1000))*60
-            self.text_label_HR.setText("Heart rate: " + str(np.round(output, 1)) + " BPM")
-
-            self.HR_data.append(HR)
-            print("HR:", HR)
-            #self.update_plot()
+        self.text_label_HR.setText("Heart rate: " + str(np.round(self.hrv.mean_hr, 1)) + " BPM")
         """
 
-        # HRV calculation
-        for reading in output[1]:
-            self.IBI_data.append(reading)
-
+        # HRV calculation over the window of the HRV engine
+        self.hrv.extend(output[1])
 
-        RMSSD = np.round(np.sqrt(np.mean(np.square(np.diff(self.IBI_data)))),1)
+        RMSSD = np.round(self.hrv.rmssd, 1)
 
         self.text_label_HRV.setText("RMSSD: " + str(RMSSD) + " ms")
-        print("RMSSD:", RMSSD, "ms")
+        log.debug("RMSSD: %s ms", RMSSD)
     def on_PPI_updated(self, output):
         """
         output[0] = HR
         output[1] = PPI
         output[2] = Error estimates
+        output[3] = epoch time at the end of every PPI (ns)
         """
-        print(output[0])
-        print(output[1])
+        log.debug("PPI HR: %s, PPI: %s", output[0], output[1])
+        self.text_label_HR.setText("Heart rate: " + str(np.average(output[0])) + " BPM")
+        if self.recording == True and len(output[1]) != 0:
+            self.record(self.recorder.write, "PPI", np.column_stack(output[:3]), output[3][-1])
 
-        # PRV calculation
+        # PRV calculation, the PPI values are weighted by their error estimates
         # Please note accuracy not same as on HRV
-        for reading in output[1]:
-            self.IBI_data.append(reading)
+        self.hrv.extend(output[1], output[2])
 
-        RMSSD = np.round(np.sqrt(np.mean(np.square(np.diff(self.IBI_data)))), 1)
+        RMSSD = np.round(self.hrv.rmssd, 1)
 
         self.text_label_HRV.setText("RMSSD: " + str(RMSSD) + " ms")
-        print("RMSSD:", RMSSD, "ms")
+        log.debug("RMSSD: %s ms", RMSSD)
 
 
     def update_plot(self, data_to_display, type):
         if type == "ECG":
             self.line.setData(y=data_to_display)
             # In case of starting ECG after PPG measurement, clean the PPG graph
-            if len(self.PPG_data1) != 0:
+            if len(self.PPG_data) != 0:
                 self.line_PPG1.setData(y=[])
                 self.line_PPG2.setData(y=[])
                 self.line_PPG3.setData(y=[])
@@ -537,6 +572,12 @@ class MainWindow(QMainWindow):
                 self.line.setData(y=[])
 
 def main():
+    logging.basicConfig(level=os.environ.get("POLOPY_LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if METRICS_FILE:
+        REGISTRY.start_dump(METRICS_FILE)
+    if METRICS_PORT:
+        REGISTRY.serve_http(int(METRICS_PORT))
     app = QApplication(sys.argv)
     loop = qasync.QEventLoop(app)
     asyncio.set_event_loop(loop)
@@ -0,0 +1,127 @@
+"""
+Offline analysis of recordings: the live filters, HRV and respiration algorithms applied to whole arrays.
+
+A recording is a CSV file of one stream written by the recorder
+(measurements/<STREAM>/<name>_<STREAM>.csv) or a binary session directory
+(<name>.polo, see session_format). analyze_recording() returns one summary
+row per stream of the recording.
+"""
+from pathlib import Path
+
+import numpy as np
+
+import decoders
+from filters import FilterBank
+from hrv import hrv_summary
+from qrs import QRSDetector
+from recorder import STREAMS
+from respiration import RespirationEstimator
+from session_format import SESSION_SUFFIX, SessionReader
+
+
+# Sample rates (Hz) of the CSV recordings, which do not store them, and of sessions without a rate in the header;
+# sessions are analysed at the negotiated rates stored in their header
+SAMPLE_RATES = {"ECG": 130, "PPG": 130, "ACC": 200}
+
+# Band (Hz) of the 4th order Butterworth filter of the GUI plots
+FILTER_BAND = (0.1, 20)
+
+# Measurement type of the streams in the GAP rows of a session
+GAP_STREAMS = {"ECG": decoders.ECG, "PPG": decoders.PPG, "ACC": decoders.ACC, "PPI": decoders.PPI}
+
+# Columns of the summary table, in order
+COLUMNS = ["file", "stream", "samples", "duration_s", "signal_std", "respiration_rate", "respiration_rate_iqr",
+           "mean_hr", "beats", "rejected", "mean_ibi", "sdnn", "rmssd", "pnn50", "gaps", "lost_samples",
+           "dropouts", "dropout_s"]
+
+
+def stream_of_csv(path, header):
+    """
+    Stream of a recorder CSV file from its header, or from its name when the header is ambiguous.
+    """
+    matches = [stream for stream, (columns, _) in STREAMS.items() if columns == header]
+    if len(matches) == 1:
+        return matches[0]
+    for stream in STREAMS:
+        if Path(path).stem.upper().endswith("_" + stream):
+            return stream
+    raise ValueError("{}: unknown stream with columns {}".format(path, header))
+
+
+def read_csv(path):
+    """
+    (stream, (rows, columns) array) of a recorder CSV file.
+    """
+    with open(path) as file:
+        header = file.readline().strip().split(",")
+    stream = stream_of_csv(path, header)
+    return stream, np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2, dtype=np.float64)
+
+
+def analyze_stream(stream, data, sample_rate=None, times=None):
+    """
+    Summary of the samples of one stream, data = (rows, columns) array.
+
+    times = epoch time (ns) of every row, used for the R-peaks of the ECG, which
+    are otherwise timed from the sample rate
+    """
+    fs = sample_rate or SAMPLE_RATES.get(stream)
+    row = {"stream": stream, "samples": len(data)}
+    if stream in ("ECG", "PPG"):
+        # Ambient light (4th PPG column) is not filtered, as in the GUI
+        signal = np.asarray(data[:, :1] if stream == "ECG" else data[:, :3], dtype=np.float64)
+        row["duration_s"] = len(data) / fs
+        if len(signal):
+            filtered = FilterBank(4, FILTER_BAND, fs, channels=signal.shape[1]).process(signal)
+            row["signal_std"] = float(filtered.std(axis=0).mean())
+        if stream == "ECG":
+            # Heart rate and HRV from the R-peaks, the whole recording in a single block
+            beats = QRSDetector(fs).process(signal[:, 0], times)
+            row.update(hrv_summary(beats.rr[1:]))
+    elif stream == "ACC":
+        row["duration_s"] = len(data) / fs
+        # Breathing moves the chest along the z-axis
+        rates = RespirationEstimator(fs=fs).estimate_all(data[:, 2])
+        if len(rates):
+            q1, median, q3 = np.percentile(rates, [25, 50, 75])
+            row["respiration_rate"] = float(median)
+            row["respiration_rate_iqr"] = float(q3 - q1)
+    elif stream in ("HR", "PPI"):
+        ibis = data[:, 1]
+        row["duration_s"] = float(ibis.sum() / 1000)
+        row.update(hrv_summary(ibis, data[:, 2] if stream == "PPI" else None))
+    return row
+
+
+def analyze_recording(path, sample_rates=None):
+    """
+    Summary rows of a CSV file or a .polo session, one per stream.
+
+    sample_rates = {stream: Hz} overriding SAMPLE_RATES for CSV files
+    """
+    path = Path(path)
+    rates = dict(SAMPLE_RATES, **(sample_rates or {}))
+    if path.suffix == SESSION_SUFFIX:
+        reader = SessionReader(path)
+        gaps = reader.gaps
+        # Lost connections (stream -1), the samples lost meanwhile are in the rows of the streams
+        dropouts = gaps[gaps[:, 2] == -1]
+        rows = []
+        for stream in reader.streams:
+            if stream == "GAP":
+                continue
+            times = reader.timestamps(stream) if stream == "ECG" else None
+            row = analyze_stream(stream, reader.data(stream), reader.sample_rate(stream) or rates.get(stream), times)
+            if stream in GAP_STREAMS:
+                lost = gaps[gaps[:, 2] == GAP_STREAMS[stream]]
+                row["gaps"] = len(lost)
+                row["lost_samples"] = int(lost[:, 3].sum())
+            row["dropouts"] = len(dropouts)
+            row["dropout_s"] = float((dropouts[:, 1] - dropouts[:, 0]).sum() / 1e9)
+            rows.append(row)
+    else:
+        stream, data = read_csv(path)
+        rows = [analyze_stream(stream, data, rates.get(stream))]
+    for row in rows:
+        row["file"] = str(path)
+    return rows
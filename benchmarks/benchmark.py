@@ -0,0 +1,291 @@
+"""
+Micro-benchmarks of the packet decoders and the per-packet signal processing.
+
+Every case feeds synthetic but protocol-correct packets (built with the
+encoders of simulator.py) to the same code the GUI runs, and reports
+
+packets/s, samples/s and the bytes allocated per packet (traced with tracemalloc)
+
+Usage:
+    python benchmarks/benchmark.py                 run all cases and compare to the baseline
+    python benchmarks/benchmark.py --save          run and store the results as the new baseline
+    python benchmarks/benchmark.py -k ecg acc      run only the cases whose name contains "ecg" or "acc"
+
+The exit status is 1 when a case is slower than the baseline by more than
+--threshold (default 25 %), so the script can be used as a regression gate.
+Baselines are machine specific: save one before making changes and compare
+against it on the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import decoders  # noqa: E402
+import simulator  # noqa: E402
+from BleakClient import PolarClient  # noqa: E402
+from filters import FilterBank  # noqa: E402
+from qrs import QRSDetector  # noqa: E402
+from respiration import RespirationEstimator  # noqa: E402
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+PACKETS = 512  # distinct packets generated for every case
+
+
+# Packet generation
+
+def _timestamps(n_packets, samples_per_packet, fs):
+    step = int(1e9 * samples_per_packet / fs)
+    return [simulator.POLAR_EPOCH_OFFSET_NS + 10**9 + i * step for i in range(n_packets)]
+
+
+def _ecg_samples(rng, n):
+    return (rng.normal(0, 200, n).cumsum() % 3000 - 1500).astype(np.int32)
+
+
+def ecg_packets(rng, delta=False):
+    n = simulator.SAMPLES_PER_PACKET[decoders.ECG]
+    packets = []
+    for ts in _timestamps(PACKETS, n, 130):
+        samples = _ecg_samples(rng, n)
+        if delta:
+            packets.append(simulator.delta_packet(decoders.ECG, ts, samples, 14))
+        else:
+            packets.append(simulator.ecg_packet(ts, samples))
+    return packets, n
+
+
+def ppg_packets(rng, delta=False):
+    n = simulator.SAMPLES_PER_PACKET[decoders.PPG]
+    packets = []
+    for ts in _timestamps(PACKETS, n, 135):
+        samples = (200000 + rng.normal(0, 500, (n, 4)).cumsum(axis=0)).astype(np.int32)
+        if delta:
+            packets.append(simulator.delta_packet(decoders.PPG, ts, samples, 22))
+        else:
+            packets.append(simulator.ppg_packet(ts, samples))
+    return packets, n
+
+
+def acc_packets(rng, frame_type=0x01):
+    n = simulator.SAMPLES_PER_PACKET[decoders.ACC]
+    limit = {0x00: 127, 0x01: 8000, 0x02: 8000}.get(frame_type, 8000)
+    packets = []
+    for ts in _timestamps(PACKETS, n, 200):
+        samples = np.clip(rng.normal(0, 30, (n, 3)).cumsum(axis=0), -limit, limit).astype(np.int32)
+        if frame_type & decoders.DELTA_FRAME:
+            packets.append(simulator.delta_packet(decoders.ACC, ts, samples, 16))
+        else:
+            packets.append(simulator.acc_packet(ts, samples, frame_type))
+    return packets, n
+
+
+def hr_packets(rng):
+    packets = []
+    for _ in range(PACKETS):
+        rr = rng.integers(600, 1100, rng.integers(1, 3))
+        packets.append(simulator.hr_packet(int(rng.integers(50, 120)), [int(r) for r in rr]))
+    return packets, 1
+
+
+def ppi_packets(rng):
+    n = 6
+    packets = []
+    for ts in _timestamps(PACKETS, n, 1):
+        ppis = rng.integers(600, 1100, n)
+        packets.append(simulator.ppi_packet(ts, (60000 // ppis).tolist(), ppis.tolist(), rng.integers(5, 30, n).tolist()))
+    return packets, n
+
+
+# Cases: name -> setup() returning (function called once per packet, packets, samples per packet,
+# function called before every pass over the packets or None)
+
+def _client():
+    client = PolarClient(None)
+    sink = []
+    for signal in (client.ecg_updated, client.ppg_updated, client.acc_updated, client.HR_updated, client.PPI_updated):
+        signal.connect(lambda value: sink.append(value) if len(sink) < 1 else None)
+    return client
+
+
+def _decoder_case(method, packets):
+    def setup(rng):
+        client = _client()
+        data, n = packets(rng)
+
+        def reset():
+            # Every pass replays the same timestamps, which the continuity check would drop as duplicates
+            client.continuity.clear()
+            client.clock.reset()
+        return getattr(client, method), [(None, packet) for packet in data], n, reset
+    return setup
+
+
+def _filter_case(fs, channels, samples_per_packet):
+    def setup(rng):
+        bank = FilterBank(4, [0.1, 20], fs, "bandpass", "butter", channels=channels)
+        shape = (samples_per_packet, channels) if channels > 1 else (samples_per_packet,)
+        blocks = [(rng.normal(0, 1000, shape),) for _ in range(PACKETS)]
+        return bank.process, blocks, samples_per_packet, None
+    return setup
+
+
+def _respiration_case(rng):
+    estimator = RespirationEstimator(fs=200, window_s=21, hop_s=1)
+    n = simulator.SAMPLES_PER_PACKET[decoders.ACC]
+    t = np.arange(PACKETS * n) / 200
+    z = 1000 + 20 * np.sin(2 * np.pi * 0.25 * t) + rng.normal(0, 2, len(t))
+    blocks = [(z[i * n:(i + 1) * n],) for i in range(PACKETS)]
+    return estimator.update, blocks, n, None
+
+
+def _qrs_case(rng):
+    detector = QRSDetector(fs=130)
+    n = simulator.SAMPLES_PER_PACKET[decoders.ECG]
+    t = np.arange(PACKETS * n) / 130
+    beats = np.arange(0.4, t[-1] + 1, 0.8)
+    i = np.clip(np.searchsorted(beats, t), 1, len(beats) - 1)
+    d = np.where(np.abs(t - beats[i - 1]) < np.abs(t - beats[i]), t - beats[i - 1], t - beats[i])
+    ecg = simulator.ecg_waveform(d) + rng.normal(0, 20, len(t))
+    blocks = [(ecg[i * n:(i + 1) * n],) for i in range(PACKETS)]
+    return detector.process, blocks, n, None
+
+
+CASES = {
+    "ecg_data_conv/raw": _decoder_case("ecg_data_conv", ecg_packets),
+    "ecg_data_conv/delta": _decoder_case("ecg_data_conv", lambda rng: ecg_packets(rng, delta=True)),
+    "ppg_data_conv/raw": _decoder_case("ppg_data_conv", ppg_packets),
+    "ppg_data_conv/delta": _decoder_case("ppg_data_conv", lambda rng: ppg_packets(rng, delta=True)),
+    "acc_data_conv/8bit": _decoder_case("acc_data_conv", lambda rng: acc_packets(rng, 0x00)),
+    "acc_data_conv/16bit": _decoder_case("acc_data_conv", lambda rng: acc_packets(rng, 0x01)),
+    "acc_data_conv/24bit": _decoder_case("acc_data_conv", lambda rng: acc_packets(rng, 0x02)),
+    "acc_data_conv/delta": _decoder_case("acc_data_conv", lambda rng: acc_packets(rng, decoders.DELTA_FRAME)),
+    "hr_data_conv": _decoder_case("hr_data_conv", hr_packets),
+    "PPI_data_conv": _decoder_case("PPI_data_conv", ppi_packets),
+    "FilterBank.process/ecg": _filter_case(130, 1, simulator.SAMPLES_PER_PACKET[decoders.ECG]),
+    "FilterBank.process/ppg": _filter_case(135, 3, simulator.SAMPLES_PER_PACKET[decoders.PPG]),
+    "RespirationEstimator.update": _respiration_case,
+    "QRSDetector.process": _qrs_case,
+}
+
+
+# Measurement
+
+def measure(fn, args, min_time=0.2, repeats=5, reset=None):
+    """
+    Best packets/s over `repeats` runs, each looping over the packets for at least `min_time` seconds.
+
+    reset = called before every pass over the packets
+    """
+    best = 0.0
+    for _ in range(repeats):
+        count = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time:
+            if reset is not None:
+                reset()
+            for arg in args:
+                fn(*arg)
+            count += len(args)
+            elapsed = time.perf_counter() - start
+        best = max(best, count / elapsed)
+    return best
+
+
+def allocated_per_packet(fn, args, reset=None):
+    """
+    Mean peak of the memory traced while processing one packet, in bytes.
+    """
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    try:
+        total = 0
+        for arg in args:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(*arg)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / len(args)
+
+
+def run(names, min_time):
+    results = {}
+    for name in names:
+        rng = np.random.default_rng(0)
+        fn, args, samples_per_packet, reset = CASES[name](rng)
+        measure(fn, args, min_time=0.02, repeats=1, reset=reset)  # warm up
+        packets_per_s = measure(fn, args, min_time=min_time, reset=reset)
+        results[name] = {
+            "packets_per_s": packets_per_s,
+            "samples_per_s": packets_per_s * samples_per_packet,
+            "alloc_bytes_per_packet": allocated_per_packet(fn, args, reset),
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the results next to the baseline. Returns the names of the regressed cases.
+    """
+    regressions = []
+    print("%-30s %14s %14s %12s %10s" % ("case", "packets/s", "samples/s", "bytes/packet", "vs base"))
+    for name, result in results.items():
+        base = baseline.get(name)
+        change = ""
+        if base:
+            ratio = result["packets_per_s"] / base["packets_per_s"]
+            change = "%+.1f %%" % (100 * (ratio - 1))
+            if ratio < 1 - threshold:
+                regressions.append(name)
+                change += " !"
+        print("%-30s %14.0f %14.0f %12.0f %10s" % (name, result["packets_per_s"], result["samples_per_s"],
+                                                   result["alloc_bytes_per_packet"], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PoloPy decoder and processing benchmarks")
+    parser.add_argument("-k", nargs="*", default=[], help="run only the cases containing one of these strings")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative throughput loss before failing (default 0.25)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement run")
+    args = parser.parse_args(argv)
+
+    names = [name for name in CASES if not args.k or any(k.lower() in name.lower() for k in args.k)]
+    results = run(names, args.min_time)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file).get("results", {})
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__,
+                       "machine": platform.machine(), "results": baseline}, file, indent=2)
+        print("Baseline saved to", args.baseline)
+        return 0
+    if regressions:
+        print("Throughput regressed by more than %d %%: %s" % (100 * args.threshold, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Import time budget of the headless logging path.
+
+Runs a fresh interpreter with -X importtime for each command below, and
+reports the cumulative import time of the modules the command loads.
+
+Usage:
+    python benchmarks/import_time.py                 check against the default budgets
+    python benchmarks/import_time.py --budget 0.5    scale all budgets by 0.5
+
+The exit status is 1 when an import goes over its budget or loads one of the
+GUI-only modules (Qt, SciPy, pandas, pyqtgraph).
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Statement: budget in ms (best of the runs)
+BUDGETS = {
+    # Only argparse & co, the CLI imports the rest after parsing the arguments
+    "import polopy_log": 50,
+    # Everything polopy-log needs to scan, connect and record
+    "import polopy_log, session_manager, transport": 400,
+}
+
+FORBIDDEN = ("PyQt5", "scipy", "pandas", "pyqtgraph")
+
+
+def import_time(statement):
+    """
+    Cumulative import time (ms) of the modules imported by `statement` and the set of their top-level names.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    baseline = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], cwd=ROOT,
+                              capture_output=True, text=True, check=True)
+    # Lines: "import time: self [us] | cumulative | imported package"
+    def parse(stderr):
+        modules = {}
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if not name.startswith("  "):
+                name = name.strip()
+                modules[name] = int(cumulative)
+            else:
+                modules.setdefault(name.strip(), 0)
+        return modules
+    modules = parse(result.stderr)
+    startup = parse(baseline.stderr)
+    total = sum(us for name, us in modules.items() if name not in startup)
+    return total / 1000, {name.split(".")[0] for name in modules}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import time budget of polopy-log")
+    parser.add_argument("--budget", type=float, default=1.0, help="scale factor of the budgets")
+    parser.add_argument("--runs", type=int, default=3, help="runs per statement, the best one is used")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for statement, budget in BUDGETS.items():
+        budget *= args.budget
+        runs = [import_time(statement) for _ in range(args.runs)]
+        best = min(ms for ms, _ in runs)
+        loaded = sorted(set(FORBIDDEN) & runs[0][1])
+        status = "ok"
+        if best > budget:
+            status = "OVER BUDGET"
+            failed = True
+        if loaded:
+            status = "loads " + ", ".join(loaded)
+            failed = True
+        print("%-50s %7.1f ms  (budget %4.0f ms)  %s" % (statement, best, budget, status))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
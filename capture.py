@@ -0,0 +1,168 @@
+"""
+Capture of the raw BLE traffic of a device and its replay through the decoders.
+
+A capture file starts with the magic bytes b"POLOCAP2" followed by records of
+
+    [kind (8), characteristic id (8), host epoch time in s (float64), length (16), bytes]
+
+kind is NOTIFICATION for notifications received from the device, WRITE for
+the commands written to it (e.g. the PMD start commands, which carry the
+settings needed to decode the data) and UUID for the definition of a
+characteristic id, whose bytes are the UUID of the characteristic.
+
+The host time of a notification is the time it was received, which the
+replay hands to the client so the clock synchronisation sees the recorded
+arrival times. Files of the first version (b"POLOCAP1") stored the host
+monotonic time instead, they are replayed with the arrival times of the replay.
+"""
+import asyncio
+import struct
+import time
+from pathlib import Path
+
+
+MAGIC = b"POLOCAP2"
+MONOTONIC_MAGIC = b"POLOCAP1"
+RECORD_HEADER = struct.Struct("<BBdH")
+
+NOTIFICATION = 0
+WRITE = 1
+UUID = 2
+
+
+class CaptureWriter:
+    """
+    Appends the notifications and writes of a device to a capture file.
+
+    timestamp = host epoch time (s) of a record, the time of the call when not given
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        new_file = not self.path.exists() or self.path.stat().st_size == 0
+        if not new_file:
+            with open(self.path, "rb") as file:
+                if file.read(len(MAGIC)) != MAGIC:
+                    raise ValueError("Cannot append to an older or foreign capture file: " + str(self.path))
+        self._file = open(self.path, "ab")
+        if new_file:
+            self._file.write(MAGIC)
+        # An appended file starts a new set of characteristic ids
+        self._ids = {}
+        self.records = 0
+
+    def _uuid_id(self, uuid):
+        uuid = uuid.lower()
+        uuid_id = self._ids.get(uuid)
+        if uuid_id is None:
+            uuid_id = self._ids[uuid] = len(self._ids)
+            self._write(UUID, uuid_id, uuid.encode("ascii"), time.time())
+        return uuid_id
+
+    def _write(self, kind, uuid_id, data, timestamp):
+        self._file.write(RECORD_HEADER.pack(kind, uuid_id, timestamp, len(data)))
+        self._file.write(data)
+        self.records += 1
+
+    def notification(self, uuid, data, timestamp=None):
+        self._write(NOTIFICATION, self._uuid_id(uuid), bytes(data), time.time() if timestamp is None else timestamp)
+
+    def write(self, uuid, data, timestamp=None):
+        self._write(WRITE, self._uuid_id(uuid), bytes(data), time.time() if timestamp is None else timestamp)
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """
+    Yield the (kind, uuid, host time, data) records of a capture file.
+
+    The host time is the epoch time in s, or the monotonic time in s in files of the first version.
+
+    The file is read into memory once and data is a memoryview into it, so
+    iterating over the records does not copy the packets.
+    """
+    buffer = memoryview(Path(path).read_bytes())
+    if bytes(buffer[:len(MAGIC)]) not in (MAGIC, MONOTONIC_MAGIC):
+        raise ValueError("Not a PoloPy capture file: " + str(path))
+    uuids = {}
+    offset = len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(buffer):
+        kind, uuid_id, timestamp, length = RECORD_HEADER.unpack_from(buffer, offset)
+        offset += RECORD_HEADER.size
+        data = buffer[offset:offset + length]
+        offset += length
+        if kind == UUID:
+            uuids[uuid_id] = bytes(data).decode("ascii")
+        else:
+            yield kind, uuids[uuid_id], timestamp, data
+
+
+def has_receive_times(path):
+    """
+    True when the host times of a capture file are epoch times, i.e. the times the notifications were received.
+    """
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+class ReplaySource:
+    """
+    Feeds a capture back through the decoders and signals of a client.
+
+    speed = 1.0 replays at the recorded pace, 2.0 twice as fast, None as fast as possible.
+    The client only needs handle_notification(uuid, sender, data, received_ns) and
+    handle_write(uuid, data), no device or BLE connection is used.
+
+    Notifications are handed over with the epoch time (ns) they were received
+    at when the capture was made, so the timestamps of the replayed samples are
+    those of the live session, whatever the speed of the replay.
+    """
+    def __init__(self, path, client, speed=1.0):
+        self.path = Path(path)
+        self.client = client
+        self.speed = speed
+        self.receive_times = has_receive_times(self.path)
+        self.packets = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def _feed(self, kind, uuid, timestamp, data):
+        if kind == WRITE:
+            self.client.handle_write(uuid, data)
+        else:
+            received_ns = int(round(timestamp * 1e9)) if self.receive_times else None
+            self.client.handle_notification(uuid, None, data, received_ns)
+            self.packets += 1
+            self.bytes += len(data)
+
+    def run_blocking(self):
+        """
+        Replay the whole capture as fast as possible. Returns the packets per second achieved.
+        """
+        records = list(read_capture(self.path))
+        start = time.perf_counter()
+        for kind, uuid, timestamp, data in records:
+            self._feed(kind, uuid, timestamp, data)
+        self.elapsed = time.perf_counter() - start
+        return self.packets / self.elapsed if self.elapsed > 0 else float("inf")
+
+    async def run(self):
+        """
+        Replay the capture in the asyncio event loop, at the recorded pace scaled by `speed`.
+        """
+        start = time.perf_counter()
+        first = None
+        for kind, uuid, timestamp, data in read_capture(self.path):
+            if self.speed:
+                if first is None:
+                    first = timestamp
+                delay = (timestamp - first) / self.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._feed(kind, uuid, timestamp, data)
+            if not self.speed and self.packets % 256 == 0:
+                # Let the other tasks of the event loop run now and then
+                await asyncio.sleep(0)
+        self.elapsed = time.perf_counter() - start
@@ -0,0 +1,131 @@
+"""
+Mapping of the sensor timestamps of a device to host epoch time.
+
+Every PMD packet carries the sensor timestamp of its last sample, and the host
+knows when the packet was received. The receive time is the true time plus a
+BLE delivery delay that is always positive and jitters by tens of milliseconds,
+so a plain least squares fit of host time against sensor time would be biased
+and noisy. ClockSync instead keeps the packet with the smallest delay of every
+segment (a few seconds) of sensor time, the lower envelope of the observations,
+and fits offset and drift to the last segment minima with running sums:
+
+    host_time = sensor_time + offset + drift * sensor_time
+"""
+from collections import deque
+
+import numpy as np
+
+
+class ClockSync:
+    """
+    Online estimate of the offset and drift between the clock of a device and the host clock.
+
+    segment_s = length of sensor time over which the least delayed packet is kept
+    segments = number of segment minima in the fit, segments * segment_s is the fit window
+    max_step_s = a sensor timestamp going backwards by more than this restarts the estimate (device reset)
+    """
+    def __init__(self, segment_s=5.0, segments=120, max_step_s=1.0):
+        self.segment_s = segment_s
+        self.max_step_s = max_step_s
+        self._points = deque(maxlen=segments)
+        self.reset()
+
+    def reset(self):
+        self._points.clear()
+        self._sensor0 = None
+        self._host0 = None
+        self._last_sensor = None
+        self._segment = None
+        self._segment_min = None
+        self._sums = np.zeros(5)  # n, sum x, sum r, sum xx, sum xr
+        self._offset = 0.0
+        self._drift = 0.0
+        self._last_timestamps = {}
+        self.observations = 0
+
+    @property
+    def synchronized(self):
+        return self._sensor0 is not None
+
+    @property
+    def offset_ns(self):
+        """
+        Host epoch time minus sensor time at the first observation, in ns.
+        """
+        if not self.synchronized:
+            return 0
+        return self._host0 - self._sensor0 + int(self._offset * 1e9)
+
+    @property
+    def drift_ppm(self):
+        return self._drift * 1e6
+
+    def observe(self, sensor_ns, host_ns):
+        """
+        Add a packet with the sensor timestamp `sensor_ns` received at host epoch time `host_ns`.
+        """
+        sensor_ns = int(sensor_ns)
+        if self._last_sensor is not None and sensor_ns < self._last_sensor - self.max_step_s * 1e9:
+            self.reset()
+        if self._sensor0 is None:
+            self._sensor0 = sensor_ns
+            self._host0 = int(host_ns)
+        self._last_sensor = max(sensor_ns, self._last_sensor or sensor_ns)
+        self.observations += 1
+
+        # Time since the first observation (s) and the residual delay of the packet (s)
+        x = (sensor_ns - self._sensor0) / 1e9
+        r = (int(host_ns) - self._host0) / 1e9 - x
+        segment = int(x // self.segment_s)
+        if segment != self._segment:
+            if self._segment_min is not None:
+                self._add_point(*self._segment_min)
+            self._segment = segment
+            self._segment_min = (x, r)
+        elif r < self._segment_min[1]:
+            self._segment_min = (x, r)
+        self._fit()
+
+    def _add_point(self, x, r):
+        if len(self._points) == self._points.maxlen:
+            old_x, old_r = self._points[0]
+            self._sums -= (1, old_x, old_r, old_x * old_x, old_x * old_r)
+        self._points.append((x, r))
+        self._sums += (1, x, r, x * x, x * r)
+
+    def _fit(self):
+        n, sx, sr, sxx, sxr = self._sums
+        current_x, current_r = self._segment_min
+        if n < 3:
+            # Not enough history for the drift, use the smallest delay seen so far
+            self._offset = min([current_r] + [r for _, r in self._points])
+            self._drift = 0.0
+            return
+        denominator = n * sxx - sx * sx
+        self._drift = (n * sxr - sx * sr) / denominator if denominator > 0 else 0.0
+        self._offset = (sr - self._drift * sx) / n
+        # A packet arriving earlier than the fitted line bounds the delay, move the line down to it
+        self._offset = min(self._offset, current_r - self._drift * current_x)
+
+    def to_epoch(self, sensor_ns):
+        """
+        Host epoch time (ns, int64) of the given sensor timestamps (scalar or array).
+        """
+        x = (np.asarray(sensor_ns, dtype=np.int64) - self._sensor0) / 1e9
+        return self._host0 + np.round((x + self._offset + self._drift * x) * 1e9).astype(np.int64)
+
+    def sample_times(self, stream, timestamp_ns, n, sample_rate):
+        """
+        Epoch times (ns) of the n samples of a packet of `stream` whose last sample has the sensor timestamp `timestamp_ns`.
+
+        The samples are spread evenly between the timestamps of the previous and
+        the current packet of the stream, so the true sample rate of the sensor is
+        followed. The nominal sample rate is used for the first packet and after gaps.
+        """
+        previous = self._last_timestamps.get(stream)
+        self._last_timestamps[stream] = timestamp_ns
+        period = 1e9 / sample_rate
+        if previous is not None and n and abs(timestamp_ns - previous - n * period) < 0.5 * n * period:
+            period = (timestamp_ns - previous) / n
+        sensor = timestamp_ns - np.round(np.arange(n - 1, -1, -1) * period).astype(np.int64)
+        return self.to_epoch(sensor)
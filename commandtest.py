@@ -1,4 +0,0 @@
-import BleakClient
-
-
-BleakClient.device_scanner(0)
\ No newline at end of file
@@ -0,0 +1,85 @@
+"""
+Detection of lost and duplicated PMD packets from the packet timestamps.
+
+Consecutive packets of a stream are sample count x sample period apart in
+sensor time. A larger step means packets were lost in between, a zero or
+slightly negative step a duplicated or reordered packet. A step back by more
+than a few packets means the sensor clock was reset (e.g. the device restarted
+during a reconnect), the check starts again from the new timestamps.
+"""
+from typing import NamedTuple
+
+
+class Gap(NamedTuple):
+    """
+    Samples missing from a stream.
+
+    start_ns, end_ns = sensor times of the first and the last missing sample
+    missing = number of missing samples
+    """
+    start_ns: int
+    end_ns: int
+    missing: int
+
+
+class ContinuityChecker:
+    """
+    Checks the continuity of the packets of one stream.
+
+    check() returns a Gap when samples are missing before the packet, and
+    sets duplicate when the packet repeats or precedes data already received.
+    A step that differs from the expected one by less than `tolerance`
+    packets is sensor timing jitter. A step back by more than `max_backward`
+    packets is a clock reset: the packet is kept and becomes the new reference.
+    """
+    def __init__(self, tolerance=0.5, max_gaps=1000, max_backward=4):
+        self.tolerance = tolerance
+        self.max_gaps = max_gaps
+        self.max_backward = max_backward
+        self.reset()
+
+    def reset(self):
+        self._last = None
+        self.packets = 0
+        self.samples = 0
+        self.lost_packets = 0
+        self.lost_samples = 0
+        self.duplicates = 0
+        self.clock_resets = 0
+        self.gaps = []
+        self.duplicate = False
+
+    @property
+    def stats(self):
+        return {"packets": self.packets, "samples": self.samples, "lost_packets": self.lost_packets,
+                "lost_samples": self.lost_samples, "duplicates": self.duplicates, "clock_resets": self.clock_resets,
+                "gaps": len(self.gaps)}
+
+    def check(self, timestamp_ns, n_samples, sample_rate):
+        """
+        Check a packet of n_samples whose last sample has the sensor timestamp timestamp_ns.
+        """
+        period = 1e9 / sample_rate
+        previous = self._last
+        if previous is not None and previous - timestamp_ns > self.max_backward * n_samples * period:
+            # The sensor clock went back, nothing is known about the samples in between
+            self.clock_resets += 1
+            previous = None
+        self.duplicate = previous is not None and timestamp_ns - previous < n_samples * period * (1 - self.tolerance)
+        if self.duplicate:
+            self.duplicates += 1
+            return None
+        self._last = timestamp_ns
+        self.packets += 1
+        self.samples += n_samples
+        if previous is None:
+            return None
+        missing = round((timestamp_ns - previous) / period) - n_samples
+        if missing <= self.tolerance * n_samples:
+            return None
+        gap = Gap(int(previous + period), int(timestamp_ns - n_samples * period), missing)
+        self.lost_samples += missing
+        self.lost_packets += max(1, round(missing / n_samples))
+        if len(self.gaps) < self.max_gaps:
+            self.gaps.append(gap)
+        return gap
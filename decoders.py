@@ -0,0 +1,153 @@
+"""
+Vectorized decoders for the Polar Measurement Data (PMD) notifications.
+
+Every PMD_DATA notification starts with the same 10 byte header:
+
+    [measurement type (8), timestamp of the last sample in ns (64), frame type (8)]
+
+followed by the samples of the packet. The decoders below turn the whole
+payload of a packet into a NumPy array in one pass and return a single batch
+per notification, instead of decoding and emitting every sample separately.
+"""
+import struct
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+
+PMD_HEADER_SIZE = 10
+
+ECG = 0x00
+PPG = 0x01
+ACC = 0x02
+PPI = 0x03
+
+# Frame type bit marking a delta-compressed frame
+DELTA_FRAME = 0x80
+
+
+class Batch(NamedTuple):
+    """
+    Decoded samples of a single PMD notification.
+
+    timestamp = sensor timestamp of the last sample in the packet (ns)
+    samples = NumPy array of the decoded samples, one row per sample
+    times = host epoch time of every sample (ns, int64), set by the client from its clock_sync.ClockSync
+    """
+    timestamp: int
+    samples: np.ndarray
+    times: Optional[np.ndarray] = None
+
+
+def read_timestamp(data):
+    # 64 bit unsigned sensor timestamp following the measurement type byte
+    return struct.unpack_from("<Q", data, 1)[0]
+
+
+def int24_le(buffer, offset=0, count=None):
+    """
+    Convert packed 24 bit little-endian signed integers to an int32 array.
+
+    The bytes are read with a np.frombuffer view starting at `offset`, so the
+    notification buffer does not need to be sliced or copied first. When
+    `count` is not given, every complete value until the end of the buffer is read.
+    """
+    raw = np.frombuffer(buffer, dtype=np.uint8, offset=offset)
+    if count is None:
+        count = raw.size // 3
+    b = raw[:count * 3].reshape(count, 3).astype(np.int32)
+    values = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+    # Shift the sign bit of the 24 bit value to the top and back to sign extend
+    return (values << 8) >> 8
+
+
+def signed_le(buffer, offset, size, count=None):
+    """
+    Convert packed little-endian signed integers of `size` bytes (1-4) to an int32 array.
+    """
+    if size == 3:
+        return int24_le(buffer, offset, count)
+    if count is None:
+        count = (len(buffer) - offset) // size
+    return np.frombuffer(buffer, dtype="<i%d" % size, count=count, offset=offset).astype(np.int32)
+
+
+def decode_delta_frame(buffer, offset, channels, resolution):
+    """
+    Decode a delta-compressed PMD frame (frame type bit 0x80 set) into an (n_samples, channels) array.
+
+    The frame starts with a reference sample holding one signed value of
+    ceil(resolution / 8) bytes per channel. It is followed by delta blocks of
+
+        [delta size in bits (8), sample count (8), bit-packed deltas]
+
+    where the deltas are signed, packed LSB first, sample by sample and
+    channel by channel. Each sample is the previous sample plus its delta.
+    """
+    size = (resolution + 7) // 8
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    blocks = [signed_le(buffer, offset, size, channels).reshape(1, channels)]
+    position = offset + channels * size
+    while position + 2 <= raw.size:
+        delta_size = int(raw[position])
+        sample_count = int(raw[position + 1])
+        position += 2
+        n_bits = delta_size * sample_count * channels
+        n_bytes = (n_bits + 7) // 8
+        if position + n_bytes > raw.size:
+            break
+        if delta_size == 0:
+            blocks.append(np.zeros((sample_count, channels), dtype=np.int32))
+            continue
+        bits = np.unpackbits(raw[position:position + n_bytes], bitorder="little")[:n_bits]
+        deltas = bits.reshape(-1, delta_size).astype(np.int32) @ (1 << np.arange(delta_size, dtype=np.int32))
+        # Two's complement of the delta_size bit values
+        deltas -= (deltas >> (delta_size - 1)) << delta_size
+        blocks.append(deltas.reshape(sample_count, channels))
+        position += n_bytes
+    return np.cumsum(np.concatenate(blocks), axis=0, dtype=np.int32)
+
+
+def is_delta_frame(data):
+    return bool(data[PMD_HEADER_SIZE - 1] & DELTA_FRAME)
+
+
+def decode_ecg(data, resolution=14):
+    """
+    Decode an H10 ECG packet. Samples are signed integers in microvolts.
+
+    Raw frames carry 24 bit samples, delta frames are decoded with the
+    resolution that was requested when the stream was started.
+    """
+    if is_delta_frame(data):
+        samples = decode_delta_frame(data, PMD_HEADER_SIZE, 1, resolution)[:, 0]
+    else:
+        samples = int24_le(data, PMD_HEADER_SIZE)
+    return Batch(read_timestamp(data), samples)
+
+
+def decode_ppg(data, resolution=22):
+    """
+    Decode an OH1 PPG packet into an (n_samples, 4) int32 array.
+
+    Each sample holds PPG0, PPG1, PPG2 and ambient as 24 bit signed integers.
+    """
+    if is_delta_frame(data):
+        return Batch(read_timestamp(data), decode_delta_frame(data, PMD_HEADER_SIZE, 4, resolution))
+    n_samples = (len(data) - PMD_HEADER_SIZE) // 12
+    samples = int24_le(data, PMD_HEADER_SIZE, n_samples * 4).reshape(n_samples, 4)
+    return Batch(read_timestamp(data), samples)
+
+
+def decode_acc(data, resolution=16):
+    """
+    Decode an ACC packet into an (n_samples, 3) int32 array of x, y and z in milli-G.
+
+    Raw frame types 0, 1 and 2 carry 8, 16 and 24 bit samples.
+    """
+    if is_delta_frame(data):
+        return Batch(read_timestamp(data), decode_delta_frame(data, PMD_HEADER_SIZE, 3, resolution))
+    step = data[PMD_HEADER_SIZE - 1] + 1
+    n_samples = (len(data) - PMD_HEADER_SIZE) // (step * 3)
+    samples = signed_le(data, PMD_HEADER_SIZE, step, n_samples * 3).reshape(n_samples, 3)
+    return Batch(read_timestamp(data), samples)
@@ -0,0 +1,103 @@
+"""
+On-disk cache of the static device information, by device address.
+
+Model, manufacturer, serial number and revisions do not change between
+connections, so reconnecting to a known device can skip reading them.
+The cache is a JSON file in $POLOPY_CACHE_DIR, by default ~/.cache/polopy.
+
+All clients of a process share one cache per file (shared()), and every
+change is merged into the current contents of the file, so clients and
+processes connecting at the same time do not overwrite each other's entries.
+Entries expire after max_age seconds, and the client checks the firmware
+revision of a cached device, so a firmware update is noticed at once.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Age (s) after which an entry is read again from the device
+MAX_AGE = 7 * 24 * 3600
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def default_path():
+    directory = os.environ.get("POLOPY_CACHE_DIR") or Path.home() / ".cache" / "polopy"
+    return Path(directory) / "devices.json"
+
+
+def shared(path=None):
+    """
+    The DeviceInfoCache of the file `path` (default_path() when not given) shared by the whole process.
+    """
+    path = Path(path) if path else default_path()
+    with _shared_lock:
+        cache = _shared.get(path)
+        if cache is None:
+            cache = _shared[path] = DeviceInfoCache(path)
+        return cache
+
+
+class DeviceInfoCache:
+    def __init__(self, path=None, max_age=MAX_AGE):
+        self.path = Path(path) if path else default_path()
+        self.max_age = max_age
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            entries = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def get(self, address):
+        """
+        Cached device information of the address, None when unknown or older than max_age.
+        """
+        with self._lock:
+            entry = self._load().get(address.upper())
+        # Entries of older versions of the cache have no time, they are read again
+        if not isinstance(entry, dict) or "info" not in entry:
+            return None
+        if time.time() - entry.get("cached_at", 0) > self.max_age:
+            return None
+        return entry["info"]
+
+    def put(self, address, info):
+        self._update(address.upper(), {"info": info, "cached_at": time.time()})
+
+    def remove(self, address):
+        self._update(address.upper(), None)
+
+    def _update(self, address, entry):
+        with self._lock:
+            # Merged into the file as it is now, other processes may have written to it since it was loaded
+            entries = self._read()
+            if entry is None:
+                if entries.pop(address, None) is None:
+                    self._entries = entries
+                    return
+            else:
+                entries[address] = entry
+            self._entries = entries
+            self._save()
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Written to a temporary file of this process first, so an interrupted write never leaves a broken cache
+            temporary = self.path.with_name("{}.{}.tmp".format(self.path.name, os.getpid()))
+            temporary.write_text(json.dumps(self._entries, indent=1))
+            os.replace(temporary, self.path)
+        except OSError:
+            pass  # A read-only home directory only costs the cache
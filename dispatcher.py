@@ -0,0 +1,43 @@
+"""
+Single subscriber for the PMD_DATA characteristic.
+
+ECG, PPG, ACC and PPI all arrive as notifications on the same PMD_DATA
+characteristic and the first byte of every notification tells the
+measurement type. Instead of every stream registering its own callback on
+the characteristic, the client subscribes once with a PMDDispatcher and
+the dispatcher routes each notification to the decoder of its stream.
+"""
+
+
+class PMDDispatcher:
+    """
+    Routes PMD_DATA notifications to the handler registered for their measurement type.
+
+    Handlers are called as handler(sender, data) where data is a memoryview of
+    the notification, so the payload is never copied before decoding. Streams
+    can be added and removed at any time without re-subscribing to the characteristic.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.unhandled_packets = 0
+
+    def add_stream(self, measurement_type, handler):
+        self.handlers[measurement_type] = handler
+
+    def remove_stream(self, measurement_type):
+        self.handlers.pop(measurement_type, None)
+
+    @property
+    def active_streams(self):
+        return list(self.handlers)
+
+    def __call__(self, sender, data):
+        view = memoryview(data)
+        if len(view) == 0:
+            return
+        handler = self.handlers.get(view[0])
+        if handler is None:
+            # Packets of a stream that was just stopped may still be in flight
+            self.unhandled_packets += 1
+            return
+        handler(sender, view)
@@ -0,0 +1,41 @@
+"""
+Streaming IIR filtering of multi-channel sample blocks.
+"""
+from functools import lru_cache
+
+import numpy as np
+from scipy import signal
+
+
+@lru_cache(maxsize=None)
+def design_sos(order, band, fs, btype, ftype):
+    """
+    Second-order sections of an IIR filter, cached for identical designs.
+
+    `band` must be hashable, a single cutoff frequency or a tuple of two.
+    The returned array is shared between all users of the design and must not be modified.
+    """
+    return signal.iirfilter(order, Wn=band, fs=fs, btype=btype, ftype=ftype, output="sos")
+
+
+class FilterBank:
+    """
+    IIR filter applied to every channel of a stream, keeping the filter state between blocks.
+
+    process() filters a whole packet of shape (n,) or (n, channels) with a
+    single sosfilt call, so the cost is one call per packet instead of one per sample.
+    """
+    def __init__(self, order, band, fs, btype="bandpass", ftype="butter", channels=1):
+        if np.ndim(band):
+            band = tuple(float(f) for f in band)
+        self.sos = design_sos(order, band, fs, btype, ftype)
+        self.channels = channels
+        self.zi = np.zeros((self.sos.shape[0], 2, channels))
+
+    def reset(self):
+        self.zi[:] = 0
+
+    def process(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        y, self.zi = signal.sosfilt(self.sos, block.reshape(-1, self.channels), axis=0, zi=self.zi)
+        return y.reshape(block.shape)
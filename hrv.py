@@ -0,0 +1,188 @@
+"""
+Streaming heart rate variability over a bounded time window, and the same metrics of a whole recording.
+"""
+import warnings
+from collections import deque
+
+import numpy as np
+
+
+class HRVEngine:
+    """
+    RMSSD, SDNN, pNN50 and mean HR of the inter-beat intervals of the last `window_s` seconds.
+
+    The metrics are kept as running sums that are updated when a beat enters
+    or leaves the window, so every update is O(1) and memory is bounded by the window.
+
+    Intervals are rejected as artifacts when they are outside [min_ibi, max_ibi] ms,
+    and as ectopic beats when they deviate more than `max_deviation` from the
+    running reference of the accepted intervals. Successive differences are
+    only taken between two consecutive accepted beats.
+
+    OH1 PPI values come with an error estimate (ms). Intervals with an error
+    estimate above `max_error` are rejected and the others are weighted by
+    error_scale / (error_scale + error estimate). H10 RR intervals have weight 1.
+    """
+    def __init__(self, window_s=300, min_ibi=300, max_ibi=2000, max_deviation=0.2,
+                 max_error=100, error_scale=20):
+        self.window_ms = window_s * 1000.0
+        self.min_ibi = min_ibi
+        self.max_ibi = max_ibi
+        self.max_deviation = max_deviation
+        self.max_error = max_error
+        self.error_scale = error_scale
+
+        # (beat time, ibi, weight, successive difference pair weight, squared difference) of accepted beats
+        self._beats = deque()
+        self._time = 0.0
+        self._previous = None  # (ibi, weight) of the previous beat if it was accepted
+        self._reference = None
+        self._consecutive_rejections = 0
+
+        self._w = 0.0
+        self._w_ibi = 0.0
+        self._w_ibi2 = 0.0
+        self._pw = 0.0
+        self._pw_diff2 = 0.0
+        self._pw_nn50 = 0.0
+
+        self.accepted = 0
+        self.rejected = 0
+
+    def add(self, ibi, err_est=None):
+        """
+        Add one inter-beat interval in ms. Returns True if it was accepted.
+        """
+        self._time += ibi
+        weight = 1.0
+        if err_est is not None:
+            weight = self.error_scale / (self.error_scale + err_est)
+
+        if not self._is_valid(ibi, err_est):
+            self.rejected += 1
+            self._previous = None
+            self._consecutive_rejections += 1
+            # After a run of rejections the rhythm has most likely really changed, start over from this interval
+            if self._consecutive_rejections >= 5 and self.min_ibi <= ibi <= self.max_ibi:
+                self._reference = ibi
+            self._evict()
+            return False
+
+        self.accepted += 1
+        self._consecutive_rejections = 0
+        self._reference = ibi if self._reference is None else 0.9 * self._reference + 0.1 * ibi
+
+        pair_weight = 0.0
+        diff2 = 0.0
+        if self._previous is not None:
+            pair_weight = min(weight, self._previous[1])
+            diff2 = (ibi - self._previous[0]) ** 2
+        self._previous = (ibi, weight)
+
+        self._beats.append((self._time, ibi, weight, pair_weight, diff2))
+        self._accumulate(ibi, weight, pair_weight, diff2, 1)
+        self._evict()
+        return True
+
+    def extend(self, ibis, err_ests=None):
+        if err_ests is None:
+            err_ests = [None] * len(ibis)
+        for ibi, err_est in zip(ibis, err_ests):
+            self.add(ibi, err_est)
+
+    def _is_valid(self, ibi, err_est):
+        if not self.min_ibi <= ibi <= self.max_ibi:
+            return False
+        if err_est is not None and err_est > self.max_error:
+            return False
+        if self._reference is not None and abs(ibi - self._reference) > self.max_deviation * self._reference:
+            return False
+        return True
+
+    def _accumulate(self, ibi, weight, pair_weight, diff2, sign):
+        self._w += sign * weight
+        self._w_ibi += sign * weight * ibi
+        self._w_ibi2 += sign * weight * ibi * ibi
+        self._pw += sign * pair_weight
+        self._pw_diff2 += sign * pair_weight * diff2
+        self._pw_nn50 += sign * pair_weight * (diff2 > 2500)
+
+    def _evict(self):
+        while self._beats and self._beats[0][0] <= self._time - self.window_ms:
+            _, ibi, weight, pair_weight, diff2 = self._beats.popleft()
+            self._accumulate(ibi, weight, pair_weight, diff2, -1)
+        if not self._beats:
+            # Do not let rounding errors of the running sums outlive the beats
+            self._w = self._w_ibi = self._w_ibi2 = self._pw = self._pw_diff2 = self._pw_nn50 = 0.0
+
+    @property
+    def mean_ibi(self):
+        return self._w_ibi / self._w if self._w > 0 else np.nan
+
+    @property
+    def mean_hr(self):
+        return 60000.0 / self.mean_ibi if self._w > 0 else np.nan
+
+    @property
+    def sdnn(self):
+        if self._w <= 0:
+            return np.nan
+        mean = self._w_ibi / self._w
+        return np.sqrt(max(self._w_ibi2 / self._w - mean * mean, 0.0))
+
+    @property
+    def rmssd(self):
+        return np.sqrt(self._pw_diff2 / self._pw) if self._pw > 0 else np.nan
+
+    @property
+    def pnn50(self):
+        # Percentage of successive differences larger than 50 ms
+        return 100.0 * self._pw_nn50 / self._pw if self._pw > 0 else np.nan
+
+
+def hrv_summary(ibis, err_ests=None, min_ibi=300, max_ibi=2000, max_deviation=0.2, max_error=100,
+                error_scale=20, reference_beats=5):
+    """
+    HRVEngine metrics of a whole recording of inter-beat intervals (ms), computed with array operations.
+
+    The artifact, error estimate and weighting rules are those of HRVEngine.
+    The ectopic beat reference is the median of the `reference_beats` valid
+    intervals centred on each beat instead of the running average of the past
+    accepted ones, as the whole recording is available.
+
+    Returns {"beats", "rejected", "mean_ibi", "mean_hr", "sdnn", "rmssd", "pnn50"}.
+    """
+    ibis = np.asarray(ibis, dtype=np.float64)
+    valid = (ibis >= min_ibi) & (ibis <= max_ibi)
+    weights = np.ones(len(ibis))
+    if err_ests is not None:
+        err_ests = np.asarray(err_ests, dtype=np.float64)
+        valid &= err_ests <= max_error
+        weights = error_scale / (error_scale + err_ests)
+
+    if len(ibis) >= reference_beats:
+        half = reference_beats // 2
+        candidates = np.pad(np.where(valid, ibis, np.nan), half, constant_values=np.nan)
+        windows = np.lib.stride_tricks.sliding_window_view(candidates, reference_beats)
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # windows without a valid interval
+            reference = np.nanmedian(windows, axis=1)
+        valid &= ~(np.abs(ibis - reference) > max_deviation * reference)
+
+    result = {"beats": int(valid.sum()), "rejected": int(len(ibis) - valid.sum()),
+              "mean_ibi": np.nan, "mean_hr": np.nan, "sdnn": np.nan, "rmssd": np.nan, "pnn50": np.nan}
+    w = weights[valid]
+    if w.sum() > 0:
+        x = ibis[valid]
+        mean = np.sum(w * x) / w.sum()
+        result["mean_ibi"] = mean
+        result["mean_hr"] = 60000.0 / mean
+        result["sdnn"] = np.sqrt(max(np.sum(w * x * x) / w.sum() - mean * mean, 0.0))
+    # Successive differences only between two consecutive accepted beats
+    pairs = valid[1:] & valid[:-1]
+    pair_weights = np.minimum(weights[1:], weights[:-1])[pairs]
+    if pair_weights.sum() > 0:
+        diff2 = np.diff(ibis)[pairs] ** 2
+        result["rmssd"] = np.sqrt(np.sum(pair_weights * diff2) / pair_weights.sum())
+        result["pnn50"] = 100.0 * np.sum(pair_weights * (diff2 > 2500)) / pair_weights.sum()
+    return result
@@ -0,0 +1,281 @@
+"""
+Runtime metrics: counters, gauges and histograms shared by the client, the recorder and the GUI.
+
+    from metrics import REGISTRY
+    packets = REGISTRY.counter("polopy_notifications_total", "Notifications received", device="H10 1", stream="ecg")
+    packets.inc()
+
+Per second rates of a counter over a sliding window are gauges made with
+REGISTRY.rate(), e.g. the notifications per second of a stream.
+
+The metrics are read in-process with REGISTRY.snapshot(), written to a file
+in the Prometheus text format with write_prometheus() (periodically with
+start_dump()) and optionally served on http://127.0.0.1:<port>/metrics with serve_http().
+Updating a metric is a few attribute operations, cheap enough for every packet.
+"""
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+
+# Upper bounds (s) of the default histogram buckets, from 10 us to 1 s
+DEFAULT_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """
+    Value set with set(), or read from `function` when the metrics are collected.
+    """
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        self._value = 0
+        self.function = function
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.function() if self.function is not None else self._value
+
+
+class Rate:
+    """
+    Per second rate of a counter over the last `window_s` seconds, a gauge computed when it is read.
+
+    Every read records the value of the counter, the rate is taken between the
+    current value and the oldest recorded one within the window, so it is 0
+    until the gauge has been read twice.
+    """
+    kind = "gauge"
+
+    def __init__(self, counter, window_s=10.0):
+        self.counter = counter
+        self.window_s = window_s
+        self._history = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        now = time.monotonic()
+        current = self.counter.value
+        with self._lock:
+            # Keep one point older than the window, so the rate always spans the whole window
+            while len(self._history) > 1 and now - self._history[1][0] >= self.window_s:
+                self._history.popleft()
+            oldest = self._history[0] if self._history else None
+            self._history.append((now, current))
+        if oldest is None or now <= oldest[0]:
+            return 0.0
+        return (current - oldest[1]) / (now - oldest[0])
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts values above all buckets
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile (inf when above all buckets).
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    """
+    Metrics by name and labels. Asking twice for the same name and labels returns the same metric.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self._dump_thread = None
+        self._server = None
+
+    def _get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(*args)
+                    self._help.setdefault(name, (help, cls.kind))
+        return metric
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", function=None, **labels):
+        gauge = self._get(Gauge, name, help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def rate(self, name, help="", counter=None, window_s=10.0, **labels):
+        """
+        Gauge of the per second rate of `counter` over the last window_s seconds, see Rate.
+        """
+        return self._get(Rate, name, help, labels, counter, window_s)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def remove(self, name, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._metrics.pop(key, None)
+
+    def snapshot(self):
+        """
+        {name: [(labels, value)]}, histograms as {"count", "sum", "mean", "p50", "p99"}.
+        """
+        result = {}
+        with self._lock:
+            items = list(self._metrics.items())
+        for (name, labels), metric in sorted(items, key=lambda item: item[0]):
+            if metric.kind == "histogram":
+                value = {"count": metric.count, "sum": metric.sum, "mean": metric.mean,
+                         "p50": metric.quantile(0.5), "p99": metric.quantile(0.99)}
+            else:
+                value = metric.value
+            result.setdefault(name, []).append((dict(labels), value))
+        return result
+
+    def prometheus_text(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            items = sorted(self._metrics.items(), key=lambda item: item[0])
+        current = None
+        for (name, labels), metric in items:
+            if name != current:
+                current = name
+                help, kind = self._help[name]
+                if help:
+                    lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, kind))
+            if metric.kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), metric.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("{}_bucket{} {}".format(name, _labels(labels + (("le", le),)), cumulative))
+                lines.append("{}_sum{} {!r}".format(name, _labels(labels), metric.sum))
+                lines.append("{}_count{} {}".format(name, _labels(labels), metric.count))
+            else:
+                lines.append("{}{} {}".format(name, _labels(labels), metric.value))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics to a text file, e.g. for the textfile collector of the Prometheus node exporter.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(path.name + ".tmp")
+        temporary.write_text(self.prometheus_text())
+        os.replace(temporary, path)
+
+    def start_dump(self, path, interval=10.0):
+        """
+        Write the metrics to `path` every `interval` seconds from a background thread.
+        """
+        if self._dump_thread is not None:
+            return
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.write_prometheus(path)
+            self.write_prometheus(path)
+        self._dump_thread = threading.Thread(target=run, name="MetricsDump", daemon=True)
+        self._dump_thread.stop = stop
+        self._dump_thread.start()
+
+    def stop_dump(self):
+        if self._dump_thread is not None:
+            self._dump_thread.stop.set()
+            self._dump_thread.join()
+            self._dump_thread = None
+
+    def serve_http(self, port=9464, host="127.0.0.1"):
+        """
+        Serve the metrics on http://host:port/metrics from a background thread. Returns the server.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="MetricsHTTP", daemon=True).start()
+        return self._server
+
+    def stop_http(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+
+# Registry used by default by all modules
+REGISTRY = Registry()
@@ -0,0 +1,191 @@
+"""
+Polar Measurement Data (PMD) control point commands and responses.
+
+Commands are written to the PMD_CONTROL characteristic:
+
+    [op code (8), measurement type (8), settings]
+
+where the settings of a START_MEASUREMENT command are a list of
+
+    [setting type (8), count (8), count x value]
+
+The device answers every command with an indication on PMD_CONTROL:
+
+    [0xF0, op code (8), measurement type (8), status (8), more frames (8), parameters]
+
+The parameters of a GET_MEASUREMENT_SETTINGS response list the available
+values of every setting in the same format as the settings of a command.
+"""
+from enum import IntEnum
+from typing import NamedTuple
+
+
+CONTROL_POINT_RESPONSE = 0xF0
+
+
+class OpCode(IntEnum):
+    GET_MEASUREMENT_SETTINGS = 0x01
+    START_MEASUREMENT = 0x02
+    STOP_MEASUREMENT = 0x03
+
+
+class MeasurementType(IntEnum):
+    ECG = 0x00
+    PPG = 0x01
+    ACC = 0x02
+    PPI = 0x03
+    GYRO = 0x05
+    MAG = 0x06
+
+
+class SettingType(IntEnum):
+    SAMPLE_RATE = 0x00
+    RESOLUTION = 0x01
+    RANGE = 0x02
+    RANGE_MILLIUNIT = 0x03
+    CHANNELS = 0x04
+    FACTOR = 0x05
+
+
+# Settings sent in a start command, FACTOR and RANGE_MILLIUNIT only describe the data
+START_SETTINGS = (SettingType.SAMPLE_RATE, SettingType.RESOLUTION, SettingType.RANGE, SettingType.CHANNELS)
+
+# Size in bytes of one value of every setting type
+SETTING_SIZE = {
+    SettingType.SAMPLE_RATE: 2,
+    SettingType.RESOLUTION: 2,
+    SettingType.RANGE: 2,
+    SettingType.RANGE_MILLIUNIT: 8,  # min and max as two 32 bit values
+    SettingType.CHANNELS: 1,
+    SettingType.FACTOR: 4,
+}
+
+
+class Status(IntEnum):
+    SUCCESS = 0x00
+    INVALID_OP_CODE = 0x01
+    INVALID_MEASUREMENT_TYPE = 0x02
+    NOT_SUPPORTED = 0x03
+    INVALID_LENGTH = 0x04
+    INVALID_PARAMETER = 0x05
+    ALREADY_IN_STATE = 0x06
+    INVALID_RESOLUTION = 0x07
+    INVALID_SAMPLE_RATE = 0x08
+    INVALID_RANGE = 0x09
+    INVALID_MTU = 0x0A
+    INVALID_NUMBER_OF_CHANNELS = 0x0B
+    INVALID_STATE = 0x0C
+    DEVICE_IN_CHARGER = 0x0D
+
+
+class PMDError(Exception):
+    """
+    The device rejected a control point command.
+    """
+    def __init__(self, response):
+        super().__init__("{} of {} failed: {}".format(_name(OpCode, response.op_code),
+                                                       _name(MeasurementType, response.measurement_type),
+                                                       _name(Status, response.status)))
+        self.response = response
+
+
+def _name(enum, value):
+    try:
+        return enum(value).name
+    except ValueError:
+        return hex(value)
+
+
+class ControlPointResponse(NamedTuple):
+    op_code: int
+    measurement_type: int
+    status: int
+    more: bool
+    parameters: bytes
+
+    @property
+    def ok(self):
+        return self.status == Status.SUCCESS
+
+    def settings(self):
+        """
+        Available values of every setting of a GET_MEASUREMENT_SETTINGS response.
+        """
+        return parse_settings(self.parameters)
+
+
+def parse_response(data):
+    """
+    Parse a PMD_CONTROL indication, None if it is not a control point response.
+    """
+    if len(data) < 4 or data[0] != CONTROL_POINT_RESPONSE:
+        return None
+    more = len(data) > 4 and data[4] != 0
+    return ControlPointResponse(data[1], data[2], data[3], more, bytes(data[5:]))
+
+
+def encode_settings(settings):
+    """
+    Encode {setting type: value or list of values} as [setting type, count, values...].
+    """
+    payload = bytearray()
+    for setting_type, values in settings.items():
+        if isinstance(values, int):
+            values = [values]
+        size = SETTING_SIZE[SettingType(setting_type)]
+        payload += bytes([setting_type, len(values)])
+        for value in values:
+            payload += int(value).to_bytes(size, "little")
+    return payload
+
+
+def parse_settings(buffer, offset=0):
+    """
+    Decode [setting type, count, values...] entries into {SettingType: [values]}.
+    """
+    settings = {}
+    while offset + 2 <= len(buffer):
+        setting_type, count = buffer[offset], buffer[offset + 1]
+        size = SETTING_SIZE.get(setting_type)
+        if size is None:
+            break  # Unknown setting, the size of its values is not known
+        offset += 2
+        values = [int.from_bytes(buffer[offset + i * size:offset + (i + 1) * size], "little") for i in range(count)]
+        settings[SettingType(setting_type)] = values
+        offset += count * size
+    return settings
+
+
+def settings_command(measurement_type):
+    return bytearray([OpCode.GET_MEASUREMENT_SETTINGS, measurement_type])
+
+
+def start_command(measurement_type, settings=None):
+    """
+    START_MEASUREMENT command, settings = {SettingType: value}. PPI has no settings.
+    """
+    return bytearray([OpCode.START_MEASUREMENT, measurement_type]) + encode_settings(settings or {})
+
+
+def stop_command(measurement_type):
+    return bytearray([OpCode.STOP_MEASUREMENT, measurement_type])
+
+
+def choose_settings(available, min_range=None):
+    """
+    Pick the start settings from the available ones.
+
+    The highest sample rate, resolution and channel count. The range is the smallest
+    one covering min_range (G), which keeps the most resolution for the movements to
+    measure, the highest range when none does or min_range is not given.
+    """
+    chosen = {}
+    for setting_type, values in available.items():
+        if setting_type not in START_SETTINGS or not values:
+            continue
+        fitting = [value for value in values if min_range is not None and value >= min_range]
+        if setting_type == SettingType.RANGE and fitting:
+            chosen[setting_type] = min(fitting)
+        else:
+            chosen[setting_type] = max(values)
+    return chosen
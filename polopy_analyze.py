@@ -0,0 +1,170 @@
+"""
+polopy-analyze: batch analysis of recorded sessions.
+
+Analyses every CSV file and .polo session found in the given directories
+or glob patterns with a process pool, and writes one summary row per
+recording and stream to <output>/summary.csv:
+
+    polopy-analyze                            everything under measurements/
+    polopy-analyze "measurements/ECG/*.csv"   the ECG CSV files
+    polopy-analyze -j 8 -o results data/      8 worker processes
+
+The result of every recording is stored in <output>/results/ as soon as it
+is done. Recordings whose result is already there and which have not
+changed since are skipped, so an interrupted run continues where it
+stopped and running it again only analyses the new recordings.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+
+# BLAS threads inside the workers would compete with the other workers for the cores
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="polopy-analyze", description="Batch analysis of recorded sessions")
+    parser.add_argument("paths", nargs="*", default=["measurements"],
+                        help="directories, files or glob patterns of recordings (default measurements)")
+    parser.add_argument("-o", "--output", default="analysis", help="output directory (default analysis)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes (default one per core)")
+    parser.add_argument("--rate", action="append", default=[], metavar="STREAM=HZ",
+                        help="sample rate of the CSV files of a stream, e.g. PPG=130, can be repeated")
+    parser.add_argument("--force", action="store_true", help="analyse again the recordings that are already done")
+    return parser.parse_args(argv)
+
+
+def find_recordings(paths, output):
+    """
+    CSV files and .polo session directories in `paths`, largest first, excluding the output directory.
+    """
+    output = Path(output).resolve()
+    found = set()
+    for pattern in paths:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        for match in map(Path, matches):
+            if match.suffix in (".csv", ".polo"):
+                found.add(match)
+            elif match.is_dir():
+                found.update(match.rglob("*.csv"))
+                found.update(path for path in match.rglob("*.polo") if path.is_dir())
+    recordings = [path for path in found if output not in path.resolve().parents]
+    return sorted(recordings, key=lambda path: -size_and_mtime(path)[0])
+
+
+def size_and_mtime(path):
+    # A session is a directory, its files together make the recording
+    files = [path] if path.is_file() else [file for file in path.iterdir() if file.is_file()]
+    stats = [file.stat() for file in files]
+    return sum(s.st_size for s in stats), max((s.st_mtime_ns for s in stats), default=0)
+
+
+def result_path(output, recording):
+    key = hashlib.sha1(str(recording.resolve()).encode()).hexdigest()[:16]
+    return Path(output) / "results" / (key + ".json")
+
+
+def load_result(path, signature):
+    """
+    Stored rows of a recording, None when missing or made from an older version of the recording.
+    """
+    try:
+        with open(path) as file:
+            result = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return result["rows"] if result.get("signature") == list(signature) else None
+
+
+def save_result(path, recording, signature, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, "w") as file:
+        json.dump({"recording": str(recording), "signature": list(signature), "rows": rows}, file)
+    os.replace(temporary, path)
+
+
+def write_summary(path, rows, columns):
+    import csv
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: round(value, 3) if isinstance(value, float) else value for key, value in row.items()})
+    os.replace(temporary, path)
+
+
+def run(args):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import analysis
+
+    rates = {}
+    for rate in args.rate:
+        stream, _, hz = rate.partition("=")
+        rates[stream.upper()] = float(hz)
+
+    output = Path(args.output)
+    recordings = find_recordings(args.paths, output)
+    if not recordings:
+        print("No recordings found in", ", ".join(args.paths))
+        return 1
+
+    rows = {}
+    todo = []
+    for recording in recordings:
+        signature = size_and_mtime(recording)
+        done = None if args.force else load_result(result_path(output, recording), signature)
+        if done is None:
+            todo.append((recording, signature))
+        else:
+            rows[recording] = done
+    print("{} recording(s), {} already analysed, {} to analyse with {} process(es)".format(
+        len(recordings), len(rows), len(todo), args.jobs))
+
+    failed = 0
+    start = time.monotonic()
+    if todo:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(analysis.analyze_recording, recording, rates): (recording, signature)
+                       for recording, signature in todo}
+            for done, future in enumerate(as_completed(futures), 1):
+                recording, signature = futures[future]
+                try:
+                    rows[recording] = future.result()
+                except Exception as error:
+                    # Not stored, so the next run tries the recording again
+                    failed += 1
+                    print("{}: analysis failed: {!r}".format(recording, error))
+                    continue
+                save_result(result_path(output, recording), recording, signature, rows[recording])
+                print("[{}/{}] {}".format(done, len(todo), recording))
+        print("Analysed {} recording(s) in {:.1f} s".format(len(todo) - failed, time.monotonic() - start))
+
+    summary = output / "summary.csv"
+    write_summary(summary, [row for recording in sorted(rows) for row in rows[recording]], analysis.COLUMNS)
+    print("Summary written to", summary)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Before NumPy is imported, the workers inherit the environment
+    for variable in THREAD_VARIABLES:
+        os.environ.setdefault(variable, "1")
+    try:
+        return run(args)
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+polopy-log: headless logging of Polar devices to disk.
+
+Scans for Polar devices, connects to them concurrently and records all their
+streams until the duration has elapsed or Ctrl+C is pressed:
+
+    polopy-log                          record every Polar device found
+    polopy-log -n 2 -d 3600             the first 2 devices, for one hour
+    polopy-log -a XX:XX:XX:XX:XX:XX     a given device
+    polopy-log --backend sim            simulated devices, no hardware needed
+                                        (how many: POLOPY_SIM_DEVICES="h10=8,oh1=2")
+    polopy-log --metrics-port 9464      serve runtime metrics on http://127.0.0.1:9464/metrics
+
+No Qt, SciPy or plotting modules are imported. The device and recording
+modules are imported only after the arguments are parsed, so --help and
+argument errors return immediately.
+"""
+import argparse
+import os
+import sys
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="polopy-log", description="Record Polar H10 / OH1 devices to disk")
+    parser.add_argument("-a", "--address", action="append", default=[], help="device address to record, can be repeated")
+    parser.add_argument("-n", "--devices", type=int, default=0, help="record at most this many devices (default all found)")
+    parser.add_argument("-d", "--duration", type=float, default=0, help="recording length in seconds (default until Ctrl+C)")
+    parser.add_argument("-o", "--directory", default="measurements", help="output directory (default measurements)")
+    parser.add_argument("-f", "--format", choices=("binary", "csv"), default="binary", help="recording format")
+    parser.add_argument("--name", default=None, help="recording name (default the start date and time)")
+    parser.add_argument("--scan-time", type=float, default=5.0, help="seconds to scan for devices")
+    parser.add_argument("--backend", choices=("bleak", "sim"), default=None,
+                        help="BLE backend, the default is $POLOPY_BACKEND or bleak")
+    parser.add_argument("--status-interval", type=float, default=10.0,
+                        help="seconds between the status lines, 0 disables them")
+    parser.add_argument("--log-level", default=os.environ.get("POLOPY_LOG_LEVEL", "INFO"),
+                        help="logging level of the device messages (default $POLOPY_LOG_LEVEL or INFO)")
+    parser.add_argument("--metrics-file", default=None,
+                        help="write the runtime metrics to this file in the Prometheus text format")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="seconds between writes of --metrics-file")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve the runtime metrics on http://127.0.0.1:PORT/metrics")
+    return parser.parse_args(argv)
+
+
+async def find_devices(args):
+    import transport
+
+    devices = await transport.discover(args.backend, timeout=args.scan_time)
+    if args.address:
+        addresses = {address.upper() for address in args.address}
+        devices = [device for device in devices if device.address.upper() in addresses]
+    else:
+        devices = [device for device in devices if device.name and "Polar" in device.name]
+    if args.devices:
+        devices = devices[:args.devices]
+    return devices
+
+
+async def run(args):
+    import asyncio
+    from session_manager import SessionManager
+
+    print("Scanning for Polar devices...")
+    devices = await find_devices(args)
+    if not devices:
+        print("No Polar devices found")
+        return 1
+    print("Connecting to", ", ".join(device.name for device in devices))
+
+    manager = SessionManager(args.directory, args.format)
+    connected = await manager.add_all(devices)
+    if not connected:
+        await manager.stop()
+        return 1
+    manager.start_recording(args.name)
+    print("Recording {} device(s), press Ctrl+C to stop".format(len(connected)))
+
+    start = time.monotonic()
+    next_status = start + args.status_interval
+    try:
+        while not args.duration or time.monotonic() - start < args.duration:
+            await asyncio.sleep(0.5)
+            if args.status_interval and time.monotonic() >= next_status:
+                next_status += args.status_interval
+                print(manager.status())
+    except asyncio.CancelledError:
+        pass
+    finally:
+        files = manager.stop_recording()
+        await manager.stop()
+    for paths in files.values():
+        for path in paths:
+            print("Saved", path)
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    import asyncio
+    import logging
+    from metrics import REGISTRY
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.backend:
+        os.environ["POLOPY_BACKEND"] = args.backend
+    if args.metrics_file:
+        REGISTRY.start_dump(args.metrics_file, args.metrics_interval)
+    if args.metrics_port:
+        REGISTRY.serve_http(args.metrics_port)
+    try:
+        return asyncio.run(run(args))
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        REGISTRY.stop_dump()
+        REGISTRY.stop_http()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+Streaming QRS (R-peak) detection on the ECG, after Pan & Tompkins.
+
+Every packet goes through the whole pipeline with a few array operations:
+
+    band-pass ~5 - 11 Hz -> derivative -> squaring -> 150 ms moving window integration
+
+The band-pass is the one of Pan & Tompkins, a moving average low-pass and a
+high-pass that subtracts a longer moving average, scaled to the sample rate.
+As a short linear-phase FIR filter it only needs NumPy, so the detector can
+run in the headless logger. The tails of the filter and of the integration
+window are carried between packets. Only the local maxima of the integrated signal, a handful per beat,
+go through the adaptive thresholds in Python, so the cost per packet hardly
+depends on the heart rate.
+
+At 130 Hz one sample is 7.7 ms, so the R-peak is located on the raw ECG
+and refined with a parabola through the highest sample and its neighbours,
+which gives its time with a fraction of a sample period.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Beats(NamedTuple):
+    """
+    R-peaks detected in a packet.
+
+    times = epoch time (ns) of every R-peak
+    rr = interval from the previous R-peak (ms), NaN for the first beat
+    hr = beat-to-beat heart rate (bpm), 60000 / rr
+    """
+    times: np.ndarray
+    rr: np.ndarray
+    hr: np.ndarray
+
+
+def band_pass_kernel(fs):
+    """
+    FIR kernel of the Pan & Tompkins band-pass at the sample rate fs.
+
+    Low-pass = two 30 ms moving averages, high-pass = the signal minus its
+    160 ms moving average, the lengths of the original 200 Hz filters.
+    """
+    short = max(1, int(round(0.03 * fs)))
+    long = int(round(0.16 * fs)) | 1  # odd, so the high-pass has an integer delay
+    low_pass = np.convolve(np.ones(short), np.ones(short)) / short ** 2
+    high_pass = -np.ones(long) / long
+    high_pass[long // 2] += 1
+    return np.convolve(low_pass, high_pass)
+
+
+class QRSDetector:
+    """
+    R-peak detector fed packet by packet with process().
+
+    fs = sample rate of the ECG (Hz)
+    window_s = length of the moving window integration (s)
+    refractory_s = shortest time between two QRS complexes (s)
+    t_wave_s = peaks closer than this to the previous QRS with less than half its slope are T-waves (s)
+    learning_s = ECG used to initialise the thresholds before the first detection (s)
+
+    An R-peak is reported once the integrated signal has passed its maximum,
+    about 100 ms (filter delay) + window_s after the R-peak. Beats found by the search back (a
+    missed beat looked for again with half the threshold after 1.66 average
+    RR intervals without a detection) are reported with that delay.
+    """
+    # Search back only looks at the last max_pending_s seconds, bounding the memory and the delay
+    max_pending_s = 3.0
+    # Time (s) by which the maximum of the integrated signal can trail the R-peak, beyond the window
+    search_margin_s = 0.05
+
+    def __init__(self, fs=130, window_s=0.15, refractory_s=0.2, t_wave_s=0.36, learning_s=2.0):
+        self.fs = fs
+        self.kernel = band_pass_kernel(fs)
+        self.delay = (len(self.kernel) - 1) // 2
+        self.window = max(1, int(round(window_s * fs)))
+        self.refractory = int(round(refractory_s * fs))
+        self.t_wave = int(round(t_wave_s * fs))
+        self.learning = int(round(learning_s * fs))
+        # The start of the filtered signal is the transient of the filter, it is not searched
+        self.settle = min(int(round(0.5 * fs)), self.learning // 2)
+        self.search = self.window + self.delay + int(round(self.search_margin_s * fs))
+        self.max_pending = int(round(self.max_pending_s * fs))
+        self.reset()
+
+    def reset(self):
+        self._processed = 0
+        self._input_tail = None
+        self._last_filtered = 0.0
+        self._squared_tail = np.zeros(self.window - 1)
+        # Samples that can still be part of a detection, the first one has the absolute index _start
+        self._start = 0
+        self._raw = np.empty(0)
+        self._slope = np.empty(0)
+        self._integrated = np.empty(0)
+        self._times = np.empty(0, dtype=np.int64)
+        # Absolute index of the next sample to examine for a local maximum
+        self._scan = max(1, self.settle)
+        # Signal and noise peak levels, None until the learning phase is over
+        self.signal_level = None
+        self.noise_level = None
+        self._last_index = None  # absolute index of the integrated maximum of the last QRS
+        self._last_slope = 0.0
+        self._last_time = None
+        self._rr = []  # last 8 RR intervals in samples
+        self._noise_peak = None  # (absolute index, value, slope) of the highest noise peak since the last QRS
+        self.beats = 0
+
+    @property
+    def threshold(self):
+        return self.noise_level + 0.25 * (self.signal_level - self.noise_level)
+
+    def process(self, samples, times=None):
+        """
+        Detect the R-peaks of a packet of ECG samples. Returns the Beats found in it.
+
+        times = epoch time (ns) of every sample, e.g. decoders.Batch.times; the
+        time since the first sample processed when not given
+        """
+        samples = np.asarray(samples, dtype=np.float64).ravel()
+        n = len(samples)
+        if times is None:
+            times = ((self._processed + np.arange(n)) * (1e9 / self.fs)).astype(np.int64)
+        self._processed += n
+
+        if self._input_tail is None:
+            # Start from a constant signal, so the filter does not see a step at the first sample
+            self._input_tail = np.full(len(self.kernel) - 1, samples[0] if n else 0.0)
+        extended = np.concatenate([self._input_tail, samples])
+        filtered = np.convolve(extended, self.kernel, "valid")
+        self._input_tail = extended[len(extended) - len(self.kernel) + 1:]
+        slope = np.diff(filtered, prepend=self._last_filtered)
+        if n:
+            self._last_filtered = filtered[-1]
+        squared = slope * slope
+        padded = np.concatenate([self._squared_tail, squared])
+        cumulative = np.concatenate([[0.0], np.cumsum(padded)])
+        integrated = (cumulative[self.window:] - cumulative[:-self.window]) / self.window
+        if self.window > 1:
+            self._squared_tail = padded[len(padded) - self.window + 1:]
+
+        self._raw = np.concatenate([self._raw, samples])
+        self._slope = np.concatenate([self._slope, np.abs(slope)])
+        self._integrated = np.concatenate([self._integrated, integrated])
+        self._times = np.concatenate([self._times, np.asarray(times, dtype=np.int64)])
+
+        found = []
+        if self.signal_level is None:
+            if self._start + len(self._integrated) < self.learning:
+                return self._beats(found)
+            settled = self._integrated[self.settle:]
+            self.signal_level = 0.25 * settled.max()
+            self.noise_level = 0.5 * settled.mean()
+
+        # Local maxima of the integrated signal, the last sample has no successor yet
+        y = self._integrated
+        first = self._scan - self._start
+        candidates = first + np.flatnonzero((y[first:-1] > y[first - 1:-2]) & (y[first:-1] >= y[first + 1:]))
+        for i in candidates:
+            self._examine(self._start + i, y[i], found)
+        self._scan = max(self._scan, self._start + len(y) - 1)
+        self._trim()
+        return self._beats(found)
+
+    def _examine(self, index, value, found):
+        # Search back: no QRS for 1.66 average RR intervals (1 s before two beats were found),
+        # take the highest noise peak above half the threshold
+        last = self.settle if self._last_index is None else self._last_index
+        average = np.mean(self._rr) if self._rr else self.fs
+        if (self._noise_peak is not None and index - last > 1.66 * average
+                and self._noise_peak[1] > 0.5 * self.threshold):
+            peak, self._noise_peak = self._noise_peak, None
+            self._detect(peak[0], peak[2], found)
+            self.signal_level = 0.25 * peak[1] + 0.75 * self.signal_level
+
+        i = index - self._start
+        slope = self._slope[max(0, i - self.window):i + 1].max()
+        if value > self.threshold:
+            since = None if self._last_index is None else index - self._last_index
+            if since is not None and since < self.refractory:
+                return  # Still the previous QRS complex
+            if since is not None and since < self.t_wave and slope < 0.5 * self._last_slope:
+                self._noise(index, value, slope)
+                return
+            self._detect(index, slope, found)
+            self.signal_level = 0.125 * value + 0.875 * self.signal_level
+        else:
+            self._noise(index, value, slope)
+
+    def _noise(self, index, value, slope):
+        self.noise_level = 0.125 * value + 0.875 * self.noise_level
+        if self._last_index is not None and index - self._last_index < self.refractory:
+            return
+        if self._noise_peak is None or value > self._noise_peak[1]:
+            self._noise_peak = (index, value, slope)
+
+    def _detect(self, index, slope, found):
+        # The R-peak is the extreme raw sample before the maximum of the integrated signal
+        i = index - self._start
+        lo = max(0, i - self.search)
+        segment = self._raw[lo:i + 1]
+        k = lo + int(np.argmax(np.abs(segment - np.median(segment))))
+        offset = 0.0
+        if 0 < k < len(self._raw) - 1:
+            y0, y1, y2 = self._raw[k - 1:k + 2]
+            curvature = y0 - 2 * y1 + y2
+            if curvature != 0:
+                offset = float(np.clip(0.5 * (y0 - y2) / curvature, -0.5, 0.5))
+        time = self._times[k] + offset * 1e9 / self.fs
+
+        if self._last_index is not None:
+            self._rr = (self._rr + [index - self._last_index])[-8:]
+        rr = (time - self._last_time) / 1e6 if self._last_time is not None else np.nan
+        found.append((time, rr))
+        self._last_index = index
+        self._last_slope = slope
+        self._last_time = time
+        self._noise_peak = None
+        self.beats += 1
+
+    def _trim(self):
+        # Keep what the next R-peak search and a possible search back can still need
+        keep = self._scan - self.search - 1
+        if self._noise_peak is not None:
+            if self._scan - self._noise_peak[0] > self.max_pending:
+                self._noise_peak = None
+            else:
+                keep = min(keep, self._noise_peak[0] - self.search - 1)
+        drop = keep - self._start
+        if drop > 0:
+            self._raw = self._raw[drop:]
+            self._slope = self._slope[drop:]
+            self._integrated = self._integrated[drop:]
+            self._times = self._times[drop:]
+            self._start += drop
+
+    def _beats(self, found):
+        times = np.array([time for time, _ in found], dtype=np.float64)
+        rr = np.array([rr for _, rr in found], dtype=np.float64)
+        return Beats(times.round().astype(np.int64), rr, 60000.0 / rr)
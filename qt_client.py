@@ -0,0 +1,31 @@
+"""
+Qt adapter of BleakClient.PolarClient for the GUI.
+"""
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from BleakClient import PolarClient, SIGNALS
+
+
+class QBleakClient(QObject):
+    """
+    Re-emits the signals of a PolarClient as pyqtSignals.
+
+    Everything else (start(), start_ECG(), device_info, ...) is forwarded to the wrapped client.
+    """
+    ecg_updated = pyqtSignal(object)
+    ppg_updated = pyqtSignal(object)
+    acc_updated = pyqtSignal(object)
+    HR_updated = pyqtSignal(list)
+    PPI_updated = pyqtSignal(list)
+    Battery_level_read = pyqtSignal(int)
+    disconnected = pyqtSignal(bool)
+    data_gap = pyqtSignal(object, object, int, int)
+
+    def __init__(self, device):
+        super().__init__()
+        self.core = PolarClient(device)
+        for name in SIGNALS:
+            getattr(self.core, name).connect(getattr(self, name).emit)
+
+    def __getattr__(self, name):
+        return getattr(self.core, name)
@@ -0,0 +1,88 @@
+"""
+Automatic reconnection of a client whose connection was lost.
+"""
+import asyncio
+import logging
+import random
+import time
+
+from BleakClient import Signal
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+
+class ReconnectSupervisor:
+    """
+    Reconnects a client after an unexpected disconnection and resumes its streams.
+
+    Attempts are spaced by a bounded exponential backoff, initial_delay doubling
+    up to max_delay (with +-20 % jitter so several devices do not retry in step),
+    for at most max_attempts attempts, None = until the client is stopped.
+
+    Signals:
+    gap = (start_ns, end_ns) epoch times of the dropout, emitted once reconnected
+    reconnected = emitted when the streams run again
+    gave_up = emitted when max_attempts attempts failed
+    """
+    def __init__(self, client, initial_delay=0.5, max_delay=30.0, max_attempts=None):
+        self.client = client
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.gap = Signal()
+        self.reconnected = Signal()
+        self.gave_up = Signal()
+        self.task = None
+        self.attempts = 0
+        self.reconnects = 0
+        self.gaps = []
+        client.disconnected.connect(self._on_disconnected)
+
+    @property
+    def reconnecting(self):
+        return self.task is not None
+
+    def _on_disconnected(self, expected):
+        if expected or self.task is not None:
+            return
+        self.task = asyncio.ensure_future(self._reconnect(time.time_ns()))
+
+    def delays(self):
+        """
+        Backoff delays (s) of the attempts.
+        """
+        delay = self.initial_delay
+        attempt = 0
+        while self.max_attempts is None or attempt < self.max_attempts:
+            attempt += 1
+            yield delay * random.uniform(0.8, 1.2)
+            delay = min(2 * delay, self.max_delay)
+
+    async def _reconnect(self, lost_ns):
+        try:
+            for self.attempts, delay in enumerate(self.delays(), 1):
+                await asyncio.sleep(delay)
+                if self.client.closing or self.client.connected:
+                    return
+                try:
+                    await self.client.resume()
+                except Exception as error:
+                    log.warning("%s: reconnect attempt %d failed: %r", self.client.device.name, self.attempts, error)
+                    continue
+                self.reconnects += 1
+                restored_ns = time.time_ns()
+                self.gaps.append((lost_ns, restored_ns))
+                REGISTRY.counter("polopy_reconnects_total", "Successful reconnections",
+                                 device=self.client.device.name).inc()
+                log.info("%s: reconnected after %.1f s", self.client.device.name, (restored_ns - lost_ns) / 1e9)
+                self.gap.emit(lost_ns, restored_ns)
+                self.reconnected.emit()
+                return
+            self.gave_up.emit()
+        finally:
+            self.task = None
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
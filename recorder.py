@@ -0,0 +1,231 @@
+"""
+Streaming recording of the decoded data to disk.
+
+The data handlers only put the decoded blocks to a bounded queue. A
+dedicated writer thread collects them into chunks and appends the chunks
+to disk, so the memory use does not grow with the length of the recording
+and stopping a recording only flushes the last chunk.
+
+Two formats are supported:
+"binary" = a memory-mappable session directory measurements/<date>.polo (see session_format)
+"csv" = one file per stream, measurements/<STREAM>/<date>_<STREAM>.csv
+"""
+import datetime
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from metrics import REGISTRY
+from session_format import SESSION_SUFFIX, SessionWriter
+
+log = logging.getLogger(__name__)
+
+# Column names and number format of the CSV file of each stream
+STREAMS = {
+    "ECG": (["ECG"], "%d"),
+    "PPG": (["PPG_CH1", "PPG_CH2", "PPG_CH3", "Ambient"], "%d"),
+    "ACC": (["ACC_X", "ACC_Y", "ACC_Z"], "%.2f"),
+    "HR": (["HR", "RR"], "%d"),
+    "PPI": (["HR", "PPI", "Error_estimate"], "%d"),
+    "GAP": (["start_ns", "end_ns", "stream", "missing_samples"], "%d"),
+}
+
+_STOP = object()
+
+
+class CsvSink:
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self._handles = {}
+        self.paths = {}
+
+    def append(self, stream, blocks, timestamps):
+        header, fmt = STREAMS[stream]
+        if stream not in self._handles:
+            file = self.directory / stream / (self.name + "_" + stream + ".csv")
+            file.parent.mkdir(parents=True, exist_ok=True)
+            self._handles[stream] = open(file, "w", newline="")
+            self._handles[stream].write(",".join(header) + "\n")
+            self.paths[stream] = file
+        chunk = np.concatenate([block.reshape(len(block), -1) for block in blocks])
+        np.savetxt(self._handles[stream], chunk, fmt=fmt, delimiter=",")
+        self._handles[stream].flush()
+
+    @property
+    def bytes_written(self):
+        return sum(handle.tell() for handle in self._handles.values() if not handle.closed)
+
+    @property
+    def files(self):
+        return list(self.paths.values())
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+
+
+class BinarySink(SessionWriter):
+    def __init__(self, directory, name, info=None, sample_rates=None):
+        super().__init__(directory / (name + SESSION_SUFFIX), info, sample_rates)
+
+    @property
+    def files(self):
+        return [self.path]
+
+
+class Recorder:
+    """
+    Records decoded blocks of every stream to disk.
+
+    write() can be called from the GUI / asyncio thread, it only enqueues the
+    block and never waits: when the writer thread falls behind and the queue is
+    full the block is dropped (counted in dropped_blocks), so the memory used by
+    the recording stays bounded and the notification handling is never delayed.
+
+    When the writer thread fails (e.g. disk full) the recording ends: write()
+    and stop() raise the exception of the writer thread.
+
+    The queue depth and the bytes written are published in metrics.REGISTRY
+    with the recorder label `label`.
+    """
+    def __init__(self, directory="measurements", format="binary", chunk_rows=4096, queue_size=256, label="default"):
+        self.directory = Path(directory)
+        self.format = format
+        self.chunk_rows = chunk_rows
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._sink = None
+        self.rows_written = {}
+        self.bytes_written = 0
+        self.dropped_blocks = 0
+        # Exception that ended the writer thread
+        self.error = None
+        self.name = None
+        REGISTRY.gauge("polopy_recorder_queue_depth", "Blocks waiting for the writer thread",
+                       function=self._queue.qsize, recorder=label)
+        self._bytes_metric = REGISTRY.counter("polopy_recorder_bytes_total", "Bytes written to disk", recorder=label)
+        self._dropped_metric = REGISTRY.counter("polopy_recorder_dropped_blocks_total",
+                                                "Blocks dropped because the writer thread did not keep up", recorder=label)
+
+    @property
+    def recording(self):
+        return self._thread is not None
+
+    def start(self, name=None, info=None, sample_rates=None):
+        """
+        Start a recording. `info` (device information) and `sample_rates` are stored in the header of binary recordings.
+        """
+        if self.recording:
+            return
+        self.name = name or datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        if self.format == "csv":
+            self._sink = CsvSink(self.directory, self.name)
+        else:
+            self._sink = BinarySink(self.directory, self.name, info, sample_rates)
+        self.rows_written = {}
+        self.bytes_written = 0
+        self.dropped_blocks = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name="Recorder", daemon=True)
+        self._thread.start()
+
+    def write(self, stream, block, timestamp_ns=None):
+        """
+        Record a block of samples, shape (n,) or (n, channels), of the given stream.
+
+        timestamp_ns = epoch time of the last sample of the block, the time of the call when not given
+
+        The block is written later by the writer thread, so it must not be modified after the call.
+        Returns False when the block was dropped. Raises the exception of a failed writer thread.
+        """
+        if not self.recording:
+            return False
+        if not self._thread.is_alive():
+            raise self.error or RuntimeError("The recorder writer thread has stopped")
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        try:
+            self._queue.put_nowait((stream, block, timestamp_ns))
+        except queue.Full:
+            self.dropped_blocks += 1
+            self._dropped_metric.inc()
+            return False
+        return True
+
+    def stop(self):
+        """
+        Flush the remaining data and close the files. Returns the paths of the recorded files.
+
+        Raises the exception of the writer thread if it failed during the recording.
+        """
+        if not self.recording:
+            return []
+        thread = self._thread
+        while thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        thread.join()
+        self._thread = None
+        # Blocks left behind by a failed writer thread
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        if self.error is not None:
+            raise self.error
+        return self._sink.files
+
+    def gap(self, start_ns, end_ns, stream=-1, missing_samples=0):
+        """
+        Record missing data from start_ns to end_ns (epoch time in ns) as a row of the GAP stream.
+
+        stream = measurement type of the stream missing samples, -1 for a lost connection
+
+        The samples lost in a dropout are recorded by the rows of the streams, the row
+        of the lost connection has no missing samples so they are not counted twice.
+        """
+        return self.write("GAP", np.array([[start_ns, end_ns, stream, missing_samples]], dtype=np.int64), end_ns)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        pending = {}
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                stream, block, timestamp_ns = item
+                blocks, timestamps, rows = pending.setdefault(stream, ([], [], [0]))
+                blocks.append(np.asarray(block))
+                timestamps.append(timestamp_ns)
+                rows[0] += len(block)
+                if rows[0] >= self.chunk_rows:
+                    self._write_chunk(stream, pending.pop(stream))
+            for stream, chunk in pending.items():
+                if chunk[2][0]:
+                    self._write_chunk(stream, chunk)
+        except Exception as error:
+            log.error("Recording %s failed: %r", self.name, error)
+            self.error = error
+        finally:
+            try:
+                self._sink.close()
+            except Exception as error:
+                self.error = self.error or error
+
+    def _write_chunk(self, stream, chunk):
+        blocks, timestamps, rows = chunk
+        self._sink.append(stream, blocks, timestamps)
+        self.rows_written[stream] = self.rows_written.get(stream, 0) + rows[0]
+        written = self._sink.bytes_written
+        self._bytes_metric.inc(written - self.bytes_written)
+        self.bytes_written = written
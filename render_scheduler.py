@@ -0,0 +1,89 @@
+"""
+Frame-rate capped plot rendering, decoupled from the arrival of samples.
+"""
+import time
+
+from metrics import REGISTRY
+
+
+class RenderScheduler:
+    """
+    Redraws the plots that have new data at most `fps` times per second.
+
+    Data handlers only write into their buffers and call mark_dirty(name).
+    A periodic timer calls tick(), which runs the render function of every
+    dirty plot once the next frame is due. Updates that arrive between two
+    frames are merged into one redraw.
+
+    Counters:
+    frames_rendered = frames in which at least one plot was redrawn
+    frames_skipped = frame slots missed because tick() was called too late (e.g. busy event loop)
+    updates_coalesced = data updates that did not need a redraw of their own
+
+    The frame times and the latency from the first mark_dirty() of a plot to
+    its redraw are published in metrics.REGISTRY.
+    """
+    def __init__(self, fps=30):
+        self._renderers = {}
+        # Time (perf_counter) of the first update of every dirty plot since its last redraw
+        self._dirty = {}
+        self._next_frame = None
+        self.frames_rendered = 0
+        self.frames_skipped = 0
+        self.updates_coalesced = 0
+        self._frames = REGISTRY.counter("polopy_render_frames_total", "Frames rendered")
+        self._frame_seconds = REGISTRY.histogram("polopy_render_frame_seconds", "Time spent rendering a frame")
+        self._latency = REGISTRY.histogram("polopy_render_latency_seconds",
+                                           "Time from a data update to the redraw of its plot")
+        self._fps = REGISTRY.gauge("polopy_render_fps", "Frames rendered per second over the last second")
+        self._fps_window = (time.perf_counter(), 0)
+        self.set_fps(fps)
+
+    def set_fps(self, fps):
+        self.fps = fps
+        self.period = 1.0 / fps
+
+    def register(self, name, render):
+        self._renderers[name] = render
+
+    def mark_dirty(self, name):
+        if name in self._dirty:
+            self.updates_coalesced += 1
+        else:
+            self._dirty[name] = time.perf_counter()
+
+    def tick(self, now=None):
+        """
+        Render the dirty plots if a frame is due. Returns True when something was drawn.
+        """
+        if now is None:
+            now = time.perf_counter()
+        if self._next_frame is None:
+            self._next_frame = now
+        if now < self._next_frame:
+            return False
+
+        missed = int((now - self._next_frame) / self.period)
+        self.frames_skipped += missed
+        self._next_frame += (missed + 1) * self.period
+
+        if not self._dirty:
+            return False
+        dirty = self._dirty
+        self._dirty = {}
+        started = time.perf_counter()
+        for name in dirty:
+            self._renderers[name]()
+        finished = time.perf_counter()
+        for updated in dirty.values():
+            self._latency.observe(finished - updated)
+        self._frame_seconds.observe(finished - started)
+        self._frames.inc()
+        self.frames_rendered += 1
+        window_start, window_frames = self._fps_window
+        if finished - window_start >= 1.0:
+            self._fps.set((window_frames + 1) / (finished - window_start))
+            self._fps_window = (finished, 0)
+        else:
+            self._fps_window = (window_start, window_frames + 1)
+        return True
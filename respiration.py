@@ -0,0 +1,111 @@
+"""
+Streaming respiratory rate estimation from the chest accelerometer.
+
+Breathing moves the chest at roughly 0.1 - 0.7 Hz (6 - 42 breaths per
+minute), so instead of running a full zero-padded FFT of the raw 200 Hz
+signal on every packet, the signal is decimated to a low rate and only the
+frequencies of the breathing band are evaluated with a precomputed zoom
+DFT once every hop.
+"""
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+
+class RespirationEstimator:
+    """
+    Respiratory rate from one accelerometer axis, updated once every `hop_s` seconds.
+
+    fs = sample rate of the accelerometer (Hz)
+    window_s = length of the analysed window (s)
+    hop_s = time between two estimates (s)
+    band = searched breathing band (Hz)
+    resolution = frequency step of the evaluated spectrum (Hz)
+    decimated_fs = rate the signal is decimated to before the analysis (Hz)
+    """
+    def __init__(self, fs=200, window_s=21.0, hop_s=1.0, band=(0.1, 0.7), resolution=200 / 15000,
+                 decimated_fs=10):
+        # Decimation by block averaging, the averaging also works as the anti-aliasing filter
+        self.factor = max(1, int(round(fs / decimated_fs)))
+        self.fs = fs / self.factor
+        self.window = RingBuffer(int(round(window_s * self.fs)))
+        self.hop = max(1, int(round(hop_s * self.fs)))
+        self._pending = np.zeros(self.factor)
+        self._n_pending = 0
+        # Decimated samples so far, and the count at which the next estimate is due
+        self._decimated = 0
+        self._next_estimate = self.window.capacity
+
+        self.frequencies = np.arange(band[0], band[1] + resolution / 2, resolution)
+        n = np.arange(self.window.capacity)
+        # Hamming windowed DFT basis of the breathing band, one row per evaluated frequency
+        self._basis = np.hamming(self.window.capacity) * np.exp(
+            -2j * np.pi * self.frequencies[:, np.newaxis] * n / self.fs)
+
+        self.rate = None  # latest estimate in breaths per minute
+
+    def update(self, samples):
+        """
+        Add a block of samples. Returns the new estimate (breaths per minute)
+        when one was computed for this block, otherwise None.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        # Complete the block that was left over from the previous packet
+        take = min(self.factor - self._n_pending, len(samples))
+        self._pending[self._n_pending:self._n_pending + take] = samples[:take]
+        self._n_pending += take
+        samples = samples[take:]
+        if self._n_pending < self.factor:
+            return None
+        n_blocks = len(samples) // self.factor
+        decimated = np.empty(n_blocks + 1)
+        decimated[0] = self._pending.mean()
+        decimated[1:] = samples[:n_blocks * self.factor].reshape(n_blocks, self.factor).mean(axis=1)
+        rest = samples[n_blocks * self.factor:]
+        self._pending[:len(rest)] = rest
+        self._n_pending = len(rest)
+
+        self.window.write(decimated)
+        self._decimated += len(decimated)
+        if self._decimated < self._next_estimate:
+            return None
+        # The estimates stay on a fixed grid of one every hop, however the packets split the signal
+        while self._next_estimate <= self._decimated:
+            self._next_estimate += self.hop
+        self.rate = self.estimate()
+        return self.rate
+
+    def estimate(self):
+        x = self.window.view(0)
+        spectrum = np.abs(self._basis @ (x - x.mean()))
+        return float(self.frequencies[np.argmax(spectrum)] * 60)
+
+    def estimate_all(self, samples, chunk=4096):
+        """
+        Estimates (breaths per minute) of a whole recording at once, one every hop.
+        Does not change the streaming state.
+
+        The k-th estimate is that of the window ending after window + k * hop decimated
+        samples, the grid update() follows. update() can only estimate at the end of a
+        packet, so its windows end up to one packet later than these, and it gives one
+        estimate for a packet spanning several hops.
+
+        All windows of the decimated signal go through a single matrix product
+        per `chunk` windows instead of one spectrum per update() call.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        n_blocks = len(samples) // self.factor
+        decimated = samples[:n_blocks * self.factor].reshape(n_blocks, self.factor).mean(axis=1)
+        size = self.window.capacity
+        if n_blocks < size:
+            return np.empty(0)
+        windows = np.lib.stride_tricks.sliding_window_view(decimated, size)[::self.hop]
+        # (x - mean) @ basis = x @ basis - mean * sum(basis), so the windows are never copied to remove their mean
+        basis = self._basis.T
+        basis_sum = basis.sum(axis=0)
+        rates = np.empty(len(windows))
+        for start in range(0, len(windows), chunk):
+            block = windows[start:start + chunk]
+            spectrum = np.abs(block @ basis - block.mean(axis=1)[:, np.newaxis] * basis_sum)
+            rates[start:start + chunk] = self.frequencies[np.argmax(spectrum, axis=1)] * 60
+        return rates
@@ -0,0 +1,73 @@
+"""
+Fixed-capacity multi-channel ring buffer for the live signal windows.
+"""
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated ring buffer holding the latest `capacity` samples of `channels` channels.
+
+    Every sample is stored twice, at index i and i + capacity of a buffer of
+    twice the capacity. The latest samples are then always available as one
+    contiguous slice, so reading the window for plotting or analysis is a
+    view and writing is O(1) per sample without any allocation.
+    """
+    def __init__(self, capacity, channels=1, dtype=np.float64):
+        self.capacity = capacity
+        self.channels = channels
+        self._data = np.zeros((2 * capacity, channels), dtype=dtype)
+        self._head = 0  # index of the next write, always < capacity
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def full(self):
+        return self._count == self.capacity
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+
+    def append(self, sample):
+        self._data[self._head] = sample
+        self._data[self._head + self.capacity] = sample
+        self._head = (self._head + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def write(self, block):
+        """
+        Write a block of samples, shape (n,) for single channel buffers or (n, channels).
+        """
+        block = np.asarray(block).reshape(-1, self.channels)
+        n = len(block)
+        if n == 0:
+            return
+        if n > self.capacity:
+            block = block[-self.capacity:]
+            n = self.capacity
+        # The block is written to both halves and may wrap around the end of each half
+        first = min(n, self.capacity - self._head)
+        for base in (0, self.capacity):
+            self._data[base + self._head:base + self._head + first] = block[:first]
+            self._data[base:base + n - first] = block[first:]
+        self._head = (self._head + n) % self.capacity
+        self._count = min(self._count + n, self.capacity)
+
+    def view(self, channel=None):
+        """
+        Contiguous view of the samples in the buffer, oldest first.
+
+        The view is only valid until the next write. With `channel` a 1-D view of that channel is returned.
+        """
+        start = self._head + self.capacity - self._count
+        window = self._data[start:start + self._count]
+        if channel is not None:
+            return window[:, channel]
+        return window
+
+    def unwrapped(self, channel=None):
+        # Copy of the samples in the buffer that stays valid after later writes
+        return self.view(channel).copy()
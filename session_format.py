@@ -0,0 +1,234 @@
+"""
+Binary, memory-mappable recording format.
+
+A recording session is a directory <name>.polo holding
+
+    header.json     device information, creation time and the layout of every stream
+    <STREAM>.dat    samples of the stream as one contiguous little-endian array, one row per sample
+    <STREAM>.idx    timestamp index, one (end_row, timestamp_ns) entry per written block
+
+end_row is the row following the last sample of the block and timestamp_ns
+the epoch time of that last sample in nanoseconds. Connection dropouts and
+lost packets are recorded as rows of the GAP stream: the samples a stream
+lost, also during a dropout, are counted only in the rows of that stream, and
+the row of a dropout only marks when the connection was down. The data and index files
+are only ever appended to, and the reader memory-maps them, so any time range
+of a recording is returned as a NumPy view without loading the whole file.
+"""
+import datetime
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+SESSION_SUFFIX = ".polo"
+FORMAT_VERSION = 1
+
+# dtype and column names of the samples of each stream
+STREAM_LAYOUT = {
+    "ECG": ("<i4", ["ECG"]),
+    "PPG": ("<i4", ["PPG_CH1", "PPG_CH2", "PPG_CH3", "Ambient"]),
+    "ACC": ("<f4", ["ACC_X", "ACC_Y", "ACC_Z"]),
+    "HR": ("<f4", ["HR", "RR"]),
+    "PPI": ("<f4", ["HR", "PPI", "Error_estimate"]),
+    # Missing data from start_ns to end_ns (epoch time), stream = measurement type of the
+    # stream with missing samples (decoders.ECG, ...) or -1 for a lost connection, whose
+    # missing_samples is 0 as the lost samples are in the rows of the streams
+    "GAP": ("<i8", ["start_ns", "end_ns", "stream", "missing_samples"]),
+}
+
+INDEX_DTYPE = np.dtype([("end_row", "<i8"), ("timestamp_ns", "<i8")])
+
+
+class SessionWriter:
+    """
+    Appends the blocks of every stream to a session directory.
+
+    info = device information stored in the header (e.g. model, serial number, firmware)
+    sample_rates = nominal sample rate of the streams (Hz), event streams like HR have none
+    """
+    def __init__(self, path, info=None, sample_rates=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.sample_rates = sample_rates or {}
+        self.header = {
+            "format": "polopy-session",
+            "version": FORMAT_VERSION,
+            "created": datetime.datetime.now().astimezone().isoformat(),
+            "device": info or {},
+            "streams": {},
+        }
+        self._data = {}
+        self._index = {}
+        self._rows = {}
+        self.bytes_written = 0
+        self._write_header()
+
+    def _write_header(self):
+        for stream, rows in self._rows.items():
+            self.header["streams"][stream]["rows"] = rows
+        with open(self.path / "header.json", "w") as file:
+            json.dump(self.header, file, indent=2)
+
+    def _add_stream(self, stream):
+        dtype, columns = STREAM_LAYOUT[stream]
+        self.header["streams"][stream] = {
+            "dtype": dtype,
+            "columns": columns,
+            "sample_rate": self.sample_rates.get(stream),
+            "rows": 0,
+        }
+        self._data[stream] = open(self.path / (stream + ".dat"), "ab")
+        self._index[stream] = open(self.path / (stream + ".idx"), "ab")
+        self._rows[stream] = 0
+        self._write_header()
+
+    def append(self, stream, blocks, timestamps):
+        """
+        Append blocks of samples of a stream, `timestamps` holding the epoch time (ns) of the last sample of every block.
+        """
+        if stream not in self._data:
+            self._add_stream(stream)
+        dtype, columns = STREAM_LAYOUT[stream]
+        lengths = [len(block) for block in blocks]
+        index = np.empty(len(blocks), dtype=INDEX_DTYPE)
+        index["end_row"] = self._rows[stream] + np.cumsum(lengths)
+        index["timestamp_ns"] = timestamps
+        data = np.concatenate([np.asarray(block).reshape(len(block), len(columns)) for block in blocks])
+        data = data.astype(dtype, copy=False)
+        data.tofile(self._data[stream])
+        index.tofile(self._index[stream])
+        self.bytes_written += data.nbytes + index.nbytes
+        self._data[stream].flush()
+        self._index[stream].flush()
+        self._rows[stream] += len(data)
+
+    @property
+    def files(self):
+        return [self.path / (stream + ".dat") for stream in self._data]
+
+    def close(self):
+        for file in list(self._data.values()) + list(self._index.values()):
+            file.close()
+        self._write_header()
+
+
+class SessionReader:
+    """
+    Random access to a recorded session through memory-mapped files.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "header.json") as file:
+            self.header = json.load(file)
+        self._data = {}
+        self._index = {}
+
+    @property
+    def streams(self):
+        return list(self.header["streams"])
+
+    @property
+    def device(self):
+        return self.header["device"]
+
+    def sample_rate(self, stream):
+        return self.header["streams"][stream]["sample_rate"]
+
+    @property
+    def gaps(self):
+        """
+        (n, 4) array of the (start_ns, end_ns, stream, missing_samples) rows of the recorded gaps.
+        """
+        if "GAP" not in self.header["streams"]:
+            return np.zeros((0, 4), dtype=np.int64)
+        return self.data("GAP")
+
+    def data(self, stream):
+        """
+        Memory-mapped (rows, channels) array of all samples of the stream.
+        """
+        if stream not in self._data:
+            layout = self.header["streams"][stream]
+            dtype = np.dtype(layout["dtype"])
+            channels = len(layout["columns"])
+            file = self.path / (stream + ".dat")
+            rows = file.stat().st_size // (dtype.itemsize * channels)
+            if rows == 0:
+                self._data[stream] = np.empty((0, channels), dtype=dtype)
+            else:
+                self._data[stream] = np.memmap(file, dtype=dtype, mode="r", shape=(rows, channels))
+        return self._data[stream]
+
+    def index(self, stream):
+        if stream not in self._index:
+            file = self.path / (stream + ".idx")
+            if file.stat().st_size < INDEX_DTYPE.itemsize:
+                self._index[stream] = np.empty(0, dtype=INDEX_DTYPE)
+            else:
+                self._index[stream] = np.memmap(file, dtype=INDEX_DTYPE, mode="r")
+        return self._index[stream]
+
+    def row_at(self, stream, timestamp_ns):
+        """
+        Fractional row of the sample recorded at `timestamp_ns`, interpolated between the index entries.
+
+        Only the two neighbouring index entries are read, found with a binary search.
+        """
+        index = self.index(stream)
+        if len(index) == 0:
+            return 0.0
+        times = index["timestamp_ns"]
+        i = int(np.searchsorted(times, timestamp_ns))
+        if 0 < i < len(index):
+            t0, t1 = float(times[i - 1]), float(times[i])
+            r0, r1 = float(index["end_row"][i - 1]), float(index["end_row"][i])
+            if t1 == t0:
+                return r1 - 1
+            return r0 - 1 + (timestamp_ns - t0) / (t1 - t0) * (r1 - r0)
+        # Outside of the index, extrapolate with the nominal sample rate
+        edge = 0 if i == 0 else len(index) - 1
+        rate = self.sample_rate(stream)
+        last_row = float(index["end_row"][edge]) - 1
+        if not rate:
+            return last_row if i else -np.inf
+        return last_row + (timestamp_ns - float(times[edge])) * rate / 1e9
+
+    def time_range(self, stream, start_ns, end_ns):
+        """
+        View of the samples recorded between start_ns and end_ns (epoch ns).
+        """
+        data = self.data(stream)
+        start = int(np.clip(np.ceil(self.row_at(stream, start_ns)), 0, len(data)))
+        end = int(np.clip(np.floor(self.row_at(stream, end_ns)) + 1, start, len(data)))
+        return data[start:end]
+
+    def timestamps(self, stream, start_row=0, end_row=None):
+        """
+        Epoch time (ns) of the samples in [start_row, end_row), interpolated from the index.
+        """
+        index = self.index(stream)
+        end_row = len(self.data(stream)) if end_row is None else end_row
+        rows = np.arange(start_row, end_row)
+        if len(index) == 0 or len(rows) == 0:
+            return np.zeros(len(rows), dtype=np.int64)
+        # Only the index entries around the requested rows are read
+        ends = index["end_row"]
+        first = max(int(np.searchsorted(ends, start_row, side="right")) - 1, 0)
+        last = min(int(np.searchsorted(ends, end_row)) + 1, len(index))
+        last_rows = np.asarray(ends[first:last], dtype=np.float64) - 1
+        times = np.asarray(index["timestamp_ns"][first:last], dtype=np.float64)
+        result = np.interp(rows, last_rows, times)
+        rate = self.sample_rate(stream)
+        if rate:
+            # Samples before the first index entry are extrapolated with the nominal sample rate.
+            # The samples of a block following a gap are placed back from the end of their
+            # block with the nominal rate, instead of being spread over the gap.
+            block = np.minimum(np.searchsorted(last_rows, rows), len(last_rows) - 1)
+            inside = rows <= last_rows[-1]
+            backward = times[block] - (last_rows[block] - rows) * 1e9 / rate
+            result[inside] = np.maximum(result, backward)[inside]
+            before = rows < last_rows[0]
+            result[before] = backward[before]
+        return result.astype(np.int64)
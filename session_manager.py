@@ -0,0 +1,252 @@
+"""
+Concurrent streaming and recording from several Polar devices in one asyncio loop.
+
+Every device gets its own DeviceSession with its own client (decoders and
+clock mapping), live buffers, recorder and throughput counters, so a device
+that disconnects or misbehaves only affects its own session.
+"""
+import asyncio
+import datetime
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+
+from BleakClient import PolarClient
+from hrv import HRVEngine
+from qrs import QRSDetector
+from reconnect import ReconnectSupervisor
+from recorder import Recorder
+from ring_buffer import RingBuffer
+
+log = logging.getLogger(__name__)
+
+# Seconds of every stream kept in the live buffers of a session
+BUFFER_SECONDS = 10
+
+# Stream: channels, the buffers are sized with the negotiated sample rate of the stream
+BUFFERS = {
+    "ECG": 1,
+    "PPG": 4,
+    "ACC": 3,
+}
+
+
+class DeviceSession:
+    """
+    Streams of a single device: client, live buffers, recorder and counters.
+
+    The R-peaks of the ECG are detected as it arrives, ecg_hr is the heart
+    rate of the last beat and hrv the HRV of the last 5 minutes of R-peaks.
+    """
+    def __init__(self, device, directory="measurements", format="binary"):
+        self.device = device
+        self.name = device.name.replace(" ", "_")
+        self.client = PolarClient(device)
+        self.recorder = Recorder(Path(directory) / self.name, format=format, label=self.name)
+        # Live buffers by stream, created on the first packet of the stream
+        self.buffers = {}
+        self.packets = {}
+        self.samples = {}
+        self.started = None
+        self.error = None
+        # Built at the negotiated ECG sample rate on the first packet
+        self.qrs = None
+        self.hrv = HRVEngine(window_s=300)
+        self.ecg_hr = None
+
+        self.client.ecg_updated.connect(lambda batch: self._on_batch("ECG", batch))
+        self.client.ecg_updated.connect(self._on_ecg)
+        self.client.ppg_updated.connect(lambda batch: self._on_batch("PPG", batch))
+        self.client.acc_updated.connect(lambda batch: self._on_batch("ACC", batch))
+        self.client.HR_updated.connect(self._on_hr)
+        self.client.PPI_updated.connect(self._on_ppi)
+        self.client.disconnected.connect(self._on_disconnected)
+        # Lost connections are re-established and the dropouts recorded as gaps
+        self.supervisor = ReconnectSupervisor(self.client)
+        self.supervisor.gap.connect(lambda start_ns, end_ns: self._record(self.recorder.gap, start_ns, end_ns))
+        # Samples lost from a stream (lost notifications) are recorded as gaps too
+        self.client.data_gap.connect(lambda *gap: self._record(self.recorder.gap, *gap))
+
+    @property
+    def address(self):
+        return self.device.address
+
+    @property
+    def connected(self):
+        return self.client.connected
+
+    def _count(self, stream, samples):
+        self.packets[stream] = self.packets.get(stream, 0) + 1
+        self.samples[stream] = self.samples.get(stream, 0) + samples
+
+    def _on_batch(self, stream, batch):
+        self._count(stream, len(batch.samples))
+        if stream not in self.buffers:
+            rate = self.client.stream_sample_rates[stream]
+            self.buffers[stream] = RingBuffer(int(round(rate * BUFFER_SECONDS)), BUFFERS[stream])
+        self.buffers[stream].write(batch.samples)
+        self._record(self.recorder.write, stream, batch.samples, batch.times[-1])
+
+    def _on_ecg(self, batch):
+        if self.qrs is None:
+            self.qrs = QRSDetector(self.client.stream_sample_rates["ECG"])
+        beats = self.qrs.process(batch.samples, batch.times)
+        if len(beats.times):
+            rr = beats.rr[~np.isnan(beats.rr)]
+            self.hrv.extend(rr)
+            self.ecg_hr = beats.hr[-1]
+
+    def _on_hr(self, output):
+        self._count("HR", len(output[1]))
+        if len(output[1]) != 0:
+            self._record(self.recorder.write, "HR", np.column_stack([np.full(len(output[1]), output[0]), output[1]]))
+
+    def _on_ppi(self, output):
+        self._count("PPI", len(output[1]))
+        if len(output[1]) != 0:
+            self._record(self.recorder.write, "PPI", np.column_stack(output[:3]), output[3][-1])
+
+    def _on_disconnected(self, expected):
+        if not expected:
+            log.warning("%s: connection lost, reconnecting", self.device.name)
+
+    async def start(self):
+        """
+        Connect and start the default streams of the device model.
+        """
+        await self.client.start()
+        if "H10" in self.device.name:
+            await self.client.start_ECG()
+            await self.client.start_ACC_H10()
+            await self.client.start_HR()
+        if "OH1" in self.device.name:
+            await self.client.start_PPG()
+            await self.client.start_ACC_OH1()
+            await self.client.start_PPI()
+        self.started = time.monotonic()
+
+    async def stop(self):
+        self.supervisor.cancel()
+        self.stop_recording()
+        if self.client.connected:
+            await self.client.stop()
+
+    def start_recording(self, name=None):
+        self.recorder.start(name, info=self.client.device_info, sample_rates=self.client.stream_sample_rates)
+
+    def stop_recording(self):
+        try:
+            return self.recorder.stop()
+        except Exception as error:
+            log.error("%s: recording failed: %r", self.device.name, error)
+            self.error = error
+            return []
+
+    def _record(self, write, *args):
+        # A failed recording (e.g. disk full) is stopped, the streams of the device go on
+        try:
+            write(*args)
+        except Exception:
+            self.stop_recording()
+
+    @property
+    def lost_samples(self):
+        return sum(checker.lost_samples for checker in self.client.continuity.values())
+
+    def throughput(self):
+        """
+        Mean packets/s and samples/s of every stream since the streams were started.
+        """
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        if elapsed <= 0:
+            return {}
+        return {stream: {"packets_per_s": self.packets[stream] / elapsed,
+                         "samples_per_s": self.samples[stream] / elapsed}
+                for stream in self.packets}
+
+
+class SessionManager:
+    """
+    Connects, streams and records from any number of devices concurrently.
+
+    Devices are connected in parallel and a failed connection or a lost
+    device is reported for that device only, the other sessions keep running.
+    """
+    def __init__(self, directory="measurements", format="binary"):
+        self.directory = Path(directory)
+        self.format = format
+        self.sessions = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    async def add(self, device):
+        """
+        Connect a device and start its streams. Returns its DeviceSession.
+        """
+        session = self.sessions.get(device.address)
+        if session is None:
+            session = self.sessions[device.address] = DeviceSession(device, self.directory, self.format)
+        try:
+            await session.start()
+        except Exception as error:
+            session.error = error
+            log.error("%s: could not connect: %r", device.name, error)
+        return session
+
+    async def add_all(self, devices):
+        """
+        Connect all devices concurrently. Returns the sessions that connected.
+        """
+        sessions = await asyncio.gather(*(self.add(device) for device in devices))
+        return [session for session in sessions if session.connected]
+
+    async def remove(self, address):
+        session = self.sessions.pop(address, None)
+        if session is not None:
+            await session.stop()
+
+    async def stop(self):
+        await asyncio.gather(*(session.stop() for session in self.sessions.values()), return_exceptions=True)
+        self.sessions.clear()
+
+    def start_recording(self, name=None):
+        # The recordings of all devices share the same name, in a directory per device
+        name = name or datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        for session in self.sessions.values():
+            session.start_recording(name)
+
+    def stop_recording(self):
+        """
+        Stop the recordings of all devices. Returns the recorded files by device address.
+        """
+        return {address: session.stop_recording() for address, session in self.sessions.items()}
+
+    def throughput(self):
+        """
+        Per-device and per-stream throughput, {address: {stream: {"packets_per_s", "samples_per_s"}}}.
+        """
+        return {address: session.throughput() for address, session in self.sessions.items()}
+
+    def status(self):
+        """
+        One line per device: name, connection state and samples/s of every stream.
+        """
+        lines = []
+        for session in self.sessions.values():
+            if session.connected:
+                state = "connected"
+            elif session.supervisor.reconnecting:
+                state = "reconnecting"
+            else:
+                state = "error" if session.error else "disconnected"
+            rates = ", ".join("{} {:.0f}/s".format(stream, value["samples_per_s"])
+                              for stream, value in session.throughput().items())
+            lost = ", lost {} samples".format(session.lost_samples) if session.lost_samples else ""
+            beats = ""
+            if session.ecg_hr is not None:
+                beats = ", ECG HR {:.0f} bpm, RMSSD {:.1f} ms".format(session.ecg_hr, session.hrv.rmssd)
+            lines.append("{:<24} {:<12} {}{}{}".format(session.device.name, state, rates, beats, lost))
+        return "\n".join(lines)
@@ -0,0 +1,382 @@
+"""
+Simulated Polar H10 and OH1 devices for hardware-free testing.
+
+SimulatedScanner advertises fake "Polar H10 xxxx" / "Polar OH1 xxxx"
+devices and SimulatedClient implements the part of the bleak.BleakClient
+API used by QBleakClient: it answers the device information and battery
+reads, accepts the PMD control point commands and sends protocol-correct
+ECG, PPG, ACC, HR and PPI notifications at the configured rates from
+asyncio tasks, so any number of devices can run in one event loop.
+
+The packet encoders are also used to build synthetic packets for the
+decoder benchmarks.
+"""
+import asyncio
+import os
+import random
+import struct
+import time
+
+import numpy as np
+
+import decoders
+import pmd
+
+
+PMD_CONTROL = "fb005c81-02e7-f387-1cad-8acd2d8df0c8"
+PMD_DATA = "fb005c82-02e7-f387-1cad-8acd2d8df0c8"
+HEART_RATE_MEASUREMENT_UUID = "00002a37-0000-1000-8000-00805f9b34fb"
+BATTERY_LEVEL_UUID = "00002a19-0000-1000-8000-00805f9b34fb"
+MANUFACTURER_NAME_UUID = "00002a29-0000-1000-8000-00805f9b34fb"
+MODEL_NBR_UUID = "00002a24-0000-1000-8000-00805f9b34fb"
+SERIAL_NUMBER_UUID = "00002a25-0000-1000-8000-00805f9b34fb"
+HARDWARE_REVISION_UUID = "00002a27-0000-1000-8000-00805f9b34fb"
+FIRMWARE_REVISION_UUID = "00002a26-0000-1000-8000-00805f9b34fb"
+SOFTWARE_REVISION_UUID = "00002a28-0000-1000-8000-00805f9b34fb"
+
+# Sensor timestamps count nanoseconds from 2000-01-01
+POLAR_EPOCH_OFFSET_NS = 946684800 * 10**9
+
+
+# Packet encoders
+
+def _pmd_header(measurement_type, timestamp_ns, frame_type):
+    return struct.pack("<BQB", measurement_type, timestamp_ns, frame_type)
+
+
+def _int24(values):
+    values = np.asarray(values, dtype=np.int32).reshape(-1)
+    return values.astype("<u4").view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+
+
+def ecg_packet(timestamp_ns, samples):
+    return _pmd_header(decoders.ECG, timestamp_ns, 0x00) + _int24(samples)
+
+
+def ppg_packet(timestamp_ns, samples):
+    # samples = (n, 4) PPG0, PPG1, PPG2, ambient
+    return _pmd_header(decoders.PPG, timestamp_ns, 0x00) + _int24(samples)
+
+
+def acc_packet(timestamp_ns, samples, frame_type=0x01):
+    # samples = (n, 3) x, y, z in milli-G, frame type 0, 1, 2 = 8, 16, 24 bit
+    size = frame_type + 1
+    samples = np.asarray(samples, dtype=np.int32).reshape(-1)
+    if size == 3:
+        payload = _int24(samples)
+    else:
+        payload = samples.astype("<i%d" % size).tobytes()
+    return _pmd_header(decoders.ACC, timestamp_ns, frame_type) + payload
+
+
+def delta_packet(measurement_type, timestamp_ns, samples, resolution, block_size=16):
+    """
+    Delta-compressed PMD frame (frame type 0x80) of (n, channels) samples.
+    """
+    samples = np.asarray(samples, dtype=np.int64)
+    samples = samples.reshape(len(samples), -1)
+    size = (resolution + 7) // 8
+    payload = bytearray()
+    for value in samples[0]:
+        payload += int(value).to_bytes(size, "little", signed=True)
+    deltas = np.diff(samples, axis=0)
+    for start in range(0, len(deltas), block_size):
+        block = deltas[start:start + block_size]
+        delta_size = int(np.max(np.abs(block))).bit_length() + 1
+        bits = ((block.reshape(-1, 1) >> np.arange(delta_size)) & 1).astype(np.uint8)
+        payload += bytes([delta_size, len(block)])
+        payload += np.packbits(bits.reshape(-1), bitorder="little").tobytes()
+    return _pmd_header(measurement_type, timestamp_ns, decoders.DELTA_FRAME) + bytes(payload)
+
+
+def hr_packet(hr, rr_intervals_1024):
+    # Heart Rate Measurement with uint8 HR and RR intervals in 1/1024 s
+    packet = bytearray([0x10, hr])
+    for rr in rr_intervals_1024:
+        packet += struct.pack("<H", rr)
+    return bytes(packet)
+
+
+def ppi_packet(timestamp_ns, hrs, ppis, err_ests, flags=None):
+    if flags is None:
+        flags = [0x06] * len(hrs)  # skin contact supported and detected
+    payload = b"".join(struct.pack("<BHHB", *sample) for sample in zip(hrs, ppis, err_ests, flags))
+    return _pmd_header(decoders.PPI, timestamp_ns, 0x00) + payload
+
+
+# Signal generation
+
+class BeatTrain:
+    """
+    Heart beat times of a simulated subject with respiratory sinus arrhythmia and random variability.
+    """
+    def __init__(self, rng, mean_hr=None):
+        self.rng = rng
+        self.mean_rr = 60.0 / (mean_hr or rng.uniform(55, 85))
+        self.breathing = rng.uniform(0.2, 0.3)
+        self.beats = np.array([0.0])
+
+    def until(self, t):
+        # All beat times up to (and one past) t
+        while self.beats[-1] <= t + 1.0:
+            last = self.beats[-1]
+            rr = (self.mean_rr * (1 + 0.05 * np.sin(2 * np.pi * self.breathing * last))
+                  + self.rng.normal(0, 0.02))
+            self.beats = np.append(self.beats, last + max(rr, 0.3))
+        return self.beats
+
+    def drop_before(self, t):
+        keep = np.searchsorted(self.beats, t - 2.0)
+        if keep > 1:
+            self.beats = self.beats[keep - 1:]
+
+    def phase(self, t):
+        # Time since the nearest beat for every sample time in t
+        beats = self.until(t[-1])
+        i = np.clip(np.searchsorted(beats, t), 1, len(beats) - 1)
+        previous = t - beats[i - 1]
+        following = t - beats[i]
+        return np.where(np.abs(previous) < np.abs(following), previous, following)
+
+
+def ecg_waveform(d):
+    return (1000 * np.exp(-0.5 * (d / 0.012) ** 2)
+            - 150 * np.exp(-0.5 * ((d - 0.03) / 0.01) ** 2)
+            + 250 * np.exp(-0.5 * ((d - 0.25) / 0.04) ** 2)
+            + 100 * np.exp(-0.5 * ((d + 0.16) / 0.025) ** 2))
+
+
+def ppg_waveform(d):
+    return np.exp(-0.5 * ((d - 0.2) / 0.08) ** 2) + 0.4 * np.exp(-0.5 * ((d - 0.45) / 0.1) ** 2)
+
+
+# Simulated device and BLE client
+
+class SimulatedDevice:
+    """
+    Stand-in for bleak's BLEDevice of a simulated Polar device.
+    """
+    simulated = True
+
+    def __init__(self, model, serial, seed=None):
+        self.model = model
+        self.serial = serial
+        self.name = "Polar %s %s" % (model, serial)
+        self.address = "SIM:%02X:%02X:%02X" % tuple(bytes.fromhex(serial.rjust(6, "0")[-6:]))
+        self.seed = seed
+
+    def __repr__(self):
+        return "%s: %s" % (self.address, self.name)
+
+
+# Settings offered by the simulated sensors, as returned by GET_MEASUREMENT_SETTINGS
+# {measurement type: {setting type: [values]}}, setting types 0 = sample rate, 1 = resolution, 2 = range
+AVAILABLE_SETTINGS = {
+    "H10": {decoders.ECG: {0: [130], 1: [14]},
+            decoders.ACC: {0: [25, 50, 100, 200], 1: [16], 2: [2, 4, 8]}},
+    "OH1": {decoders.PPG: {0: [130], 1: [22]},
+            decoders.ACC: {0: [50], 1: [16], 2: [8]},
+            decoders.PPI: {}},
+}
+
+# Samples per notification, chosen so that the packets fit a 232 byte MTU like on the real sensors
+SAMPLES_PER_PACKET = {decoders.ECG: 73, decoders.PPG: 18, decoders.ACC: 36}
+
+
+class SimulatedClient:
+    """
+    Drop-in replacement for bleak.BleakClient connected to a SimulatedDevice.
+    """
+    def __init__(self, device, disconnected_callback=None, **kwargs):
+        self.device = device
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self.mtu_size = 232
+        self.rng = np.random.default_rng(device.seed)
+        self.beats = BeatTrain(self.rng)
+        self.battery = int(self.rng.integers(40, 100))
+        self._callbacks = {}
+        self._tasks = {}
+        self._start = None
+        # The sensor clock runs with a small drift compared to the host clock
+        self.drift_ppm = float(self.rng.uniform(-30, 30))
+        self._clock_offset_ns = 0
+        self._unreachable_until = 0.0
+        # Fraction of the PMD data notifications lost on the way, for testing the loss detection
+        self.packet_loss = float(os.environ.get("POLOPY_SIM_LOSS", 0))
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(0.05)
+        if time.monotonic() < self._unreachable_until:
+            raise ConnectionError("Simulated device out of range")
+        self.is_connected = True
+        if self._start is None:
+            # The sensor clock keeps running between connections
+            self._start = time.monotonic()
+            self._clock_offset_ns = time.time_ns() - POLAR_EPOCH_OFFSET_NS
+        return True
+
+    async def simulate_dropout(self, duration):
+        """
+        Drop the connection as if the device went out of range for `duration` seconds.
+        """
+        self._unreachable_until = time.monotonic() + duration
+        await self.disconnect()
+
+    async def disconnect(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._callbacks.clear()
+        was_connected = self.is_connected
+        self.is_connected = False
+        if was_connected and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+        return True
+
+    def _elapsed(self):
+        return time.monotonic() - self._start
+
+    def sensor_time_ns(self, t):
+        # Sensor timestamp of the simulated time t (s since connecting)
+        return int(self._clock_offset_ns + t * (1 + self.drift_ppm * 1e-6) * 1e9)
+
+    async def read_gatt_char(self, uuid, **kwargs):
+        await asyncio.sleep(0.005)
+        values = {
+            MODEL_NBR_UUID: "Polar " + self.device.model,
+            MANUFACTURER_NAME_UUID: "Polar Electro Oy",
+            SERIAL_NUMBER_UUID: self.device.serial,
+            FIRMWARE_REVISION_UUID: "3.1.1" if self.device.model == "H10" else "2.1.9",
+            HARDWARE_REVISION_UUID: "00760690.03",
+            SOFTWARE_REVISION_UUID: "SIMULATED",
+        }
+        uuid = str(uuid).lower()
+        if uuid == BATTERY_LEVEL_UUID:
+            return bytearray([self.battery])
+        return bytearray(values[uuid].encode("ascii"))
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        uuid = str(uuid).lower()
+        self._callbacks[uuid] = callback
+        if uuid == HEART_RATE_MEASUREMENT_UUID and self.device.model == "H10":
+            self._tasks["HR"] = asyncio.ensure_future(self._hr_loop())
+
+    async def stop_notify(self, uuid, **kwargs):
+        self._callbacks.pop(str(uuid).lower(), None)
+
+    def _notify(self, uuid, data):
+        if uuid == PMD_DATA and self.packet_loss and self.rng.random() < self.packet_loss:
+            return
+        callback = self._callbacks.get(uuid)
+        if callback is not None:
+            callback(uuid, bytearray(data))
+
+    async def write_gatt_char(self, uuid, data, response=None, **kwargs):
+        await asyncio.sleep(0.005)
+        uuid = str(uuid).lower()
+        if uuid != PMD_CONTROL or len(data) < 2:
+            return
+        op_code, measurement_type = data[0], data[1]
+        available = AVAILABLE_SETTINGS[self.device.model]
+        status = pmd.Status.SUCCESS if measurement_type in available else pmd.Status.INVALID_MEASUREMENT_TYPE
+        parameters = b""
+        if op_code == pmd.OpCode.GET_MEASUREMENT_SETTINGS and status == pmd.Status.SUCCESS:
+            parameters = pmd.encode_settings(available[measurement_type])
+        elif op_code == pmd.OpCode.START_MEASUREMENT and status == pmd.Status.SUCCESS:
+            settings = {setting_type: values[0] for setting_type, values in pmd.parse_settings(data, 2).items()}
+            for setting_type, value in settings.items():
+                if value not in available[measurement_type].get(setting_type, [value]):
+                    status = pmd.Status.INVALID_SAMPLE_RATE if setting_type == pmd.SettingType.SAMPLE_RATE else pmd.Status.INVALID_PARAMETER
+            if status == pmd.Status.SUCCESS:
+                self._stop_stream(measurement_type)
+                self._tasks[measurement_type] = asyncio.ensure_future(self._pmd_loop(measurement_type, settings))
+        elif op_code == pmd.OpCode.STOP_MEASUREMENT:
+            self._stop_stream(measurement_type)
+        # Control point response: [0xF0, op code, measurement type, status, more frames, parameters]
+        self._notify(PMD_CONTROL, bytes([pmd.CONTROL_POINT_RESPONSE, op_code, measurement_type, status, 0x00]) + parameters)
+
+    def _stop_stream(self, measurement_type):
+        task = self._tasks.pop(measurement_type, None)
+        if task is not None:
+            task.cancel()
+
+    async def _hr_loop(self):
+        last_beat = self._elapsed()
+        while True:
+            await asyncio.sleep(1.0)
+            now = self._elapsed()
+            beats = self.beats.until(now)
+            new = beats[(beats > last_beat) & (beats <= now)]
+            if len(new) == 0:
+                continue
+            rr = np.diff(np.concatenate([[last_beat], new]))
+            last_beat = new[-1]
+            hr = int(round(60.0 / np.mean(rr)))
+            self._notify(HEART_RATE_MEASUREMENT_UUID, hr_packet(hr, np.round(rr * 1024).astype(int)))
+
+    async def _pmd_loop(self, measurement_type, settings):
+        if measurement_type == decoders.PPI:
+            await self._ppi_loop()
+            return
+        fs = settings.get(0, 130)
+        n = SAMPLES_PER_PACKET[measurement_type]
+        t_next = self._elapsed()
+        while True:
+            t = t_next + np.arange(1, n + 1) / fs
+            t_next = t[-1]
+            delay = t_next - self._elapsed()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            timestamp = self.sensor_time_ns(t_next)
+            if measurement_type == decoders.ECG:
+                samples = ecg_waveform(self.beats.phase(t)) + self.rng.normal(0, 10, n)
+                packet = ecg_packet(timestamp, np.round(samples))
+            elif measurement_type == decoders.PPG:
+                pulse = ppg_waveform(self.beats.phase(t))
+                channels = 200000 + np.outer(pulse, [5000, 4000, 3000]) + self.rng.normal(0, 50, (n, 3))
+                ambient = 1000 + self.rng.normal(0, 20, (n, 1))
+                packet = ppg_packet(timestamp, np.round(np.hstack([channels, ambient])))
+            else:
+                breathing = 15 * np.sin(2 * np.pi * self.beats.breathing * t)
+                samples = np.column_stack([20 + 0 * t, -30 + 0 * t, -990 + breathing]) + self.rng.normal(0, 3, (n, 3))
+                packet = acc_packet(timestamp, np.round(samples))
+            self.beats.drop_before(t[0])
+            self._notify(PMD_DATA, packet)
+
+    async def _ppi_loop(self):
+        last_beat = self._elapsed()
+        while True:
+            await asyncio.sleep(2.0)
+            now = self._elapsed()
+            beats = self.beats.until(now)
+            new = beats[(beats > last_beat) & (beats <= now)]
+            if len(new) == 0:
+                continue
+            ppi = np.diff(np.concatenate([[last_beat], new])) + self.rng.normal(0, 0.005, len(new))
+            last_beat = new[-1]
+            ppi_ms = np.round(ppi * 1000).astype(int)
+            hrs = np.round(60000.0 / ppi_ms).astype(int)
+            err = self.rng.integers(5, 30, len(new))
+            self._notify(PMD_DATA, ppi_packet(self.sensor_time_ns(now), hrs, ppi_ms, err))
+
+
+class SimulatedScanner:
+    """
+    Stand-in for bleak.BleakScanner that "discovers" simulated devices.
+
+    The number of devices comes from the POLOPY_SIM_DEVICES environment variable,
+    e.g. "h10=8,oh1=2", by default one H10 and one OH1.
+    """
+    @staticmethod
+    async def discover(timeout=1.0, devices=None, **kwargs):
+        if devices is None:
+            devices = os.environ.get("POLOPY_SIM_DEVICES", "h10=1,oh1=1")
+        counts = dict(item.split("=") for item in devices.split(",") if item)
+        await asyncio.sleep(min(timeout, 0.1))
+        found = []
+        for model, count in counts.items():
+            for i in range(int(count)):
+                serial = "%08X" % (0x5100 + i if model.upper() == "H10" else 0xA100 + i)
+                found.append(SimulatedDevice(model.upper(), serial, seed=random.getrandbits(32)))
+        return found
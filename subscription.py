@@ -0,0 +1,117 @@
+"""
+Async iteration over the batches of a client signal.
+
+    async with client.stream("ecg", maxsize=64, policy=DROP_OLDEST) as batches:
+        async for batch in batches:
+            ...
+
+The signal callback only appends the batch to the bounded queue of the
+subscription and wakes the consumer, so a slow consumer never runs inside
+the notification handling of the client and never delays the other streams.
+"""
+import asyncio
+from collections import deque
+
+
+# What to do with a new batch when the queue of a subscription is full
+BLOCK = "block"  # the producer waits for space, only for asynchronous producers (see put())
+DROP_OLDEST = "drop_oldest"  # discard the oldest queued batch
+DROP_NEWEST = "drop_newest"  # discard the new batch
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class Subscription:
+    """
+    Bounded queue of the values emitted by a signal, consumed with `async for`.
+
+    Counters: received = values emitted by the signal, dropped = values lost to
+    the policy, high_water = largest number of values queued at once.
+
+    A signal callback can not wait, so a subscription to a signal can not use
+    the BLOCK policy. Without a signal, asynchronous producers call put(), which
+    waits for space with BLOCK, and put_nowait() raises asyncio.QueueFull
+    instead of growing the queue past maxsize.
+    """
+    def __init__(self, signal, maxsize=256, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy {!r}, expected one of {}".format(policy, POLICIES))
+        if policy == BLOCK and signal is not None:
+            raise ValueError("A signal can not wait for space, use {!r} or {!r}".format(DROP_OLDEST, DROP_NEWEST))
+        self.signal = signal
+        self.maxsize = maxsize
+        self.policy = policy
+        self._items = deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+        if signal is not None:
+            signal.connect(self.put_nowait)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def stats(self):
+        return {"received": self.received, "dropped": self.dropped, "queued": len(self._items),
+                "high_water": self.high_water, "maxsize": self.maxsize, "policy": self.policy}
+
+    def put_nowait(self, item):
+        if self.closed:
+            return
+        if self.policy == BLOCK and len(self._items) >= self.maxsize:
+            raise asyncio.QueueFull
+        self.received += 1
+        if len(self._items) >= self.maxsize:
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self.policy == DROP_OLDEST:
+                self._items.popleft()
+                self.dropped += 1
+        self._items.append(item)
+        if len(self._items) > self.high_water:
+            self.high_water = len(self._items)
+        self._ready.set()
+
+    async def put(self, item):
+        """
+        Queue a value from a coroutine, waiting for space when the policy is BLOCK.
+        """
+        while self.policy == BLOCK and len(self._items) >= self.maxsize and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+        self.put_nowait(item)
+
+    def close(self):
+        """
+        Stop receiving. The iteration ends once the values already queued are consumed.
+        """
+        if not self.closed:
+            self.closed = True
+            if self.signal is not None:
+                self.signal.disconnect(self.put_nowait)
+            self._ready.set()
+            self._space.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self.closed:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+        item = self._items.popleft()
+        self._space.set()
+        return item
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
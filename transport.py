@@ -0,0 +1,29 @@
+"""
+Pluggable BLE transport.
+
+The backend is selected with the POLOPY_BACKEND environment variable:
+"bleak" (default) talks to real devices, "sim" uses the simulated devices
+of simulator.py. Clients are created by device type, so simulated and real
+devices can be mixed in the same program.
+"""
+import os
+
+
+BACKEND = os.environ.get("POLOPY_BACKEND", "bleak")
+
+
+def create_client(device, disconnected_callback=None):
+    if getattr(device, "simulated", False):
+        from simulator import SimulatedClient
+        return SimulatedClient(device, disconnected_callback=disconnected_callback)
+    from bleak import BleakClient
+    return BleakClient(device, disconnected_callback=disconnected_callback)
+
+
+async def discover(backend=None, **kwargs):
+    backend = backend or BACKEND
+    if backend == "sim":
+        from simulator import SimulatedScanner
+        return await SimulatedScanner.discover(**kwargs)
+    from bleak import BleakScanner
+    return await BleakScanner.discover(**kwargs)